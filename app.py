@@ -1,39 +1,257 @@
-from flask import Flask, render_template, redirect, url_for, request, flash, send_from_directory, g
+from flask import Flask, Blueprint, render_template, redirect, url_for, request, flash, abort, jsonify, g, current_app, \
+    has_app_context, has_request_context, before_render_template, template_rendered
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 import os
-from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
-from sqlalchemy import or_, and_
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.utils import send_file
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from datetime import datetime, timedelta
+from sqlalchemy import or_, and_, tuple_, event, func, inspect, text, literal_column
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateColumn, CreateTable
+from sqlalchemy.orm import Session, selectinload, joinedload, make_transient_to_detached
+from sqlalchemy.pool import Pool
+from collections import namedtuple, OrderedDict, Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+import base64
+import contextlib
+import functools
+import gzip
+import hashlib
+import hmac
+import itertools
+import json
+import math
+import mimetypes
+import queue
+import re
+import sqlite3
+import threading
+import time
 
 import os
+import logging
 from dotenv import load_dotenv
+from markupsafe import Markup, escape
 
-# Load environment variables
-load_dotenv()
+try:
+    from PIL import Image, ImageOps, features as pil_features
+except ImportError:  # Pillow is optional, without it pages serve the original uploads
+    Image = None
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
-db = SQLAlchemy(app)
-login_manager = LoginManager(app)
-login_manager.login_view = 'login'
+def configure_from_environment(app):
+    """Read the settings from environment variables, or the defaults."""
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///site.db')
+    engine_options = {}
+    for option, variable in (('pool_size', 'DB_POOL_SIZE'), ('max_overflow', 'DB_MAX_OVERFLOW'),
+                             ('pool_recycle', 'DB_POOL_RECYCLE'), ('pool_timeout', 'DB_POOL_TIMEOUT')):
+        if os.environ.get(variable):
+            engine_options[option] = int(os.environ[variable])
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(engine_options, pool_pre_ping=True)
+    app.config['SQLITE_BUSY_TIMEOUT'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))  # milliseconds
+    app.config['SQLITE_CACHE_SIZE'] = int(os.environ.get('SQLITE_CACHE_SIZE', -64000))  # negative means KiB
+    app.config['SQLITE_MMAP_SIZE'] = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+    app.config['SEARCH_BACKEND'] = os.environ.get('SEARCH_BACKEND', 'auto')  # auto, fts5, terms
+    app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1024))  # 0 disables the cache
+    app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', 30))  # seconds
+    app.config['FRAGMENT_CACHE'] = os.environ.get('FRAGMENT_CACHE', 'memory')  # memory, sqlite or none
+    app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 4096))  # rendered fragments kept
+    app.config['FRAGMENT_CACHE_PATH'] = os.environ.get('FRAGMENT_CACHE_PATH', os.path.join(app.instance_path, 'fragments.db'))
+    app.config['ADMIN_STATS_TTL'] = float(os.environ.get('ADMIN_STATS_TTL', 60))  # seconds
+    # Any werkzeug method string, costs included, e.g. scrypt:32768:8:1 or pbkdf2:sha256:600000.
+    # Hashes made with other settings are upgraded at the user's next login.
+    app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    app.config['LOGIN_THROTTLE'] = os.environ.get('LOGIN_THROTTLE', 'memory')  # memory, sqlite or none
+    app.config['LOGIN_THROTTLE_PATH'] = os.environ.get('LOGIN_THROTTLE_PATH', os.path.join(app.instance_path, 'throttle.db'))
+    app.config['LOGIN_IP_BURST'] = int(os.environ.get('LOGIN_IP_BURST', 30))  # attempts per client address
+    app.config['LOGIN_IP_PER_MINUTE'] = float(os.environ.get('LOGIN_IP_PER_MINUTE', 30))
+    app.config['LOGIN_USER_BURST'] = int(os.environ.get('LOGIN_USER_BURST', 10))  # attempts per username
+    app.config['LOGIN_USER_PER_MINUTE'] = float(os.environ.get('LOGIN_USER_PER_MINUTE', 5))
+    # Reverse proxies in front of the app whose X-Forwarded-For/-Proto are trusted; 0 trusts none
+    app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+    app.config['EVENTS_BACKEND'] = os.environ.get('EVENTS_BACKEND', 'memory')  # memory, sqlite or none
+    app.config['EVENTS_PATH'] = os.environ.get('EVENTS_PATH', os.path.join(app.instance_path, 'events.db'))
+    app.config['EVENTS_POLL_INTERVAL'] = float(os.environ.get('EVENTS_POLL_INTERVAL', 0.5))  # seconds, sqlite backend
+    app.config['EVENTS_KEEPALIVE'] = float(os.environ.get('EVENTS_KEEPALIVE', 15))  # seconds between comment pings
+    app.config['EVENTS_MAX_DURATION'] = float(os.environ.get('EVENTS_MAX_DURATION', 300))  # then the browser reconnects
+    app.config['EVENTS_MAX_STREAMS'] = int(os.environ.get('EVENTS_MAX_STREAMS', 24))  # per worker, 0 for no limit
+    app.config['SQL_PROFILER'] = os.environ.get('SQL_PROFILER', '').lower() in ('1', 'true', 'yes')
+    app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 100))  # logged when SQL_PROFILER is on
+    app.config['METRICS_BACKEND'] = os.environ.get('METRICS_BACKEND', 'memory')  # memory, sqlite or none
+    app.config['METRICS_PATH'] = os.environ.get('METRICS_PATH', os.path.join(app.instance_path, 'metrics.db'))
+    app.config['METRICS_FLUSH_INTERVAL'] = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))  # seconds
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')  # bearer token required by /metrics if set
+    app.config['MEDIA_SENDFILE'] = os.environ.get('MEDIA_SENDFILE', '')  # '', x-accel-redirect or x-sendfile
+    app.config['MEDIA_ACCEL_PREFIX'] = os.environ.get('MEDIA_ACCEL_PREFIX', '/_media')  # internal nginx location
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024  # 2MB max file size
+    app.config['IMAGE_WORKERS'] = int(os.environ.get('IMAGE_WORKERS', 2))  # 0 resizes inside the request
+    app.config['AVATAR_FOLDER'] = AVATAR_FOLDER
 
+STORE_BACKENDS = ('memory', 'sqlite', 'none')
+
+def validate_config(config):
+    """Check the settings once, when the app is built, rather than failing
+    on the first request that happens to use a bad one."""
+    problems = []
+    for key in ('FRAGMENT_CACHE', 'LOGIN_THROTTLE', 'EVENTS_BACKEND', 'METRICS_BACKEND'):
+        if config[key] not in STORE_BACKENDS:
+            problems.append(f"{key} must be one of {', '.join(STORE_BACKENDS)}, not {config[key]!r}")
+    if config['SEARCH_BACKEND'] not in ('auto', 'fts5', 'terms'):
+        problems.append(f"SEARCH_BACKEND must be auto, fts5 or terms, not {config['SEARCH_BACKEND']!r}")
+    if config['MEDIA_SENDFILE'] not in ('', 'x-accel-redirect', 'x-sendfile'):
+        problems.append(f"MEDIA_SENDFILE must be empty, x-accel-redirect or x-sendfile, not {config['MEDIA_SENDFILE']!r}")
+    if config['PASSWORD_HASH_METHOD'].split(':', 1)[0] not in ('scrypt', 'pbkdf2'):
+        problems.append(f"PASSWORD_HASH_METHOD must be a scrypt or pbkdf2 method, not {config['PASSWORD_HASH_METHOD']!r}")
+    for key in ('USER_CACHE_SIZE', 'USER_CACHE_TTL', 'FRAGMENT_CACHE_SIZE', 'ADMIN_STATS_TTL', 'IMAGE_WORKERS',
+                'EVENTS_MAX_DURATION', 'EVENTS_MAX_STREAMS', 'SLOW_QUERY_MS', 'SQLITE_BUSY_TIMEOUT', 'TRUSTED_PROXIES'):
+        if config[key] < 0:
+            problems.append(f'{key} must not be negative')
+    for key in ('LOGIN_IP_BURST', 'LOGIN_IP_PER_MINUTE', 'LOGIN_USER_BURST', 'LOGIN_USER_PER_MINUTE',
+                'EVENTS_POLL_INTERVAL', 'EVENTS_KEEPALIVE', 'METRICS_FLUSH_INTERVAL'):
+        if config[key] <= 0:
+            problems.append(f'{key} must be positive')
+    if problems:
+        raise ValueError('Invalid configuration: ' + '; '.join(problems))
+
+def sqlite_connect_listener(config):
+    """The 'connect' listener that tunes each new SQLite connection of an
+    app's engine with that app's settings."""
+    pragmas = (f"PRAGMA busy_timeout={config['SQLITE_BUSY_TIMEOUT']}", 'PRAGMA synchronous=NORMAL',
+               f"PRAGMA cache_size={config['SQLITE_CACHE_SIZE']}", f"PRAGMA mmap_size={config['SQLITE_MMAP_SIZE']}")
+
+    def configure_sqlite(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        # Let the 'begin' hook below choose how each transaction starts
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+    return configure_sqlite
+
+# Endpoints whose transactions differ from what their HTTP method implies:
+# login() only reads on POST. GETs that sometimes write, like the mark-read
+# in conversation(), wrap the write in sqlite_write_transaction().
+SQLITE_DEFERRED_ENDPOINTS = {'accounts.login'}
+
+@event.listens_for(Engine, 'begin')
+def begin_sqlite(conn):
+    if conn.dialect.name != 'sqlite':
+        return
+    # A deferred transaction that reads and then writes fails with "database
+    # is locked" if another worker committed in between; the busy timeout
+    # cannot help it. Requests that write take the write lock up front.
+    if has_request_context() and request.endpoint not in SQLITE_DEFERRED_ENDPOINTS and (
+            request.method not in ('GET', 'HEAD', 'OPTIONS') or g.get('sqlite_write')):
+        conn.exec_driver_sql('BEGIN IMMEDIATE')
+    else:
+        conn.exec_driver_sql('BEGIN')
+
+@contextlib.contextmanager
+def sqlite_write_transaction():
+    """Run the block in a transaction of its own that takes the write lock up
+    front, for requests that only sometimes write, and commit it."""
+    db.session.commit()
+    g.sqlite_write = True
+    try:
+        yield
+        db.session.commit()
+    finally:
+        g.sqlite_write = False
+
+class SQLiteSideStore:
+    """Base for the stores that share state between workers through a
+    SQLite file of their own, outside the main database. Each thread gets a
+    connection, reopened after a fork, that creates the SCHEMA statements."""
+
+    SCHEMA = ()
+    TIMEOUT = 1  # seconds to wait for another worker's write lock
+    SYNCHRONOUS = 'NORMAL'
+    TRIM_EVERY = 100  # writes between calls to trim old rows, for subclasses that keep them
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+
+    def _connection(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.TIMEOUT, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(f'PRAGMA synchronous={self.SYNCHRONOUS}')
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return self._local.conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """A write transaction that takes the lock up front."""
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _trim_due(self):
+        self._writes += 1
+        return self._writes % self.TRIM_EVERY == 0
+
+class ConfiguredStore:
+    """The store named by the first of ``keys`` (memory, sqlite or none),
+    built from the values of the others by the builder of that name. It is
+    built again, and the old one's stop() called, whenever a value changes."""
+
+    def __init__(self, keys, **builders):
+        self.keys, self.builders = keys, builders
+        self._store, self._settings = None, None
+
+    def get(self):
+        settings = tuple(current_app.config[key] for key in self.keys)
+        if settings != self._settings:
+            if self._store is not None and hasattr(self._store, 'stop'):
+                self._store.stop()
+            build = self.builders.get(settings[0])
+            self._store = build(*settings[1:]) if build else None
+            self._settings = settings
+        return self._store
+
+db = SQLAlchemy()
+login_manager = LoginManager()
+login_manager.login_view = 'accounts.login'
+
+# Routes by area; create_app() registers them all. Their commands are
+# top-level, e.g. `flask upgrade-db`.
+main_bp = Blueprint('main', __name__, cli_group=None)
+accounts_bp = Blueprint('accounts', __name__, cli_group=None)
+listings_bp = Blueprint('listings', __name__, cli_group=None)
+messaging_bp = Blueprint('messaging', __name__, cli_group=None)
+reviews_bp = Blueprint('reviews', __name__, cli_group=None)
+admin_bp = Blueprint('admin', __name__, cli_group=None)
+media_bp = Blueprint('media', __name__, cli_group=None)
+
+# Created on first write, not at import
 UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'static', 'uploads')
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024  # 2MB max file size
+AVATAR_FOLDER = os.path.join(os.path.dirname(__file__), 'static', 'avatars')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-AVATAR_FOLDER = os.path.join(os.path.dirname(__file__), 'static', 'avatars')
-if not os.path.exists(AVATAR_FOLDER):
-    os.makedirs(AVATAR_FOLDER)
-app.config['AVATAR_FOLDER'] = AVATAR_FOLDER
+# Resized copies of each listing image, keyed by name with their maximum edge
+IMAGE_SIZES = {'thumb': 480, 'detail': 1280}
+
 AVATAR_ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
 def allowed_avatar(filename):
@@ -41,7 +259,7 @@ def allowed_avatar(filename):
 
 favorites = db.Table('favorites',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
-    db.Column('listing_id', db.Integer, db.ForeignKey('listing.id'), primary_key=True)
+    db.Column('listing_id', db.Integer, db.ForeignKey('listing.id'), primary_key=True, index=True)
 )
 
 class Listing(db.Model):
@@ -57,13 +275,34 @@ class Listing(db.Model):
     seller = db.relationship('User', foreign_keys=[seller_id], backref='listings')
     reserved_by = db.relationship('User', foreign_keys=[reserved_by_id], backref='reserved_listings')
     status = db.Column(db.String(20), default='Available')  # Available, Reserved, Sold
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # bumped when its card changes
     images = db.relationship('ListingImage', cascade='all, delete-orphan', backref='listing')
+    # Shaped after listings() filters/sorts and the seller/buyer history pages
+    __table_args__ = (
+        db.Index('ix_listing_category', 'category', 'id'),
+        db.Index('ix_listing_status', 'status', 'id'),
+        db.Index('ix_listing_price', 'price', 'id'),
+        db.Index('ix_listing_location', 'location'),
+        db.Index('ix_listing_seller', 'seller_id', 'status', 'id'),
+        db.Index('ix_listing_reserved_by', 'reserved_by_id', 'status', 'id'),
+        db.Index('ix_listing_seller_recent', 'seller_id', 'id'),
+        # Ids are never reused, so a cached listing card can not be served for a newer listing
+        {'sqlite_autoincrement': True},
+    )
 
 class ListingImage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(120), nullable=False)
-    listing_id = db.Column(db.Integer, db.ForeignKey('listing.id'), nullable=False)
+    listing_id = db.Column(db.Integer, db.ForeignKey('listing.id'), nullable=False, index=True)
     is_cover = db.Column(db.Boolean, default=False)
+    derivatives = db.Column(db.String(20))  # comma separated formats of the resized copies, once generated
+
+class StoredFile(db.Model):
+    # One file in the content-addressed upload store, shared by every listing
+    # image and avatar with the same bytes
+    name = db.Column(db.String(120), primary_key=True)  # <first two hex digits>/<sha256>.<ext>
+    size = db.Column(db.Integer, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -71,6 +310,9 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(150), nullable=False)
     avatar_filename = db.Column(db.String(120))
     is_admin = db.Column(db.Boolean, default=False)
+    unread_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     favorites = db.relationship('Listing', secondary=favorites, backref='favorited_by', lazy='dynamic')
 
     @property
@@ -79,11 +321,19 @@ class User(UserMixin, db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, current_app.config['PASSWORD_HASH_METHOD'])
 
     def verify_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    def password_needs_rehash(self):
+        return self.password_hash.split('$', 1)[0] != password_hash_prefix(current_app.config['PASSWORD_HASH_METHOD'])
+
+@functools.lru_cache(maxsize=8)
+def password_hash_prefix(method):
+    """The method prefix werkzeug stores for method, with its default costs filled in."""
+    return generate_password_hash('', method).split('$', 1)[0]
+
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -93,6 +343,58 @@ class Message(db.Model):
     read = db.Column(db.Boolean, default=False)
     sender = db.relationship('User', foreign_keys=[sender_id], backref='sent_messages')
     recipient = db.relationship('User', foreign_keys=[recipient_id], backref='received_messages')
+    __table_args__ = (
+        db.Index('ix_message_pair', 'sender_id', 'recipient_id', 'timestamp', 'id'),
+        db.Index('ix_message_unread', 'recipient_id', 'read', 'sender_id'),
+        db.Index('ix_message_timestamp', 'timestamp'),
+    )
+
+# Inbox summary of a conversation, one row per participant (owner) so that
+# each side's inbox is a single indexed range scan. Kept up to date by
+# record_message() and the mark-read in conversation().
+class Thread(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    partner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    last_message_id = db.Column(db.Integer, db.ForeignKey('message.id'))
+    last_timestamp = db.Column(db.DateTime, nullable=False)
+    unread_count = db.Column(db.Integer, nullable=False, default=0)
+    owner = db.relationship('User', foreign_keys=[owner_id])
+    partner = db.relationship('User', foreign_keys=[partner_id])
+    last_message = db.relationship('Message')
+    __table_args__ = (
+        db.UniqueConstraint('owner_id', 'partner_id'),
+        db.Index('ix_thread_owner_recent', 'owner_id', 'last_timestamp', 'id'),
+    )
+
+def touch_thread(owner_id, partner_id, msg, unread_increment):
+    updated = Thread.query.filter_by(owner_id=owner_id, partner_id=partner_id).update({
+        'last_message_id': msg.id,
+        'last_timestamp': msg.timestamp,
+        'unread_count': Thread.unread_count + unread_increment,
+    })
+    if not updated:
+        db.session.add(Thread(owner_id=owner_id, partner_id=partner_id, last_message_id=msg.id,
+                              last_timestamp=msg.timestamp, unread_count=unread_increment))
+
+def record_message(msg):
+    """Add a new message and update both participants' threads; the caller
+    commits, which also pushes the message to both participants' open pages."""
+    db.session.add(msg)
+    db.session.flush()
+    touch_thread(msg.sender_id, msg.recipient_id, msg, 0)
+    touch_thread(msg.recipient_id, msg.sender_id, msg, 1)
+    User.query.filter_by(id=msg.recipient_id).update({'unread_count': User.unread_count + 1})
+    user_cache.invalidate(msg.recipient_id)
+    data = {'id': msg.id, 'sender': msg.sender.username, 'recipient': msg.recipient.username, 'content': msg.content,
+            'timestamp': msg.timestamp.strftime('%Y-%m-%d %H:%M')}
+    queue_event(msg.sender_id, 'message', data)
+    queue_event(msg.recipient_id, 'message', data)
+    queue_unread_event(msg.recipient_id)
+
+def queue_unread_event(user_id):
+    unread_count = db.session.execute(db.select(User.unread_count).where(User.id == user_id)).scalar()
+    queue_event(user_id, 'unread', {'unread_count': unread_count})
 
 class Review(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -105,97 +407,1129 @@ class Review(db.Model):
     reviewer = db.relationship('User', foreign_keys=[reviewer_id], backref='given_reviews')
     reviewee = db.relationship('User', foreign_keys=[reviewee_id], backref='received_reviews')
     listing = db.relationship('Listing', backref='reviews')
+    __table_args__ = (
+        db.Index('ix_review_reviewee', 'reviewee_id', 'timestamp'),
+        db.Index('ix_review_reviewer', 'reviewer_id', 'reviewee_id', 'listing_id'),
+    )
+
+RATING_STARS = range(1, 6)
+
+class RatingSummary(db.Model):
+    # Running totals of the reviews a user has received, kept in step with
+    # the review table by record_review() so profiles never aggregate it
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    stars_1 = db.Column(db.Integer, nullable=False, default=0)
+    stars_2 = db.Column(db.Integer, nullable=False, default=0)
+    stars_3 = db.Column(db.Integer, nullable=False, default=0)
+    stars_4 = db.Column(db.Integer, nullable=False, default=0)
+    stars_5 = db.Column(db.Integer, nullable=False, default=0)
+    user = db.relationship('User', backref=db.backref('rating_summary', uselist=False))
+
+    @property
+    def average(self):
+        return round(self.total / self.count, 2) if self.count else None
+
+    @property
+    def histogram(self):
+        """(stars, count) pairs from five stars down to one."""
+        return [(stars, getattr(self, f'stars_{stars}')) for stars in reversed(RATING_STARS)]
+
+def record_review(review):
+    """Add a new review and count it in the reviewee's rating summary; the caller commits."""
+    db.session.add(review)
+    db.session.flush()
+    column = f'stars_{review.rating}'
+    updated = RatingSummary.query.filter_by(user_id=review.reviewee_id).update({
+        'count': RatingSummary.count + 1,
+        'total': RatingSummary.total + review.rating,
+        column: getattr(RatingSummary, column) + 1,
+    })
+    if not updated:
+        db.session.add(RatingSummary(user_id=review.reviewee_id, count=1, total=review.rating,
+                                     **{f'stars_{stars}': int(stars == review.rating) for stars in RATING_STARS}))
 
 class Report(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     reporter_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     listing_id = db.Column(db.Integer, db.ForeignKey('listing.id'), nullable=True)
     reason = db.Column(db.Text, nullable=False)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     resolved = db.Column(db.Boolean, default=False)
     reporter = db.relationship('User', backref='reports')
     listing = db.relationship('Listing', backref='reports')
+    __table_args__ = (
+        db.Index('ix_report_resolved', 'resolved', 'timestamp', 'id'),
+    )
+
+# Full-text search over listing title/description. SQLite gets an FTS5 table
+# keyed by listing id; other backends use listing_search_term, an inverted
+# index tokenised in Python. Both are kept in sync by the mapper events below.
+listing_search_term = db.Table('listing_search_term',
+    db.Column('term', db.String(64), primary_key=True),
+    db.Column('listing_id', db.Integer, db.ForeignKey('listing.id', ondelete='CASCADE'), primary_key=True, index=True),
+    db.Column('weight', db.Integer, nullable=False)
+)
+
+SEARCH_FTS_DDL = "CREATE VIRTUAL TABLE IF NOT EXISTS listing_fts USING fts5(title, description)"
+SEARCH_TITLE_WEIGHT = 10
+SEARCH_TERM_MAX_LENGTH = 64
+
+def search_tokens(text_value):
+    return [t[:SEARCH_TERM_MAX_LENGTH] for t in re.findall(r'\w+', (text_value or '').lower())]
+
+def search_backend(dialect_name):
+    backend = current_app.config['SEARCH_BACKEND']
+    if backend == 'auto':
+        return 'fts5' if dialect_name == 'sqlite' else 'terms'
+    return backend
+
+def fts_match_expression(keyword):
+    return ' '.join(f'"{t}"*' for t in search_tokens(keyword))
+
+def listing_term_weights(title, description):
+    weights = {}
+    for t in search_tokens(title):
+        weights[t] = weights.get(t, 0) + SEARCH_TITLE_WEIGHT
+    for t in search_tokens(description):
+        weights[t] = weights.get(t, 0) + 1
+    return weights
+
+def index_listing(connection, listing_id, title, description):
+    unindex_listing(connection, listing_id)
+    if search_backend(connection.dialect.name) == 'fts5':
+        connection.execute(text("INSERT INTO listing_fts (rowid, title, description) VALUES (:id, :title, :description)"),
+                           {'id': listing_id, 'title': title, 'description': description})
+    else:
+        rows = [{'term': t, 'listing_id': listing_id, 'weight': w}
+                for t, w in listing_term_weights(title, description).items()]
+        if rows:
+            connection.execute(listing_search_term.insert(), rows)
+
+def unindex_listing(connection, listing_id):
+    if search_backend(connection.dialect.name) == 'fts5':
+        connection.execute(text("DELETE FROM listing_fts WHERE rowid = :id"), {'id': listing_id})
+    else:
+        connection.execute(listing_search_term.delete().where(listing_search_term.c.listing_id == listing_id))
+
+def search_listings_subquery(keyword):
+    """Return a (listing_id, rank) subquery of matches, lower rank first, or
+    None if the keyword has nothing to search for."""
+    tokens = search_tokens(keyword)
+    if not tokens:
+        return None
+    if search_backend(db.engine.dialect.name) == 'fts5':
+        return (db.select(literal_column('rowid').label('listing_id'),
+                          literal_column(f'bm25(listing_fts, {SEARCH_TITLE_WEIGHT}.0, 1.0)').label('rank'))
+                .select_from(text('listing_fts'))
+                .where(text('listing_fts MATCH :match').bindparams(match=fts_match_expression(keyword)))
+                .subquery())
+    term = listing_search_term.c.term
+    prefix = [and_(term >= t, term < t + '\uffff') for t in tokens]
+    query = (db.select(listing_search_term.c.listing_id, (-func.sum(listing_search_term.c.weight)).label('rank'))
+             .where(or_(*prefix))
+             .group_by(listing_search_term.c.listing_id))
+    for condition in prefix:
+        query = query.where(listing_search_term.c.listing_id.in_(
+            db.select(listing_search_term.c.listing_id).where(condition)))
+    return query.subquery()
+
+@event.listens_for(Listing.__table__, 'after_create')
+def create_search_index(target, connection, **kw):
+    if search_backend(connection.dialect.name) == 'fts5':
+        connection.execute(text(SEARCH_FTS_DDL))
+
+@event.listens_for(Listing.__table__, 'before_drop')
+def drop_search_index(target, connection, **kw):
+    if search_backend(connection.dialect.name) == 'fts5':
+        connection.execute(text("DROP TABLE IF EXISTS listing_fts"))
+
+@event.listens_for(Listing, 'after_insert')
+def listing_inserted(mapper, connection, target):
+    index_listing(connection, target.id, target.title, target.description)
+
+@event.listens_for(Listing, 'after_update')
+def listing_updated(mapper, connection, target):
+    state = inspect(target)
+    if state.attrs.title.history.has_changes() or state.attrs.description.history.has_changes():
+        index_listing(connection, target.id, target.title, target.description)
+
+@event.listens_for(Listing, 'after_delete')
+def listing_deleted(mapper, connection, target):
+    unindex_listing(connection, target.id)
+
+def populate_search_index(connection):
+    """Create the listing search index if needed and repopulate it."""
+    if search_backend(connection.dialect.name) == 'fts5':
+        connection.execute(text(SEARCH_FTS_DDL))
+        connection.execute(text("DELETE FROM listing_fts"))
+        connection.execute(text("INSERT INTO listing_fts (rowid, title, description) SELECT id, title, description FROM listing"))
+    else:
+        listing_search_term.create(connection, checkfirst=True)
+        connection.execute(listing_search_term.delete())
+        result = connection.execution_options(yield_per=1000).execute(
+            db.select(Listing.id, Listing.title, Listing.description))
+        for partition in result.partitions():
+            rows = [{'term': t, 'listing_id': r.id, 'weight': w}
+                    for r in partition for t, w in listing_term_weights(r.title, r.description).items()]
+            if rows:
+                connection.execute(listing_search_term.insert(), rows)
+
+@listings_bp.cli.command('rebuild-search-index')
+def rebuild_search_index():
+    """Create the listing search index if needed and repopulate it."""
+    with db.engine.begin() as connection:
+        populate_search_index(connection)
+    print('Search index rebuilt.')
+
+# Columns whose change bumps User.version and so invalidates cached copies.
+USER_VERSIONED_COLUMNS = ('username', 'password_hash', 'avatar_filename', 'is_admin')
+
+@event.listens_for(User, 'before_update')
+def bump_user_version(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[key].history.has_changes() for key in USER_VERSIONED_COLUMNS):
+        target.version = (target.version or 0) + 1
+
+@event.listens_for(User, 'after_update')
+def user_updated(mapper, connection, target):
+    user_cache.invalidate(target.id)
+
+class UserCache:
+    """Bounded LRU of user rows for the Flask-Login loader.
+
+    A hit rebuilds the User in the current session without a SELECT. After
+    the TTL an entry is revalidated by re-reading only its version and unread
+    counter; a changed version forces a full reload. Writes in this process
+    invalidate immediately, so other workers may lag by at most the TTL.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.revalidations = 0
+
+    def load(self, user_id):
+        size, ttl = current_app.config['USER_CACHE_SIZE'], current_app.config['USER_CACHE_TTL']
+        if size <= 0:
+            return db.session.get(User, user_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+        if entry is not None and entry['expires'] <= now:
+            row = db.session.execute(db.select(User.version, User.unread_count).where(User.id == user_id)).first()
+            if row is not None and row.version == entry['values']['version']:
+                entry = {'values': dict(entry['values'], unread_count=row.unread_count), 'expires': now + ttl}
+                self._store(user_id, entry, size)
+                self.revalidations += 1
+            else:
+                entry = None
+        elif entry is not None:
+            self.hits += 1
+        if entry is None:
+            self.misses += 1
+            user = db.session.get(User, user_id)
+            if user is not None:
+                values = {c.key: getattr(user, c.key) for c in inspect(User).column_attrs}
+                self._store(user_id, {'values': values, 'expires': now + ttl}, size)
+            return user
+        user = User(**entry['values'])
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def _store(self, user_id, entry, size):
+        with self._lock:
+            self._entries[user_id] = entry
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                'revalidations': self.revalidations}
+
+user_cache = UserCache()
+
+# Opt-in request profiler. Its hooks are only installed once SQL_PROFILER is
+# first seen on, so a disabled profiler costs one config lookup per request.
+slow_query_log = logging.getLogger('app.slow_query')
+sql_profiler_installed = False
+
+def normalize_sql(statement):
+    """Collapse whitespace, literals and IN lists so equal queries log alike."""
+    statement = re.sub(r"'(?:[^']|'')*'", '?', statement)
+    statement = re.sub(r'\b\d+(?:\.\d+)?\b', '?', statement)
+    statement = re.sub(r'\(\s*\?(?:\s*,\s*\?)+\s*\)', '(?, ...)', statement)
+    return ' '.join(statement.split())
+
+def profile_query_start(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_started'] = time.perf_counter()
+
+def profile_query_end(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('query_started', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    profile = g.get('sql_profile') if has_request_context() else None
+    if profile is not None:
+        profile['queries'] += 1
+        profile['db'] += elapsed
+    if has_app_context() and current_app.config['SQL_PROFILER'] and elapsed * 1000 >= current_app.config['SLOW_QUERY_MS']:
+        slow_query_log.warning('Slow query (%.1f ms) in %s: %s', elapsed * 1000,
+                               request.endpoint if has_request_context() else '-', normalize_sql(statement))
+
+def profile_render_start(sender, template, context, **extra):
+    profile = g.get('sql_profile')
+    if profile is not None:
+        profile['rendering'].append(time.perf_counter())
+
+def profile_render_end(sender, template, context, **extra):
+    profile = g.get('sql_profile')
+    if profile is not None and profile['rendering']:
+        started = profile['rendering'].pop()
+        # Templates rendered from inside another only count once
+        if not profile['rendering']:
+            profile['render'] += time.perf_counter() - started
+
+def install_sql_profiler():
+    global sql_profiler_installed
+    event.listen(Engine, 'before_cursor_execute', profile_query_start)
+    event.listen(Engine, 'after_cursor_execute', profile_query_end)
+    before_render_template.connect(profile_render_start)
+    template_rendered.connect(profile_render_end)
+    sql_profiler_installed = True
+
+def start_request_profile():
+    if current_app.config['SQL_PROFILER']:
+        if not sql_profiler_installed:
+            install_sql_profiler()
+        g.sql_profile = {'queries': 0, 'db': 0.0, 'render': 0.0, 'rendering': [], 'started': time.perf_counter()}
+
+def add_server_timing(response):
+    profile = g.pop('sql_profile', None)
+    if profile is not None:
+        total = time.perf_counter() - profile['started']
+        response.headers.add('Server-Timing', f'db;dur={profile["db"] * 1000:.1f};desc="{profile["queries"]} queries"')
+        response.headers.add('Server-Timing', f'render;dur={profile["render"] * 1000:.1f}')
+        response.headers.add('Server-Timing', f'app;dur={total * 1000:.1f}')
+    return response
+
+# Request and storage metrics for /metrics. Requests only add to a Counter in
+# memory; a thread in each worker flushes the totals to the store every
+# METRICS_FLUSH_INTERVAL, so no request waits on the store.
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+METRIC_FAMILIES = [
+    ('http_requests_total', 'counter', 'Requests handled, by endpoint, method and status.'),
+    ('http_request_duration_seconds', 'histogram', 'Time to handle a request, by endpoint.'),
+    ('db_pool_checkouts_total', 'counter', 'Connections checked out of the SQLAlchemy pool.'),
+    ('db_pool_checked_out', 'gauge', 'Connections currently checked out, summed over workers.'),
+    ('db_pool_overflow', 'gauge', 'Connections open beyond pool_size, summed over workers.'),
+    ('upload_bytes_written_total', 'counter', 'Bytes written to UPLOAD_FOLDER, by kind.'),
+    ('db_rows', 'gauge', 'Rows per model.'),
+]
+
+class MemoryMetricsStore:
+    """Totals for this worker only."""
+
+    def __init__(self):
+        self._counters, self._gauges = Counter(), {}
+        self._lock = threading.Lock()
+
+    def add(self, deltas, gauges):
+        with self._lock:
+            self._counters.update(deltas)
+            self._gauges = dict(gauges)
+
+    def read(self):
+        with self._lock:
+            return dict(self._counters), dict(self._gauges)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+
+class SQLiteMetricsStore(SQLiteSideStore):
+    """Totals shared by every worker through one SQLite file. Counters are
+    summed into one row per series; gauges are kept per process and summed
+    over the processes that flushed in the last STALE_SECONDS."""
+
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS counter (name TEXT NOT NULL, labels TEXT NOT NULL, '
+              'value REAL NOT NULL, PRIMARY KEY (name, labels))',
+              'CREATE TABLE IF NOT EXISTS gauge (name TEXT NOT NULL, labels TEXT NOT NULL, pid INTEGER NOT NULL, '
+              'value REAL NOT NULL, updated REAL NOT NULL, PRIMARY KEY (name, labels, pid))')
+    TIMEOUT = 5
+    SYNCHRONOUS = 'FULL'
+    STALE_SECONDS = 60
+
+    def add(self, deltas, gauges):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany('INSERT INTO counter VALUES (?, ?, ?) '
+                             'ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value',
+                             [(name, json.dumps(labels), value) for (name, labels), value in deltas.items()])
+            conn.execute('DELETE FROM gauge WHERE pid = ? OR updated < ?', (os.getpid(), now - self.STALE_SECONDS))
+            conn.executemany('INSERT INTO gauge VALUES (?, ?, ?, ?, ?)',
+                             [(name, json.dumps(labels), os.getpid(), value, now) for (name, labels), value in gauges.items()])
+
+    def read(self):
+        conn = self._connection()
+        counters = conn.execute('SELECT name, labels, value FROM counter').fetchall()
+        gauges = conn.execute('SELECT name, labels, sum(value) FROM gauge WHERE updated >= ? GROUP BY name, labels',
+                              (time.time() - self.STALE_SECONDS,)).fetchall()
+        return tuple({(name, tuple(map(tuple, json.loads(labels)))): value for name, labels, value in rows}
+                     for rows in (counters, gauges))
+
+    def clear(self):
+        conn = self._connection()
+        conn.execute('DELETE FROM counter')
+        conn.execute('DELETE FROM gauge')
+
+class Metrics:
+    """Collects request, pool and upload metrics in the store selected by
+    METRICS_BACKEND. Series are keyed by (name, labels), labels being a tuple
+    of (name, value) pairs."""
+
+    def __init__(self):
+        self._store = ConfiguredStore(('METRICS_BACKEND', 'METRICS_PATH'),
+                                      memory=lambda path: MemoryMetricsStore(),
+                                      sqlite=SQLiteMetricsStore)
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._histogram_keys = {}
+        self._app, self._engine, self._flusher_pid = None, None, None
+        self._stopped = threading.Event()
+
+    @property
+    def store(self):
+        return self._store.get()
+
+    def inc(self, name, labels=(), amount=1):
+        with self._lock:
+            self._pending[name, labels] += amount
+
+    def observe_request(self, endpoint, method, status, seconds):
+        keys = self._histogram_keys.get(endpoint)
+        if keys is None:
+            labels = (('endpoint', endpoint),)
+            keys = self._histogram_keys[endpoint] = (
+                [(le, ('http_request_duration_seconds_bucket', labels + (('le', '+Inf' if le == float('inf') else str(le)),)))
+                 for le in METRIC_BUCKETS],
+                ('http_request_duration_seconds_sum', labels), ('http_request_duration_seconds_count', labels))
+        buckets, sum_key, count_key = keys
+        with self._lock:
+            pending = self._pending
+            pending['http_requests_total', (('endpoint', endpoint), ('method', method), ('status', str(status)))] += 1
+            for le, key in buckets:
+                # Empty buckets are written too, so every series has all of them
+                pending[key] += seconds <= le
+            pending[sum_key] += seconds
+            pending[count_key] += 1
+
+    def start(self):
+        """Start this worker's flush thread, once per process. It flushes
+        with the settings of the app that last recorded a request."""
+        self._app = current_app._get_current_object()
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid != os.getpid():
+                if self._flusher_pid is not None:
+                    # Forked: the parent reports what it counted itself
+                    self._pending.clear()
+                self._engine = db.engine
+                threading.Thread(target=self._flush_periodically, name='metrics-flusher', daemon=True).start()
+                self._flusher_pid = os.getpid()
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(self._app.config['METRICS_FLUSH_INTERVAL']):
+            with self._app.app_context():
+                self.flush()
+
+    def flush_at_exit(self):
+        if self._app is not None:
+            with self._app.app_context():
+                self.flush()
+
+    def process_gauges(self):
+        pool = self._engine.pool if self._engine is not None else None
+        gauges = {}
+        if hasattr(pool, 'checkedout') and hasattr(pool, 'overflow'):
+            gauges['db_pool_checked_out', ()] = pool.checkedout()
+            gauges['db_pool_overflow', ()] = max(pool.overflow(), 0)
+        return gauges
+
+    def flush(self):
+        store = self.store
+        with self._lock:
+            deltas, self._pending = self._pending, Counter()
+        if store is None:
+            return
+        try:
+            store.add(deltas, self.process_gauges())
+        except sqlite3.Error:
+            # Keep the totals for the next flush
+            with self._lock:
+                self._pending.update(deltas)
+            current_app.logger.warning('Could not flush metrics', exc_info=True)
+
+    def collect(self):
+        """Flush this worker and return the stored (counters, gauges)."""
+        self.flush()
+        return self.store.read()
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+        if self.store is not None:
+            self.store.clear()
+
+metrics = Metrics()
+atexit.register(metrics.flush_at_exit)
+
+@event.listens_for(Pool, 'checkout')
+def count_pool_checkout(dbapi_connection, connection_record, connection_proxy):
+    if has_app_context() and current_app.config['METRICS_BACKEND'] != 'none':
+        metrics.inc('db_pool_checkouts_total')
+
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+def record_request_metrics(response):
+    if current_app.config['METRICS_BACKEND'] != 'none' and 'request_started' in g:
+        metrics.start()
+        metrics.observe_request(request.endpoint or 'unmatched', request.method, response.status_code,
+                                time.perf_counter() - g.request_started)
+    return response
+
+def metric_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def metric_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def render_metrics(samples):
+    """Prometheus text exposition format for {(name, labels): value}."""
+    lines = []
+    for family, kind, description in METRIC_FAMILIES:
+        names = [family + suffix for suffix in ('_bucket', '_sum', '_count')] if kind == 'histogram' else [family]
+        series = sorted(((name, labels), value) for (name, labels), value in samples.items() if name in names)
+        # Histogram buckets go in order of le, then _sum and _count
+        series.sort(key=lambda item: (tuple(label for label in item[0][1] if label[0] != 'le'),
+                                      names.index(item[0][0]), float(dict(item[0][1]).get('le', 0))))
+        lines += [f'# HELP {family} {description}', f'# TYPE {family} {kind}']
+        for (name, labels), value in series:
+            label_text = ','.join(f'{key}="{metric_label_value(label)}"' for key, label in labels)
+            lines.append(f'{name}{{{label_text}}} {metric_value(value)}' if labels else f'{name} {metric_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+@admin_bp.route('/metrics')
+def metrics_endpoint():
+    token = current_app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(403)
+    if metrics.store is None:
+        abort(404)
+    counters, gauges = metrics.collect()
+    samples = {**counters, **gauges}
+    for mapper in db.Model.registry.mappers:
+        samples['db_rows', (('model', mapper.class_.__name__),)] = \
+            db.session.execute(db.select(func.count()).select_from(mapper.local_table)).scalar()
+    return current_app.response_class(render_metrics(samples), mimetype='text/plain; version=0.0.4')
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return user_cache.load(int(user_id))
 
-@app.before_request
 def load_unread_count():
     if current_user.is_authenticated:
-        g.unread_count = Message.query.filter_by(recipient=current_user, read=False).count()
+        g.unread_count = current_user.unread_count
     else:
         g.unread_count = 0
 
-@app.route('/')
+@main_bp.route('/')
 def home():
     return render_template('index.html')
 
-@app.route('/about')
+@main_bp.route('/about')
 def about():
     return render_template('about.html')
 
-@app.route('/contact', methods=['GET', 'POST'])
+@main_bp.route('/contact', methods=['GET', 'POST'])
 def contact():
     if request.method == 'POST':
         flash('Message sent!', 'success')
-        return redirect(url_for('contact'))
+        return redirect(url_for('main.contact'))
     return render_template('contact.html')
 
-@app.route('/register', methods=['GET', 'POST'])
+class MemoryTokenBuckets:
+    """Token buckets for this worker only, dropping the least recently used
+    past maxsize keys."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, rate, now):
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return 0.0 if allowed else (1 - tokens) / rate
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+class SQLiteTokenBuckets(SQLiteSideStore):
+    """Token buckets shared by every worker through one SQLite file. A
+    locked or unreadable file lets the attempt through rather than locking
+    everyone out. Idle buckets are trimmed every hundred writes."""
+
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)',)
+    IDLE_SECONDS = 3600
+
+    def take(self, key, burst, rate, now):
+        try:
+            with self._transaction() as conn:
+                row = conn.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+                tokens, updated = row or (burst, now)
+                tokens = min(burst, tokens + (now - updated) * rate)
+                allowed = tokens >= 1
+                conn.execute('INSERT OR REPLACE INTO bucket VALUES (?, ?, ?)', (key, tokens - 1 if allowed else tokens, now))
+                if self._trim_due():
+                    conn.execute('DELETE FROM bucket WHERE updated < ?', (now - self.IDLE_SECONDS,))
+        except sqlite3.Error:
+            return 0.0
+        return 0.0 if allowed else (1 - tokens) / rate
+
+    def clear(self):
+        self._connection().execute('DELETE FROM bucket')
+
+class LoginThrottle:
+    """Limits password attempts per client address and per username with
+    token buckets in the store selected by LOGIN_THROTTLE. It is checked
+    before any hashing, so a flood of logins is refused cheaply."""
+
+    def __init__(self):
+        self._store = ConfiguredStore(('LOGIN_THROTTLE', 'LOGIN_THROTTLE_PATH'),
+                                      memory=lambda path: MemoryTokenBuckets(), sqlite=SQLiteTokenBuckets)
+        self.throttled = 0
+
+    @property
+    def store(self):
+        return self._store.get()
+
+    def check(self, username=None):
+        """Take a token for this request's address and, if given, the
+        username. Returns 0 when the attempt may go ahead, otherwise the
+        seconds until it may be retried."""
+        store = self.store
+        if store is None:
+            return 0.0
+        now = time.time()
+        wait = store.take(f'ip:{request.remote_addr}', current_app.config['LOGIN_IP_BURST'],
+                          current_app.config['LOGIN_IP_PER_MINUTE'] / 60, now)
+        if not wait and username is not None:
+            wait = store.take(f'user:{username.lower()}', current_app.config['LOGIN_USER_BURST'],
+                              current_app.config['LOGIN_USER_PER_MINUTE'] / 60, now)
+        if wait:
+            self.throttled += 1
+        return wait
+
+    def clear(self):
+        if self.store is not None:
+            self.store.clear()
+        self.throttled = 0
+
+login_throttle = LoginThrottle()
+
+def throttled(template, retry_after):
+    flash(f'Too many attempts. Please try again in {math.ceil(retry_after)} seconds.', 'danger')
+    return render_template(template), 429, {'Retry-After': str(math.ceil(retry_after))}
+
+@accounts_bp.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
+        retry_after = login_throttle.check()
+        if retry_after:
+            return throttled('register.html', retry_after)
         if User.query.filter_by(username=username).first():
             flash('Username already exists.', 'danger')
-            return redirect(url_for('register'))
+            return redirect(url_for('accounts.register'))
         user = User(username=username)
         user.password = password
         db.session.add(user)
         db.session.commit()
         flash('Account created! Please log in.', 'success')
-        return redirect(url_for('login'))
+        return redirect(url_for('accounts.login'))
     return render_template('register.html')
 
-@app.route('/login', methods=['GET', 'POST'])
+@accounts_bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
+        retry_after = login_throttle.check(username)
+        if retry_after:
+            return throttled('login.html', retry_after)
         user = User.query.filter_by(username=username).first()
         if user and user.verify_password(password):
+            if user.password_needs_rehash():
+                user.password = password
+                try:
+                    db.session.commit()
+                except OperationalError:
+                    # Lost the write lock to another worker, the next login tries again
+                    db.session.rollback()
             login_user(user)
             flash('Logged in successfully.', 'success')
-            return redirect(url_for('home'))
+            return redirect(url_for('main.home'))
         else:
             flash('Invalid credentials.', 'danger')
     return render_template('login.html')
 
-@app.route('/logout')
+@accounts_bp.route('/logout')
 @login_required
 def logout():
     logout_user()
     flash('You have been logged out.', 'info')
-    return redirect(url_for('home'))
+    return redirect(url_for('main.home'))
+
+# Uploads are stored once per distinct content, named by their SHA-256 and
+# sharded by its first byte so no directory grows past a few thousand files.
+CONTENT_ADDRESSED_NAME = re.compile(r'^(?:[0-9a-f]{2}/)?[0-9a-f]{32,}\.')
+
+def stored_name(digest, extension):
+    return f"{digest[:2]}/{digest}.{extension.lower()}"
+
+def acquire_stored_file(data, extension):
+    """Add a reference to the stored copy of data, writing it if it is new,
+    and return the name for the referencing row."""
+    name = stored_name(hashlib.sha256(data).hexdigest(), extension)
+    if not StoredFile.query.filter_by(name=name).update({'refcount': StoredFile.refcount + 1}):
+        db.session.add(StoredFile(name=name, size=len(data), refcount=1))
+        db.session.flush()
+    path = os.path.join(current_app.config['UPLOAD_FOLDER'], name)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(partial, 'wb') as f:
+            f.write(data)
+        os.replace(partial, path)
+        metrics.inc('upload_bytes_written_total', (('kind', 'original'),), len(data))
+    return name
+
+def store_upload(file):
+    return acquire_stored_file(file.read(), file.filename.rsplit('.', 1)[1])
+
+def release_stored_file(name):
+    """Drop a reference; the last one removes the file and its resized copies.
+    This runs under the transaction's write lock, so an upload of the same
+    bytes in another worker waits and then writes the file again."""
+    StoredFile.query.filter_by(name=name).update({'refcount': StoredFile.refcount - 1})
+    if StoredFile.query.filter(StoredFile.name == name, StoredFile.refcount <= 0).delete():
+        remove_image_files(name)
+
+def derivative_filename(filename, size, fmt):
+    return f"{filename.rsplit('.', 1)[0]}.{size}.{fmt}"
+
+def image_file_names(filename):
+    """The original upload and every resized copy that may exist for it."""
+    return [filename] + [derivative_filename(filename, size, fmt) for size in IMAGE_SIZES for fmt in ('jpg', 'webp')]
+
+def remove_image_files(filename):
+    for name in image_file_names(filename):
+        try:
+            os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], name))
+        except OSError:
+            pass
+
+def generate_derivatives(image_id, filename):
+    """Write JPEG (and WebP, if Pillow supports it) copies of an upload for
+    every size in IMAGE_SIZES, then mark the image row as having them."""
+    folder = current_app.config['UPLOAD_FOLDER']
+    formats = ['jpg'] + (['webp'] if pil_features.check('webp') else [])
+    # Images with the same content share their resized copies
+    missing = {size: edge for size, edge in IMAGE_SIZES.items()
+               if not all(os.path.exists(os.path.join(folder, derivative_filename(filename, size, fmt))) for fmt in formats)}
+    try:
+        if missing:
+            with Image.open(os.path.join(folder, filename)) as original:
+                image = ImageOps.exif_transpose(original)
+                image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+                for size, edge in missing.items():
+                    resized = image.copy()
+                    resized.thumbnail((edge, edge), Image.LANCZOS)
+                    flat = resized
+                    if resized.mode == 'RGBA':
+                        flat = Image.new('RGB', resized.size, 'white')
+                        flat.paste(resized, mask=resized.getchannel('A'))
+                    flat.save(os.path.join(folder, derivative_filename(filename, size, 'jpg')),
+                              'JPEG', quality=82, optimize=True, progressive=True)
+                    if 'webp' in formats:
+                        resized.save(os.path.join(folder, derivative_filename(filename, size, 'webp')), 'WEBP', quality=80)
+                    metrics.inc('upload_bytes_written_total', (('kind', 'derivative'),),
+                                sum(os.path.getsize(os.path.join(folder, derivative_filename(filename, size, fmt)))
+                                    for fmt in formats))
+    except (OSError, ValueError):
+        logging.getLogger(__name__).exception('Could not resize image %s', filename)
+        return
+    with current_app.app_context():
+        ListingImage.query.filter_by(id=image_id).update({'derivatives': ','.join(formats)})
+        Listing.query.filter(Listing.id == db.select(ListingImage.listing_id).where(ListingImage.id == image_id)
+                             .scalar_subquery()).update({'version': Listing.version + 1}, synchronize_session=False)
+        db.session.commit()
+
+image_executor = None
+
+def schedule_derivatives(images):
+    """Resize committed images on the background pool (created lazily, so
+    each forked worker gets its own threads)."""
+    global image_executor
+    if Image is None:
+        return
+    jobs = [(img.id, img.filename) for img in images]
+    # Reading the expired ids began a new transaction; end it so the
+    # resizer's own session can write the derivatives column.
+    db.session.commit()
+    if current_app.config['IMAGE_WORKERS'] <= 0:
+        for job in jobs:
+            generate_derivatives(*job)
+        return
+    if image_executor is None:
+        image_executor = ThreadPoolExecutor(max_workers=current_app.config['IMAGE_WORKERS'], thread_name_prefix='image-derivatives')
+    app = current_app._get_current_object()
+
+    def resize(image_id, filename):
+        with app.app_context():
+            generate_derivatives(image_id, filename)
+    for job in jobs:
+        image_executor.submit(resize, *job)
+
+@media_bp.app_template_global()
+def image_url(img, size=None, fmt='jpg'):
+    if size and img.derivatives and fmt in img.derivatives.split(','):
+        return url_for('media.uploaded_file', filename=derivative_filename(img.filename, size, fmt))
+    return url_for('media.uploaded_file', filename=img.filename)
+
+@media_bp.app_template_global()
+def image_srcset(img, fmt='jpg'):
+    if not img.derivatives or fmt not in img.derivatives.split(','):
+        return ''
+    return ', '.join(f'{image_url(img, size, fmt)} {edge}w' for size, edge in IMAGE_SIZES.items())
+
+@media_bp.cli.command('generate-image-derivatives')
+def generate_image_derivatives():
+    """Resize every listing image that has no derivatives yet."""
+    if Image is None:
+        print('Pillow is not installed.')
+        return
+    pending = [(img.id, img.filename) for img in ListingImage.query.filter(ListingImage.derivatives.is_(None))]
+    for job in pending:
+        generate_derivatives(*job)
+    print(f'Resized {len(pending)} images.')
 
 CATEGORIES = ['Electronics', 'Appliances', 'Books', 'Clothing', 'Sports', 'Other']
+LISTINGS_PER_PAGE = 24
 
-@app.route('/listings')
-def listings():
-    category = request.args.get('category', '')
-    keyword = request.args.get('keyword', '')
-    location = request.args.get('location', '')
-    min_price = request.args.get('min_price', '')
-    max_price = request.args.get('max_price', '')
-    status = request.args.get('status', '')
-    sort = request.args.get('sort', 'newest')
-    query = Listing.query
+Page = namedtuple('Page', ['items', 'next_cursor', 'prev_cursor'])
+
+def encode_cursor(values):
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def decode_cursor(token, columns):
+    """Turn a cursor token back into bind values for columns, or None if it is
+    missing or malformed."""
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        if not isinstance(values, list) or len(values) != len(columns):
+            return None
+        if not all(isinstance(v, (int, float, str)) for v in values):
+            return None
+        return [db.literal(datetime.fromisoformat(v) if isinstance(c.type, db.DateTime) else v, c.type)
+                for c, v in zip(columns, values)]
+    except (ValueError, TypeError):
+        return None
+
+def keyset_paginate(query, columns, descending, per_page, after=None, before=None):
+    """Page through query ordered by columns (the last one must be unique).
+
+    Instead of OFFSET, each page is fetched with a WHERE on the (sort key, id)
+    of the row at its edge, so deep pages cost the same as the first one.
+    query may also be a list of queries over disjoint rows, for example the
+    two directions of a conversation; each is paged along its own index and
+    the results are merged.
+    """
+    after = decode_cursor(after, columns)
+    before = decode_cursor(before, columns) if after is None else None
+    backwards = before is not None
+    reverse = descending != backwards
+    cursor = before if backwards else after
+    queries = query if isinstance(query, (list, tuple)) else [query]
+    rows = []
+    for query in queries:
+        if cursor is not None:
+            key = tuple_(*columns)
+            query = query.filter(key < tuple_(*cursor) if reverse else key > tuple_(*cursor))
+        query = query.order_by(*[c.desc() if reverse else c.asc() for c in columns])
+        rows += query.limit(per_page + 1).all()
+    if len(queries) > 1:
+        rows.sort(key=lambda row: tuple(getattr(row, c.key) for c in columns), reverse=reverse)
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    def edge(row):
+        return encode_cursor([getattr(row, c.key) for c in columns])
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if has_more or backwards:
+            next_cursor = edge(rows[-1])
+        if (has_more and backwards) or (after is not None and not backwards):
+            prev_cursor = edge(rows[0])
+    return Page(rows, next_cursor, prev_cursor)
+
+class MemoryFragmentStore:
+    """Bounded LRU of rendered fragments, private to this worker."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+            return html
+
+    def set(self, key, html):
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def evict(self, prefix):
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class SQLiteFragmentStore(SQLiteSideStore):
+    """Fragments shared by every worker through one SQLite file. It is a
+    cache, so a locked or unreadable file just counts as a miss. The oldest
+    rows are trimmed to maxsize every hundred writes."""
+
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS fragment (key TEXT PRIMARY KEY, html TEXT NOT NULL, stored_at REAL NOT NULL)',
+              'CREATE INDEX IF NOT EXISTS ix_fragment_stored_at ON fragment (stored_at)')
+    SYNCHRONOUS = 'OFF'
+
+    def __init__(self, path, maxsize):
+        super().__init__(path)
+        self.maxsize = maxsize
+
+    def get(self, key):
+        try:
+            row = self._connection().execute('SELECT html FROM fragment WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error:
+            return None
+        return row[0] if row else None
+
+    def set(self, key, html):
+        try:
+            conn = self._connection()
+            conn.execute('INSERT OR REPLACE INTO fragment VALUES (?, ?, ?)', (key, html, time.time()))
+            if self._trim_due():
+                conn.execute('DELETE FROM fragment WHERE stored_at < (SELECT stored_at FROM fragment '
+                             'ORDER BY stored_at DESC LIMIT 1 OFFSET ?)', (self.maxsize - 1,))
+        except sqlite3.Error:
+            pass
+
+    def evict(self, prefix):
+        self._connection().execute('DELETE FROM fragment WHERE key >= ? AND key < ?', (prefix, prefix + '\uffff'))
+
+    def clear(self):
+        self._connection().execute('DELETE FROM fragment')
+
+    def __len__(self):
+        return self._connection().execute('SELECT count(*) FROM fragment').fetchone()[0]
+
+class FragmentCache:
+    """Rendered template fragments keyed by name and version, in the store
+    selected by FRAGMENT_CACHE. Keys carry the version, so a changed record
+    is simply rendered under a new key and old entries age out."""
+
+    def __init__(self):
+        self._store = ConfiguredStore(('FRAGMENT_CACHE', 'FRAGMENT_CACHE_PATH', 'FRAGMENT_CACHE_SIZE'),
+                                      memory=lambda path, size: MemoryFragmentStore(size) if size > 0 else None,
+                                      sqlite=SQLiteFragmentStore)
+        self.hits = self.misses = 0
+
+    @property
+    def store(self):
+        return self._store.get()
+
+    def get(self, key):
+        html = self.store.get(key) if self.store is not None else None
+        if html is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return html
+
+    def set(self, key, html):
+        if self.store is not None:
+            self.store.set(key, html)
+
+    def evict(self, prefix):
+        if self.store is not None:
+            self.store.evict(prefix)
+
+    def clear(self):
+        if self.store is not None:
+            self.store.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        return {'backend': current_app.config['FRAGMENT_CACHE'], 'size': len(self.store) if self.store is not None else 0,
+                'hits': self.hits, 'misses': self.misses}
+
+fragment_cache = FragmentCache()
+
+@listings_bp.cli.command('clear-fragment-cache')
+def clear_fragment_cache():
+    """Drop every cached fragment, e.g. after deploying changed templates."""
+    fragment_cache.clear()
+    print(f"Cleared the {current_app.config['FRAGMENT_CACHE']} fragment cache.")
+
+FRAGMENT_HOLE = '<!--fragment-hole:{}-->'
+
+@listings_bp.app_template_global()
+def cached_fragment(name, *key, caller, **holes):
+    """Render the body of a {% call %} block once per key. The keyword
+    arguments are rendered on every request into the fragment_hole() markers."""
+    cache_key = ':'.join(str(part) for part in (name,) + key)
+    html = fragment_cache.get(cache_key)
+    if html is None:
+        html = str(caller())
+        fragment_cache.set(cache_key, html)
+    for hole, value in holes.items():
+        html = html.replace(FRAGMENT_HOLE.format(hole), str(escape(value)))
+    return Markup(html)
+
+@listings_bp.app_template_global()
+def fragment_hole(name):
+    return Markup(FRAGMENT_HOLE.format(name))
+
+# Columns shown on a listing card; changing one moves the card to a new version
+LISTING_CARD_COLUMNS = ('title', 'price', 'category', 'location', 'status')
+
+def bump_card_version(listing):
+    """Move the listing's cached card to a new key."""
+    listing.version = Listing.version + 1
+
+@event.listens_for(Listing, 'before_update')
+def bump_listing_version(mapper, connection, target):
+    state = inspect(target)
+    if not state.attrs.version.history.has_changes() and \
+            any(state.attrs[key].history.has_changes() for key in LISTING_CARD_COLUMNS):
+        bump_card_version(target)
+
+def evict_listing_card(listing_id):
+    # Only frees the space: the id is never handed out again, so other
+    # workers' copies are never read
+    fragment_cache.evict(f'listing-card:{listing_id}:')
+
+def section_page(query, columns, descending, per_page, section):
+    """Keyset-paginate one of several independently paged tables on a page
+    by its own <section>_after / <section>_before cursors."""
+    return keyset_paginate(query, columns, descending, per_page, after=request.args.get(f'{section}_after'),
+                           before=request.args.get(f'{section}_before'))
+
+def section_page_urls(page, section, endpoint, **values):
+    """Previous/next links for a section page that keep every other argument,
+    so the other sections stay where they are. Arguments named like a path
+    value or a url_for option (_external, _anchor...) are dropped."""
+    args = {k: v for k, v in request.args.items()
+            if k not in (f'{section}_after', f'{section}_before') and k not in values and not k.startswith('_')}
+    def link(direction, cursor):
+        return url_for(endpoint, **values, **args, **{f'{section}_{direction}': cursor}) if cursor else None
+    return link('before', page.prev_cursor), link('after', page.next_cursor)
+
+def listing_card_options(*relationships):
+    """Loader options for listing cards: images in one extra SELECT for the
+    whole page and the seller (plus any extra relationships) joined in."""
+    return [selectinload(Listing.images), joinedload(Listing.seller)] + [joinedload(r) for r in relationships]
+
+def favorite_ids_for(listings):
+    """Ids of the given listings that the current user has favorited, in one query."""
+    if not current_user.is_authenticated or not listings:
+        return set()
+    rows = db.session.execute(db.select(favorites.c.listing_id).where(
+        favorites.c.user_id == current_user.id,
+        favorites.c.listing_id.in_([l.id for l in listings])))
+    return {row.listing_id for row in rows}
+
+LISTING_SORTS = {
+    'newest': ([Listing.id], True),
+    'price_asc': ([Listing.price, Listing.id], False),
+    'price_desc': ([Listing.price, Listing.id], True),
+}
+
+# The /listings query arguments that page links carry over
+LISTING_FILTER_ARGS = ('category', 'keyword', 'location', 'min_price', 'max_price', 'status', 'sort')
+
+def listings_page(args, per_page=LISTINGS_PER_PAGE):
+    """Filter, sort and keyset-paginate listings by the /listings query
+    arguments; returns the page and the sort that was applied."""
+    category = args.get('category', '')
+    keyword = args.get('keyword', '')
+    location = args.get('location', '')
+    min_price = args.get('min_price', '')
+    max_price = args.get('max_price', '')
+    status = args.get('status', '')
+    sort = args.get('sort', '')
+    query = Listing.query.options(*listing_card_options())
+    matches = search_listings_subquery(keyword) if keyword else None
     if category:
         query = query.filter_by(category=category)
     if location:
         query = query.filter(Listing.location.contains(location))
-    if keyword:
+    if matches is not None:
+        query = query.join(matches, matches.c.listing_id == Listing.id)
+    elif keyword:
         query = query.filter(Listing.title.contains(keyword) | Listing.description.contains(keyword))
     if min_price:
         try:
@@ -209,24 +1543,121 @@ def listings():
             pass
     if status:
         query = query.filter_by(status=status)
-    if sort == 'price_asc':
-        query = query.order_by(Listing.price.asc())
-    elif sort == 'price_desc':
-        query = query.order_by(Listing.price.desc())
-    else:
-        query = query.order_by(Listing.id.desc())
-    all_listings = query.all()
+    if sort == 'relevance' or (not sort and matches is not None):
+        sort = 'relevance' if matches is not None else 'newest'
+    elif sort not in LISTING_SORTS:
+        sort = 'newest'
+    if sort == 'relevance':
+        query = query.add_columns(matches.c.rank, Listing.id)
+        page = keyset_paginate(query, [matches.c.rank, Listing.id], False, per_page,
+                               after=args.get('after'), before=args.get('before'))
+        return page._replace(items=[row[0] for row in page.items]), sort
+    columns, descending = LISTING_SORTS[sort]
+    return keyset_paginate(query, columns, descending, per_page,
+                           after=args.get('after'), before=args.get('before')), sort
+
+@listings_bp.route('/listings')
+def listings():
+    page, sort = listings_page(request.args)
+    args = {k: request.args[k] for k in LISTING_FILTER_ARGS if k in request.args}
+    next_url = url_for('listings.listings', after=page.next_cursor, **args) if page.next_cursor else None
+    prev_url = url_for('listings.listings', before=page.prev_cursor, **args) if page.prev_cursor else None
     locations = [l.location for l in Listing.query.with_entities(Listing.location).distinct() if l.location]
-    return render_template('listings.html', listings=all_listings, categories=CATEGORIES, selected_category=category, keyword=keyword, locations=locations, selected_location=location, min_price=min_price, max_price=max_price, selected_status=status, sort=sort)
+    api_next_url = url_for('listings.api_listings', after=page.next_cursor, fields=','.join(LISTING_SCROLL_FIELDS), **args) if page.next_cursor else None
+    return render_template('listings.html', listings=page.items, favorite_ids=favorite_ids_for(page.items), next_url=next_url, prev_url=prev_url, api_next_url=api_next_url, categories=CATEGORIES, selected_category=args.get('category', ''), keyword=args.get('keyword', ''), locations=locations, selected_location=args.get('location', ''), min_price=args.get('min_price', ''), max_price=args.get('max_price', ''), selected_status=args.get('status', ''), sort=sort)
+
+API_MAX_PAGE_SIZE = 100
+API_GZIP_MIN_SIZE = 1024  # bytes; smaller bodies are not worth compressing
+
+def cover_image(listing):
+    return next((img for img in listing.images if img.is_cover), listing.images[0] if listing.images else None)
 
-@app.route('/listing/<int:listing_id>')
+# Fields a client may pick with ?fields=, each read from a listing loaded
+# with listing_card_options() and the current user's favorite ids
+LISTING_API_FIELDS = {
+    'id': lambda listing, favorite_ids: listing.id,
+    'title': lambda listing, favorite_ids: listing.title,
+    'description': lambda listing, favorite_ids: listing.description,
+    'price': lambda listing, favorite_ids: listing.price,
+    'category': lambda listing, favorite_ids: listing.category,
+    'location': lambda listing, favorite_ids: listing.location,
+    'status': lambda listing, favorite_ids: listing.status,
+    'seller': lambda listing, favorite_ids: listing.seller.username,
+    'cover': lambda listing, favorite_ids: image_url(cover_image(listing), 'thumb') if listing.images else None,
+    'images': lambda listing, favorite_ids: [image_url(img, 'thumb') for img in listing.images],
+    'image_count': lambda listing, favorite_ids: len(listing.images),
+    'url': lambda listing, favorite_ids: url_for('listings.listing_detail', listing_id=listing.id),
+    # None when the current user cannot favorite the listing
+    'favorited': lambda listing, favorite_ids: listing.id in favorite_ids
+        if current_user.is_authenticated and listing.seller_id != current_user.id else None,
+}
+LISTING_API_DEFAULT_FIELDS = ['id', 'title', 'price', 'category', 'location', 'status', 'cover', 'url']
+# What static/js/listings.js needs to render a card while scrolling
+LISTING_SCROLL_FIELDS = ['id', 'title', 'price', 'category', 'location', 'status', 'cover', 'image_count', 'url', 'favorited']
+
+def conditional_json(payload):
+    """JSON response with a content-hash ETag. A matching If-None-Match gets
+    304 before anything is compressed; larger bodies are gzipped for clients
+    that accept it, under their own ETag."""
+    body = json.dumps(payload, separators=(',', ':')).encode()
+    compress = request.accept_encodings['gzip'] > 0 and len(body) >= API_GZIP_MIN_SIZE
+    etag = hashlib.sha1(body).hexdigest() + ('-gzip' if compress else '')
+    response = current_app.response_class(mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.update(['Accept-Encoding', 'Cookie'])
+    if request.if_none_match.contains(etag):
+        response.status_code = 304
+        return response
+    if compress:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.content_encoding = 'gzip'
+    else:
+        response.set_data(body)
+    return response
+
+@listings_bp.route('/api/listings')
+def api_listings():
+    fields = [f for f in request.args.get('fields', '').split(',') if f] or LISTING_API_DEFAULT_FIELDS
+    unknown = [f for f in fields if f not in LISTING_API_FIELDS]
+    if unknown:
+        return jsonify(error=f"Unknown fields: {', '.join(unknown)}"), 400
+    limit = request.args.get('limit', LISTINGS_PER_PAGE, type=int)
+    page, sort = listings_page(request.args, per_page=max(1, min(limit, API_MAX_PAGE_SIZE)))
+    favorite_ids = favorite_ids_for(page.items) if 'favorited' in fields else set()
+    return conditional_json({
+        'items': [{f: LISTING_API_FIELDS[f](listing, favorite_ids) for f in fields} for listing in page.items],
+        'sort': sort,
+        'next_cursor': page.next_cursor,
+        'prev_cursor': page.prev_cursor,
+    })
+
+@listings_bp.route('/api/listing-images')
+def api_listing_images():
+    """Image URLs for a batch of listings (?ids=1,2,3), cover first, fetched
+    by the carousel the first time someone browses a card's photos."""
+    try:
+        ids = {int(i) for i in request.args.get('ids', '').split(',') if i.strip()}
+    except ValueError:
+        return jsonify(error='ids must be a comma separated list of listing ids'), 400
+    if len(ids) > API_MAX_PAGE_SIZE:
+        return jsonify(error=f'At most {API_MAX_PAGE_SIZE} ids per request'), 400
+    manifests = {str(i): [] for i in sorted(ids)}
+    images = ListingImage.query.filter(ListingImage.listing_id.in_(ids)) \
+        .order_by(ListingImage.listing_id, ListingImage.is_cover.desc(), ListingImage.id)
+    for img in images:
+        manifests[str(img.listing_id)].append(image_url(img, 'thumb'))
+    return conditional_json({'images': manifests})
+
+@listings_bp.route('/listing/<int:listing_id>')
 def listing_detail(listing_id):
     listing = Listing.query.get_or_404(listing_id)
     return render_template('listing_detail.html', listing=listing)
 
 # Remove YOLO/OpenCV imports and crop_main_object function
 
-@app.route('/listing/new', methods=['GET', 'POST'])
+@listings_bp.route('/listing/new', methods=['GET', 'POST'])
 @login_required
 def new_listing():
     if request.method == 'POST':
@@ -240,32 +1671,34 @@ def new_listing():
         listing = Listing(title=title, description=description, price=price, category=category, location=location, seller=current_user)
         db.session.add(listing)
         db.session.commit()
+        new_imgs = []
         for i, file in enumerate(files):
             if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                image_filename = f"{current_user.id}_{listing.id}_{filename}"
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], image_filename)
-                file.save(file_path)
+                image_filename = store_upload(file)
                 img = ListingImage(filename=image_filename, listing=listing, is_cover=(i == cover_index))
                 db.session.add(img)
+                new_imgs.append(img)
         db.session.commit()
+        schedule_derivatives(new_imgs)
         flash('Listing created!', 'success')
-        return redirect(url_for('listings'))
+        return redirect(url_for('listings.listings'))
     return render_template('new_listing.html', categories=CATEGORIES)
 
-@app.route('/listing/<int:listing_id>/edit', methods=['GET', 'POST'])
+@listings_bp.route('/listing/<int:listing_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_listing(listing_id):
     listing = Listing.query.get_or_404(listing_id)
     if listing.seller != current_user:
         flash('You do not have permission to edit this listing.', 'danger')
-        return redirect(url_for('listing_detail', listing_id=listing.id))
+        return redirect(url_for('listings.listing_detail', listing_id=listing.id))
     if request.method == 'POST':
         listing.title = request.form['title']
         listing.description = request.form['description']
         listing.price = float(request.form['price'])
         listing.category = request.form['category']
         listing.location = request.form['location']
+        # Image changes do not touch the listing row, so move the card on explicitly
+        bump_card_version(listing)
         files = request.files.getlist('images')
         cover_existing = request.form.get('cover_radio_existing')
         cover_new = request.form.get('cover_index_new')
@@ -275,10 +1708,7 @@ def edit_listing(listing_id):
             ids_to_delete = [int(i) for i in delete_image_ids.split(',') if i.strip()]
             for img in listing.images[:]:
                 if img.id in ids_to_delete:
-                    try:
-                        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], img.filename))
-                    except Exception:
-                        pass
+                    release_stored_file(img.filename)
                     db.session.delete(img)
         # 1. Reset all existing images to not be cover
         for img in listing.images:
@@ -292,184 +1722,573 @@ def edit_listing(listing_id):
         new_imgs = []
         for i, file in enumerate(files):
             if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                image_filename = f"{current_user.id}_{listing.id}_{filename}"
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], image_filename)
-                file.save(file_path)
+                image_filename = store_upload(file)
                 is_cover = (cover_new is not None and str(i) == str(cover_new)) and not cover_existing
                 img = ListingImage(filename=image_filename, listing=listing, is_cover=is_cover)
                 db.session.add(img)
                 new_imgs.append(img)
         db.session.commit()
+        schedule_derivatives(new_imgs)
         flash('Listing updated!', 'success')
-        return redirect(url_for('listing_detail', listing_id=listing.id))
+        return redirect(url_for('listings.listing_detail', listing_id=listing.id))
     return render_template('edit_listing.html', listing=listing, categories=CATEGORIES)
 
-@app.route('/listing/<int:listing_id>/delete', methods=['POST'])
+@listings_bp.route('/listing/<int:listing_id>/delete', methods=['POST'])
 @login_required
 def delete_listing(listing_id):
     listing = Listing.query.get_or_404(listing_id)
     if listing.seller != current_user:
         flash('You do not have permission to delete this listing.', 'danger')
-        return redirect(url_for('listing_detail', listing_id=listing.id))
-    # Delete associated images from disk
+        return redirect(url_for('listings.listing_detail', listing_id=listing.id))
     for img in listing.images:
-        try:
-            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], img.filename))
-        except Exception:
-            pass
+        release_stored_file(img.filename)
     db.session.delete(listing)
     db.session.commit()
+    evict_listing_card(listing_id)
     flash('Listing deleted.', 'info')
-    return redirect(url_for('listings'))
+    return redirect(url_for('listings.listings'))
+
+def listing_state_or_404(listing_id):
+    """Status and parties of a listing, read without loading the object."""
+    return db.session.execute(db.select(Listing.status, Listing.seller_id, Listing.reserved_by_id)
+                              .where(Listing.id == listing_id)).one_or_none() or abort(404)
 
-@app.route('/listing/<int:listing_id>/reserve', methods=['POST'])
+def transition_listing(listing_id, from_status, to_status, **values):
+    """Move a listing from from_status to to_status in one conditional UPDATE
+    and return whether it applied. The checks the routes make beforehand only
+    pick the error message; of several racing requests the database lets
+    exactly one match the row."""
+    criteria = [Listing.id == listing_id]
+    if from_status is not None:
+        criteria.append(Listing.status == from_status)
+    result = db.session.execute(
+        db.update(Listing).where(*criteria)
+        .values(status=to_status, version=Listing.version + 1, **values)
+        .execution_options(synchronize_session=False))
+    return result.rowcount == 1
+
+@listings_bp.route('/listing/<int:listing_id>/reserve', methods=['POST'])
 @login_required
 def reserve_listing(listing_id):
-    listing = Listing.query.get_or_404(listing_id)
+    listing = listing_state_or_404(listing_id)
     if listing.status != 'Available':
         flash('This listing is not available for reservation.', 'danger')
-        return redirect(url_for('listing_detail', listing_id=listing.id))
-    if listing.seller == current_user:
+    elif listing.seller_id == current_user.id:
         flash('You cannot reserve your own listing.', 'danger')
-        return redirect(url_for('listing_detail', listing_id=listing.id))
-    listing.status = 'Reserved'
-    listing.reserved_by = current_user
-    db.session.commit()
-    flash('You have reserved this listing.', 'success')
-    return redirect(url_for('listing_detail', listing_id=listing.id))
+    elif not transition_listing(listing_id, 'Available', 'Reserved', reserved_by_id=current_user.id):
+        flash('This listing is not available for reservation.', 'danger')
+    else:
+        db.session.commit()
+        flash('You have reserved this listing.', 'success')
+    return redirect(url_for('listings.listing_detail', listing_id=listing_id))
 
-@app.route('/listing/<int:listing_id>/cancel_reservation', methods=['POST'])
+@listings_bp.route('/listing/<int:listing_id>/cancel_reservation', methods=['POST'])
 @login_required
 def cancel_reservation(listing_id):
-    listing = Listing.query.get_or_404(listing_id)
+    listing = listing_state_or_404(listing_id)
     # Only the reserving user or the seller can cancel
     if listing.status != 'Reserved':
         flash('This listing is not reserved.', 'danger')
-    elif current_user != listing.reserved_by and current_user != listing.seller:
+    elif current_user.id not in (listing.reserved_by_id, listing.seller_id):
         flash('You do not have permission to cancel this reservation.', 'danger')
+    elif not transition_listing(listing_id, 'Reserved', 'Available', reserved_by_id=None):
+        flash('This listing is not reserved.', 'danger')
     else:
-        listing.status = 'Available'
-        listing.reserved_by = None
         db.session.commit()
         flash('Reservation cancelled.', 'info')
-    return redirect(url_for('listing_detail', listing_id=listing.id))
+    return redirect(url_for('listings.listing_detail', listing_id=listing_id))
 
-@app.route('/listing/<int:listing_id>/relist', methods=['POST'])
+@listings_bp.route('/listing/<int:listing_id>/relist', methods=['POST'])
 @login_required
 def relist_listing(listing_id):
-    listing = Listing.query.get_or_404(listing_id)
-    if current_user != listing.seller:
+    if listing_state_or_404(listing_id).seller_id != current_user.id:
         flash('Only the seller can relist.', 'danger')
     else:
-        listing.status = 'Available'
-        listing.reserved_by = None
+        transition_listing(listing_id, None, 'Available', reserved_by_id=None)
         db.session.commit()
         flash('Listing relisted as available.', 'success')
-    return redirect(url_for('listing_detail', listing_id=listing.id))
+    return redirect(url_for('listings.listing_detail', listing_id=listing_id))
 
-@app.route('/listing/<int:listing_id>/mark_sold', methods=['POST'])
+@listings_bp.route('/listing/<int:listing_id>/mark_sold', methods=['POST'])
 @login_required
 def mark_sold(listing_id):
-    listing = Listing.query.get_or_404(listing_id)
-    if listing.seller != current_user:
+    listing = listing_state_or_404(listing_id)
+    if listing.seller_id != current_user.id:
         flash('Only the seller can mark as sold.', 'danger')
-        return redirect(url_for('listing_detail', listing_id=listing.id))
-    if listing.status != 'Reserved':
+    elif not transition_listing(listing_id, 'Reserved', 'Sold'):
         flash('Listing must be reserved before marking as sold.', 'danger')
-        return redirect(url_for('listing_detail', listing_id=listing.id))
-    listing.status = 'Sold'
-    db.session.commit()
-    flash('Listing marked as sold.', 'success')
-    return redirect(url_for('listing_detail', listing_id=listing.id))
+    else:
+        db.session.commit()
+        flash('Listing marked as sold.', 'success')
+    return redirect(url_for('listings.listing_detail', listing_id=listing_id))
+
+# Stored files are named after a digest of their bytes and never change, so
+# browsers may keep them without revalidating. Legacy names can be overwritten.
+MEDIA_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+@functools.lru_cache(maxsize=4096)
+def media_digest(path, mtime_ns, size):
+    """SHA-256 of a media file. The stat arguments make a replaced file miss the cache."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def send_media(folder, location, filename):
+    """Serve an uploaded file with a content-hash ETag, answering If-None-Match
+    with 304 and Range with 206, or hand the bytes off to the front proxy."""
+    path = safe_join(folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    stat = os.stat(path)
+    etag = media_digest(path, stat.st_mtime_ns, stat.st_size)
+    immutable = bool(CONTENT_ADDRESSED_NAME.match(filename))
+    max_age = MEDIA_IMMUTABLE_MAX_AGE if immutable else None
+    mode = current_app.config['MEDIA_SENDFILE']
+    if mode == 'x-accel-redirect':
+        # nginx serves the internal location itself, including Range requests
+        response = current_app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = f"{current_app.config['MEDIA_ACCEL_PREFIX'].rstrip('/')}/{location}/{filename}"
+        response.set_etag(etag)
+        response.last_modified = stat.st_mtime
+        if max_age:
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+        else:
+            response.cache_control.no_cache = True
+        response = response.make_conditional(request)
+    else:
+        response = send_file(path, request.environ, etag=etag, last_modified=stat.st_mtime, max_age=max_age,
+                             use_x_sendfile=(mode == 'x-sendfile'), response_class=current_app.response_class)
+    if immutable:
+        response.cache_control.immutable = True
+    return response
 
-@app.route('/uploads/<filename>')
+@media_bp.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_media(current_app.config['UPLOAD_FOLDER'], 'uploads', filename)
 
-@app.route('/user/<username>', methods=['GET', 'POST'])
+PROFILE_REVIEWS_PER_PAGE = 10
+PROFILE_LISTINGS_PER_PAGE = 12
+
+@accounts_bp.route('/user/<username>', methods=['GET', 'POST'])
 def user_profile(username):
     user = User.query.filter_by(username=username).first_or_404()
-    listings = Listing.query.filter_by(seller=user).order_by(Listing.id.desc()).all()
     if current_user.is_authenticated and current_user.id == user.id and request.method == 'POST':
         file = request.files.get('avatar')
         if file and allowed_avatar(file.filename):
-            filename = secure_filename(file.filename)
-            avatar_filename = f"{user.id}_{filename}"
-            file.save(os.path.join(app.config['AVATAR_FOLDER'], avatar_filename))
+            avatar_filename = store_upload(file)
+            if user.avatar_filename:
+                release_stored_file(user.avatar_filename)
             user.avatar_filename = avatar_filename
             db.session.commit()
             flash('Avatar updated!', 'success')
-            return redirect(url_for('user_profile', username=user.username))
-    # Calculate average rating
-    reviews = Review.query.filter_by(reviewee=user).all()
-    avg_rating = round(sum(r.rating for r in reviews) / len(reviews), 2) if reviews else None
-    return render_template('user_profile.html', user=user, listings=listings, reviews=reviews, avg_rating=avg_rating)
+            return redirect(url_for('accounts.user_profile', username=user.username))
+    reviews = section_page(Review.query.options(joinedload(Review.reviewer)).filter_by(reviewee_id=user.id),
+                           [Review.timestamp, Review.id], True, PROFILE_REVIEWS_PER_PAGE, 'reviews')
+    listings = section_page(Listing.query.filter_by(seller_id=user.id), [Listing.id], True,
+                            PROFILE_LISTINGS_PER_PAGE, 'listings')
+    reviews_prev_url, reviews_next_url = section_page_urls(reviews, 'reviews', 'accounts.user_profile', username=user.username)
+    listings_prev_url, listings_next_url = section_page_urls(listings, 'listings', 'accounts.user_profile', username=user.username)
+    summary = db.session.get(RatingSummary, user.id)
+    return render_template('user_profile.html', user=user, summary=summary if summary and summary.count else None,
+                           reviews=reviews.items, listings=listings.items,
+                           reviews_prev_url=reviews_prev_url, reviews_next_url=reviews_next_url,
+                           listings_prev_url=listings_prev_url, listings_next_url=listings_next_url)
 
-@app.route('/avatars/<filename>')
+@media_bp.route('/avatars/<path:filename>')
 def avatar_file(filename):
-    return send_from_directory(app.config['AVATAR_FOLDER'], filename)
+    if CONTENT_ADDRESSED_NAME.match(filename):
+        return send_media(current_app.config['UPLOAD_FOLDER'], 'uploads', filename)
+    return send_media(current_app.config['AVATAR_FOLDER'], 'avatars', filename)
+
+THREADS_PER_PAGE = 20
 
-@app.route('/conversations')
+@messaging_bp.route('/conversations')
 @login_required
 def conversations():
-    # Find all users who have chatted with current_user
-    user_ids = set()
-    for msg in Message.query.filter(or_(Message.sender==current_user, Message.recipient==current_user)).all():
-        if msg.sender != current_user:
-            user_ids.add(msg.sender_id)
-        if msg.recipient != current_user:
-            user_ids.add(msg.recipient_id)
-    users = User.query.filter(User.id.in_(user_ids)).all()
-    threads = []
-    for user in users:
-        last_msg = Message.query.filter(
-            or_(and_(Message.sender==current_user, Message.recipient==user),
-                 and_(Message.sender==user, Message.recipient==current_user))
-        ).order_by(Message.timestamp.desc()).first()
-        unread = Message.query.filter_by(sender=user, recipient=current_user, read=False).count()
-        threads.append({'user': user, 'last_msg': last_msg, 'unread': unread})
-    threads.sort(key=lambda t: t['last_msg'].timestamp if t['last_msg'] else 0, reverse=True)
-    return render_template('conversations.html', threads=threads)
-
-@app.route('/messages/<username>', methods=['GET', 'POST'])
+    query = Thread.query.options(joinedload(Thread.partner), joinedload(Thread.last_message)) \
+        .filter_by(owner_id=current_user.id)
+    page = keyset_paginate(query, [Thread.last_timestamp, Thread.id], True, THREADS_PER_PAGE,
+                           after=request.args.get('after'), before=request.args.get('before'))
+    next_url = url_for('messaging.conversations', after=page.next_cursor) if page.next_cursor else None
+    prev_url = url_for('messaging.conversations', before=page.prev_cursor) if page.prev_cursor else None
+    return render_template('conversations.html', threads=page.items, next_url=next_url, prev_url=prev_url)
+
+CONVERSATION_MESSAGES_PER_PAGE = 50
+
+@messaging_bp.route('/messages/<username>', methods=['GET', 'POST'])
 @login_required
 def conversation(username):
     other = User.query.filter_by(username=username).first_or_404()
     if request.method == 'POST':
         content = request.form['content']
         if content.strip():
-            msg = Message(sender=current_user, recipient=other, content=content)
-            db.session.add(msg)
+            record_message(Message(sender=current_user, recipient=other, content=content))
             db.session.commit()
             flash('Message sent!', 'success')
-        return redirect(url_for('conversation', username=other.username))
-    # Mark all messages from other as read
-    Message.query.filter_by(sender=other, recipient=current_user, read=False).update({'read': True})
-    db.session.commit()
-    messages = Message.query.filter(
-        ((Message.sender == current_user) & (Message.recipient == other)) |
-        ((Message.sender == other) & (Message.recipient == current_user))
-    ).order_by(Message.timestamp.asc()).all()
-    return render_template('conversation.html', other=other, messages=messages)
+        return redirect(url_for('messaging.conversation', username=other.username))
+    after, before = request.args.get('after'), request.args.get('before')
+    thread = Thread.query.filter_by(owner_id=current_user.id, partner_id=other.id).first()
+    if thread is not None and thread.unread_count and not (after or before):
+        # Seeing the latest page reads the thread up to its last message, in
+        # one short write transaction instead of holding the lock for the page
+        with sqlite_write_transaction():
+            mark_conversation_read(other, up_to_id=thread.last_message_id)
+    # Each direction is a range scan on ix_message_pair, so a page costs the
+    # same however long the conversation is
+    page = keyset_paginate([Message.query.filter_by(sender_id=current_user.id, recipient_id=other.id),
+                            Message.query.filter_by(sender_id=other.id, recipient_id=current_user.id)],
+                           [Message.timestamp, Message.id], True, CONVERSATION_MESSAGES_PER_PAGE,
+                           after=after, before=before)
+    older_url = url_for('messaging.conversation', username=other.username, after=page.next_cursor) if page.next_cursor else None
+    newer_url = url_for('messaging.conversation', username=other.username, before=page.prev_cursor) if page.prev_cursor else None
+    return render_template('conversation.html', other=other, messages=page.items[::-1],
+                           older_url=older_url, newer_url=newer_url)
+
+def mark_conversation_read(other, up_to_id=None):
+    """Mark the messages other sent the current user as read, only up to
+    up_to_id if given, and return how many changed; the caller commits."""
+    query = Message.query.filter_by(sender=other, recipient=current_user, read=False)
+    if up_to_id is not None:
+        query = query.filter(Message.id <= up_to_id)
+    marked = query.update({'read': True})
+    if marked:
+        Thread.query.filter_by(owner_id=current_user.id, partner_id=other.id) \
+            .update({'unread_count': Thread.unread_count - marked})
+        User.query.filter_by(id=current_user.id).update({'unread_count': User.unread_count - marked})
+        user_cache.invalidate(current_user.id)
+        queue_unread_event(current_user.id)
+    return marked
+
+@messaging_bp.route('/messages/<username>/read', methods=['POST'])
+@login_required
+def conversation_read(username):
+    other = User.query.filter_by(username=username).first_or_404()
+    try:
+        up_to_id = int(request.form['up_to'])
+    except (KeyError, ValueError):
+        abort(400)
+    if mark_conversation_read(other, up_to_id):
+        db.session.commit()
+    return '', 204
 
-@app.route('/message/send/<int:recipient_id>', methods=['POST'])
+@messaging_bp.route('/message/send/<int:recipient_id>', methods=['POST'])
 @login_required
 def send_message(recipient_id):
     recipient = User.query.get_or_404(recipient_id)
     content = request.form['content']
     if not content.strip():
         flash('Message cannot be empty.', 'danger')
-        return redirect(request.referrer or url_for('home'))
-    msg = Message(sender=current_user, recipient=recipient, content=content)
-    db.session.add(msg)
+        return redirect(request.referrer or url_for('main.home'))
+    record_message(Message(sender=current_user, recipient=recipient, content=content))
     db.session.commit()
     flash('Message sent!', 'success')
-    return redirect(url_for('conversation', username=recipient.username))
+    return redirect(url_for('messaging.conversation', username=recipient.username))
 
 # Removed /inbox and /outbox routes as Conversations replaces their functionality
 
-@app.route('/favorite/<int:listing_id>', methods=['POST'])
+class MemoryEventBackend:
+    """Events for the streams connected to this worker only. The last few
+    events per user are kept so a reconnecting stream can catch up."""
+
+    HISTORY = 50
+    MAX_USERS = 10000
+
+    def __init__(self, deliver):
+        self._deliver = deliver
+        self._ids = itertools.count(int(time.time() * 1000))
+        self._history = OrderedDict()
+        self._lock = threading.Lock()
+
+    def publish(self, user_id, event, data):
+        with self._lock:
+            item = (next(self._ids), event, data)
+            history = self._history.pop(user_id, None) or deque(maxlen=self.HISTORY)
+            history.append(item)
+            self._history[user_id] = history
+            while len(self._history) > self.MAX_USERS:
+                self._history.popitem(last=False)
+        self._deliver(user_id, item)
+
+    def since(self, user_id, last_id):
+        with self._lock:
+            return [item for item in self._history.get(user_id, ()) if item[0] > last_id]
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+class SQLiteEventBackend(SQLiteSideStore):
+    """Events shared by every worker through one SQLite file. Publishers
+    append rows, and one thread per worker polls for new rows and hands them
+    to its own streams, so the cost does not grow with connected clients.
+    Rows are kept for RETAIN_SECONDS to let reconnecting streams catch up."""
+
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS event (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, '
+              'event TEXT NOT NULL, data TEXT NOT NULL, created REAL NOT NULL)',
+              'CREATE INDEX IF NOT EXISTS ix_event_user ON event (user_id, id)')
+    RETAIN_SECONDS = 300
+
+    def __init__(self, path, interval, deliver):
+        super().__init__(path)
+        self.interval = interval
+        self._deliver = deliver
+        self._poller, self._stopped = None, threading.Event()
+        self._lock = threading.Lock()
+
+    def publish(self, user_id, event, data):
+        conn = self._connection()
+        conn.execute('INSERT INTO event (user_id, event, data, created) VALUES (?, ?, ?, ?)',
+                     (user_id, event, json.dumps(data), time.time()))
+        if self._trim_due():
+            conn.execute('DELETE FROM event WHERE created < ?', (time.time() - self.RETAIN_SECONDS,))
+
+    def since(self, user_id, last_id):
+        rows = self._connection().execute('SELECT id, event, data FROM event WHERE user_id = ? AND id > ? ORDER BY id',
+                                          (user_id, last_id)).fetchall()
+        return [(event_id, event, json.loads(data)) for event_id, event, data in rows]
+
+    def start(self):
+        with self._lock:
+            if self._poller is None or not self._poller.is_alive() or self._poller.pid != os.getpid():
+                self._poller = threading.Thread(target=self._poll, name='event-poller', daemon=True)
+                self._poller.pid = os.getpid()
+                self._poller.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _poll(self):
+        last_id = None
+        while not self._stopped.wait(self.interval):
+            try:
+                conn = self._connection()
+                if last_id is None:
+                    last_id = conn.execute('SELECT coalesce(max(id), 0) FROM event').fetchone()[0]
+                    continue
+                rows = conn.execute('SELECT id, user_id, event, data FROM event WHERE id > ? ORDER BY id',
+                                    (last_id,)).fetchall()
+            except sqlite3.Error:
+                continue
+            for event_id, user_id, event, data in rows:
+                self._deliver(user_id, (event_id, event, json.loads(data)))
+                last_id = event_id
+
+class EventBroker:
+    """Pushes per-user events, new messages and unread counts, to the /events
+    streams through the backend selected by EVENTS_BACKEND. Events are a
+    convenience on top of the pages, so a failing backend only drops them."""
+
+    def __init__(self):
+        self._backend = ConfiguredStore(
+            ('EVENTS_BACKEND', 'EVENTS_PATH', 'EVENTS_POLL_INTERVAL'),
+            memory=lambda path, interval: MemoryEventBackend(self._deliver),
+            sqlite=lambda path, interval: SQLiteEventBackend(path, interval, self._deliver))
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self):
+        return self._backend.get()
+
+    def publish(self, user_id, event, data):
+        try:
+            if self.backend is not None:
+                self.backend.publish(user_id, event, data)
+        except sqlite3.Error:
+            current_app.logger.warning('Dropped %s event for user %s', event, user_id, exc_info=True)
+
+    def subscribe(self, user_id, last_id=None, limit=0):
+        """A queue of the user's events, or None if this worker already
+        holds ``limit`` streams."""
+        stream = queue.SimpleQueue()
+        with self._lock:
+            if limit and sum(len(streams) for streams in self._streams.values()) >= limit:
+                return None
+            self._streams.setdefault(user_id, set()).add(stream)
+        self.backend.start()
+        if last_id is not None:
+            try:
+                for item in self.backend.since(user_id, last_id):
+                    stream.put(item)
+            except sqlite3.Error:
+                pass
+        return stream
+
+    def unsubscribe(self, user_id, stream):
+        with self._lock:
+            streams = self._streams.get(user_id, set())
+            streams.discard(stream)
+            if not streams:
+                self._streams.pop(user_id, None)
+
+    def _deliver(self, user_id, item):
+        with self._lock:
+            streams = list(self._streams.get(user_id, ()))
+        for stream in streams:
+            stream.put(item)
+
+    def stats(self):
+        with self._lock:
+            return {'backend': current_app.config['EVENTS_BACKEND'], 'users': len(self._streams),
+                    'streams': sum(len(streams) for streams in self._streams.values())}
+
+event_broker = EventBroker()
+
+def queue_event(user_id, event, data):
+    """Publish an event once the current transaction commits."""
+    db.session.info.setdefault('pending_events', []).append((user_id, event, data))
+
+@event.listens_for(Session, 'after_commit')
+def publish_pending_events(session):
+    for user_id, name, data in session.info.pop('pending_events', ()):
+        event_broker.publish(user_id, name, data)
+
+@event.listens_for(Session, 'after_rollback')
+def drop_pending_events(session):
+    session.info.pop('pending_events', None)
+
+def sse(event, data, event_id=None):
+    lines = [f'id: {event_id}'] if event_id is not None else []
+    lines += [f'event: {event}', f'data: {json.dumps(data)}']
+    return '\n'.join(lines) + '\n\n'
+
+@messaging_bp.route('/events')
+@login_required
+def events():
+    if event_broker.backend is None:
+        # 204 tells EventSource not to reconnect
+        return '', 204
+    user_id, unread_count = current_user.id, current_user.unread_count
+    last_id = request.headers.get('Last-Event-ID', '')
+    stream = event_broker.subscribe(user_id, int(last_id) if last_id.isdigit() else None,
+                                    current_app.config['EVENTS_MAX_STREAMS'])
+    if stream is None:
+        # Every stream holds a worker thread, so past the limit pages go without
+        return '', 204
+    # The page names its stream so it can end it from events_close() on unload
+    token = request.args.get('stream', '')[:64]
+    keepalive, max_duration = current_app.config['EVENTS_KEEPALIVE'], current_app.config['EVENTS_MAX_DURATION']
+
+    # Runs after the request context is gone, so it holds no database connection
+    def generate():
+        try:
+            yield 'retry: 3000\n\n' + sse('unread', {'unread_count': unread_count})
+            deadline = time.monotonic() + max_duration if max_duration else None
+            while True:
+                timeout = keepalive if deadline is None else min(keepalive, deadline - time.monotonic())
+                if timeout <= 0:
+                    return
+                try:
+                    event_id, name, data = stream.get(timeout=timeout)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if name == 'close':
+                    if token and data.get('stream') == token:
+                        return
+                    continue
+                yield sse(name, data, event_id)
+        finally:
+            event_broker.unsubscribe(user_id, stream)
+    return current_app.response_class(generate(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@messaging_bp.route('/events/close', methods=['POST'])
+@login_required
+def events_close():
+    # The server only notices a closed stream when a write fails, so a page
+    # being left ends its own stream through whichever worker holds it
+    token = request.form.get('stream', '')[:64]
+    if token:
+        event_broker.publish(current_user.id, 'close', {'stream': token})
+    return '', 204
+
+def reconcile_unread(connection):
+    """Recount the per-user and per-thread unread counters from the message table."""
+    unread = db.select(func.count(Message.id)).where(Message.read == False)
+    users = connection.execute(db.update(User).values(
+        unread_count=unread.where(Message.recipient_id == User.id).scalar_subquery())).rowcount
+    threads = connection.execute(db.update(Thread).values(
+        unread_count=unread.where(Message.recipient_id == Thread.owner_id,
+                                  Message.sender_id == Thread.partner_id).scalar_subquery())).rowcount
+    return users, threads
+
+@messaging_bp.cli.command('reconcile-unread-counts')
+def reconcile_unread_counts():
+    """Recount the per-user and per-thread unread counters from the message table."""
+    with db.engine.begin() as connection:
+        users, threads = reconcile_unread(connection)
+    print(f'Reconciled unread counts for {users} users and {threads} threads.')
+
+def reconcile_stored_files(connection):
+    """Recount the references to each stored upload from listing images and avatars."""
+    names = connection.execute(db.select(ListingImage.filename).union_all(
+        db.select(User.avatar_filename).where(User.avatar_filename.isnot(None)))).scalars()
+    counts = Counter(name for name in names if CONTENT_ADDRESSED_NAME.match(name))
+    connection.execute(db.delete(StoredFile))
+    rows = [{'name': name, 'size': os.path.getsize(os.path.join(current_app.config['UPLOAD_FOLDER'], name)), 'refcount': count}
+            for name, count in counts.items() if os.path.exists(os.path.join(current_app.config['UPLOAD_FOLDER'], name))]
+    if rows:
+        connection.execute(db.insert(StoredFile), rows)
+    return len(rows)
+
+@media_bp.cli.command('reconcile-stored-files')
+def reconcile_stored_files_command():
+    """Recount the references to each stored upload from listing images and avatars."""
+    with db.engine.begin() as connection:
+        files = reconcile_stored_files(connection)
+    print(f'Reconciled reference counts for {files} stored files.')
+
+def populate_threads(connection):
+    """Regenerate the conversation inbox summaries from the message table."""
+    summaries = {}
+    result = connection.execution_options(yield_per=1000).execute(
+        db.select(Message.id, Message.sender_id, Message.recipient_id, Message.timestamp, Message.read)
+        .order_by(Message.timestamp, Message.id))
+    for msg in result:
+        for owner_id, partner_id in ((msg.sender_id, msg.recipient_id), (msg.recipient_id, msg.sender_id)):
+            summary = summaries.setdefault((owner_id, partner_id), {'unread_count': 0})
+            summary['last_message_id'] = msg.id
+            summary['last_timestamp'] = msg.timestamp
+        if not msg.read:
+            summaries[(msg.recipient_id, msg.sender_id)]['unread_count'] += 1
+    connection.execute(db.delete(Thread))
+    if summaries:
+        connection.execute(db.insert(Thread), [dict(summary, owner_id=owner_id, partner_id=partner_id)
+                                               for (owner_id, partner_id), summary in summaries.items()])
+    return len(summaries)
+
+@messaging_bp.cli.command('rebuild-threads')
+def rebuild_threads():
+    """Regenerate the conversation inbox summaries from the message table."""
+    with db.engine.begin() as connection:
+        count = populate_threads(connection)
+    print(f'Rebuilt {count} conversation threads.')
+
+def populate_rating_summaries(connection):
+    """Regenerate every user's rating summary from the review table."""
+    rows = connection.execute(db.select(
+        Review.reviewee_id.label('user_id'), func.count(Review.id).label('count'), func.sum(Review.rating).label('total'),
+        *[func.sum(db.case((Review.rating == stars, 1), else_=0)).label(f'stars_{stars}') for stars in RATING_STARS])
+        .group_by(Review.reviewee_id)).mappings().all()
+    connection.execute(db.delete(RatingSummary))
+    if rows:
+        connection.execute(db.insert(RatingSummary), [dict(row) for row in rows])
+    return len(rows)
+
+@reviews_bp.cli.command('rebuild-rating-summaries')
+def rebuild_rating_summaries():
+    """Regenerate every user's rating summary from the review table."""
+    with db.engine.begin() as connection:
+        count = populate_rating_summaries(connection)
+    print(f'Rebuilt rating summaries for {count} users.')
+
+@listings_bp.route('/favorite/<int:listing_id>', methods=['POST'])
 @login_required
 def favorite_listing(listing_id):
     listing = Listing.query.get_or_404(listing_id)
@@ -481,9 +2300,9 @@ def favorite_listing(listing_id):
         current_user.favorites.append(listing)
         db.session.commit()
         flash('Added to favorites.', 'success')
-    return redirect(request.referrer or url_for('listings'))
+    return redirect(request.referrer or url_for('listings.listings'))
 
-@app.route('/unfavorite/<int:listing_id>', methods=['POST'])
+@listings_bp.route('/unfavorite/<int:listing_id>', methods=['POST'])
 @login_required
 def unfavorite_listing(listing_id):
     listing = Listing.query.get_or_404(listing_id)
@@ -491,49 +2310,51 @@ def unfavorite_listing(listing_id):
         current_user.favorites.remove(listing)
         db.session.commit()
         flash('Removed from favorites.', 'info')
-    return redirect(request.referrer or url_for('listings'))
+    return redirect(request.referrer or url_for('listings.listings'))
 
-@app.route('/my_favorites')
+@listings_bp.route('/my_favorites')
 @login_required
 def my_favorites():
-    listings = current_user.favorites.order_by(Listing.id.desc()).all()
+    listings = current_user.favorites.options(*listing_card_options()).order_by(Listing.id.desc()).all()
     return render_template('my_favorites.html', listings=listings)
 
-@app.route('/my_purchases')
+@listings_bp.route('/my_purchases')
 @login_required
 def my_purchases():
-    listings = Listing.query.filter_by(reserved_by=current_user, status='Sold').order_by(Listing.id.desc()).all()
+    listings = Listing.query.options(*listing_card_options()).filter_by(reserved_by=current_user, status='Sold').order_by(Listing.id.desc()).all()
     return render_template('my_purchases.html', listings=listings)
 
-@app.route('/my_sales')
+@listings_bp.route('/my_sales')
 @login_required
 def my_sales():
-    listings = Listing.query.filter_by(seller=current_user, status='Sold').order_by(Listing.id.desc()).all()
+    listings = Listing.query.options(*listing_card_options(Listing.reserved_by)).filter_by(seller=current_user, status='Sold').order_by(Listing.id.desc()).all()
     return render_template('my_sales.html', listings=listings)
 
-@app.route('/review/<int:listing_id>/<int:reviewee_id>', methods=['POST'])
+@reviews_bp.route('/review/<int:listing_id>/<int:reviewee_id>', methods=['POST'])
 @login_required
 def submit_review(listing_id, reviewee_id):
     listing = Listing.query.get_or_404(listing_id)
     reviewee = User.query.get_or_404(reviewee_id)
     rating = int(request.form['rating'])
     comment = request.form['comment']
+    if rating not in RATING_STARS:
+        flash('Ratings go from 1 to 5 stars.', 'danger')
+        return redirect(url_for('listings.listing_detail', listing_id=listing.id))
     # Only allow review if user was buyer or seller and transaction is complete
     if listing.status != 'Sold' or (current_user != listing.seller and current_user != listing.reserved_by):
         flash('You cannot review this transaction.', 'danger')
-        return redirect(url_for('listing_detail', listing_id=listing.id))
+        return redirect(url_for('listings.listing_detail', listing_id=listing.id))
     # Prevent duplicate reviews
     existing = Review.query.filter_by(reviewer=current_user, reviewee=reviewee, listing=listing).first()
     if existing:
         flash('You have already reviewed this user for this transaction.', 'info')
-        return redirect(url_for('listing_detail', listing_id=listing.id))
-    review = Review(reviewer=current_user, reviewee=reviewee, listing=listing, rating=rating, comment=comment)
-    db.session.add(review)
+        return redirect(url_for('listings.listing_detail', listing_id=listing.id))
+    record_review(Review(reviewer=current_user, reviewee=reviewee, listing=listing, rating=rating, comment=comment))
     db.session.commit()
     flash('Review submitted!', 'success')
-    return redirect(url_for('listing_detail', listing_id=listing.id))
+    return redirect(url_for('listings.listing_detail', listing_id=listing.id))
 
-@app.route('/report/listing/<int:listing_id>', methods=['POST'])
+@reviews_bp.route('/report/listing/<int:listing_id>', methods=['POST'])
 @login_required
 def report_listing(listing_id):
     listing = Listing.query.get_or_404(listing_id)
@@ -542,20 +2363,270 @@ def report_listing(listing_id):
     db.session.add(report)
     db.session.commit()
     flash('Report submitted. Thank you for helping keep the platform safe.', 'success')
-    return redirect(url_for('listing_detail', listing_id=listing.id))
+    return redirect(url_for('listings.listing_detail', listing_id=listing.id))
+
+ADMIN_PAGE_SIZE = 25
+ADMIN_STATS_DAYS = 14
+
+admin_stats_cache = {'stats': None, 'computed': 0.0}
 
-@app.route('/admin')
+def admin_statistics():
+    """Site-wide aggregates for the dashboard, computed with grouped SQL and
+    reused by this worker for ADMIN_STATS_TTL seconds."""
+    now = time.monotonic()
+    if admin_stats_cache['stats'] is not None and now - admin_stats_cache['computed'] < current_app.config['ADMIN_STATS_TTL']:
+        return admin_stats_cache['stats']
+    since = datetime.utcnow() - timedelta(days=ADMIN_STATS_DAYS)
+    def grouped(key, *criteria):
+        return db.session.execute(db.select(key, func.count()).where(*criteria).group_by(key).order_by(key)).all()
+    stats = {
+        'generated_at': datetime.utcnow(),
+        'users': db.session.scalar(db.select(func.count(User.id))),
+        'open_reports': db.session.scalar(db.select(func.count(Report.id)).where(Report.resolved == False)),
+        'listings_by_status': grouped(Listing.status),
+        'listings_by_category': grouped(Listing.category),
+        'messages_per_day': grouped(func.date(Message.timestamp), Message.timestamp >= since),
+        'new_users_per_day': grouped(func.date(User.created_at), User.created_at >= since),
+    }
+    stats['listings'] = sum(count for _, count in stats['listings_by_status'])
+    admin_stats_cache.update(stats=stats, computed=now)
+    return stats
+
+@admin_bp.route('/admin')
 @login_required
 def admin_dashboard():
-    if not current_user.is_admin:
+    # Check the flag in the database, the cached user may lag a revocation made by another worker
+    if not db.session.execute(db.select(User.is_admin).where(User.id == current_user.id)).scalar():
         flash('Access denied.', 'danger')
-        return redirect(url_for('home'))
-    reports = Report.query.order_by(Report.timestamp.desc()).all()
-    users = User.query.all()
-    listings = Listing.query.all()
-    return render_template('admin_dashboard.html', reports=reports, users=users, listings=listings)
+        return redirect(url_for('main.home'))
+    report_status = request.args.get('report_status', 'open')
+    report_query = Report.query.options(joinedload(Report.reporter), joinedload(Report.listing))
+    if report_status in ('open', 'resolved'):
+        report_query = report_query.filter(Report.resolved == (report_status == 'resolved'))
+    reports = section_page(report_query, [Report.timestamp, Report.id], True, ADMIN_PAGE_SIZE, 'reports')
+
+    user_search = request.args.get('user_search', '').strip()
+    user_query = User.query
+    if user_search:
+        user_query = user_query.filter(User.username.startswith(user_search, autoescape=True))
+    if request.args.get('user_role') == 'admin':
+        user_query = user_query.filter(User.is_admin == True)
+    users = section_page(user_query, [User.id], True, ADMIN_PAGE_SIZE, 'users')
+
+    listing_status = request.args.get('listing_status', '')
+    listing_category = request.args.get('listing_category', '')
+    listing_query = Listing.query.options(joinedload(Listing.seller))
+    if listing_status:
+        listing_query = listing_query.filter_by(status=listing_status)
+    if listing_category:
+        listing_query = listing_query.filter_by(category=listing_category)
+    listings = section_page(listing_query, [Listing.id], True, ADMIN_PAGE_SIZE, 'listings')
+
+    return render_template('admin_dashboard.html', stats=admin_statistics(), categories=CATEGORIES,
+                           reports=reports.items, report_pages=section_page_urls(reports, 'reports', 'admin.admin_dashboard'),
+                           users=users.items, user_pages=section_page_urls(users, 'users', 'admin.admin_dashboard'),
+                           listings=listings.items, listing_pages=section_page_urls(listings, 'listings', 'admin.admin_dashboard'),
+                           report_status=report_status, user_search=user_search,
+                           user_role=request.args.get('user_role', ''), listing_status=listing_status,
+                           listing_category=listing_category, user_cache_stats=user_cache.stats(),
+                           fragment_cache_stats=fragment_cache.stats(), logins_throttled=login_throttle.throttled,
+                           event_stats=event_broker.stats())
+
+# Versioned schema migrations for databases created by older releases. A new
+# database is built with create_all() and stamped with every version; an
+# existing one runs, in order, each migration above its recorded version.
+schema_version = db.Table('schema_version',
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('applied_at', db.DateTime, nullable=False, default=datetime.utcnow)
+)
+
+def add_missing_columns(connection, table, *names):
+    existing = {c['name'] for c in inspect(connection).get_columns(table.name)}
+    quoted = connection.dialect.identifier_preparer.format_table(table)
+    for name in names:
+        if name not in existing:
+            column = CreateColumn(table.c[name]).compile(dialect=connection.dialect)
+            connection.execute(text(f'ALTER TABLE {quoted} ADD COLUMN {column}'))
+
+def migrate_unread_counters_and_threads(connection):
+    add_missing_columns(connection, User.__table__, 'unread_count', 'version')
+    Thread.__table__.create(connection, checkfirst=True)
+    populate_threads(connection)
+    reconcile_unread(connection)
+
+def migrate_search_index(connection):
+    listing_search_term.create(connection, checkfirst=True)
+    populate_search_index(connection)
+
+def migrate_hot_column_indexes(connection):
+    inspector = db.inspect(connection)
+    for table in db.metadata.sorted_tables:
+        if not table.indexes:
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            # Indexes on columns added by later migrations are created there
+            if {column.name for column in index.columns} <= existing:
+                index.create(connection, checkfirst=True)
+
+def migrate_image_derivatives(connection):
+    add_missing_columns(connection, ListingImage.__table__, 'derivatives')
+
+def migrate_listing_version(connection):
+    add_missing_columns(connection, Listing.__table__, 'version')
+
+def migrate_content_addressed_uploads(connection):
+    """Move listing images and avatars into the content-addressed store,
+    merging duplicates. Old files are removed once every row points at the store."""
+    StoredFile.__table__.create(connection, checkfirst=True)
+    log = logging.getLogger(__name__)
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    moved, obsolete = {}, []
+    def adopt(folder, filename):
+        if CONTENT_ADDRESSED_NAME.match(filename):
+            return filename
+        if (folder, filename) not in moved:
+            try:
+                with open(os.path.join(folder, filename), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                log.warning('Upload %s is missing, leaving it in place', filename)
+                moved[(folder, filename)] = filename
+                return filename
+            name = stored_name(hashlib.sha256(data).hexdigest(), filename.rsplit('.', 1)[-1])
+            path = os.path.join(upload_folder, name)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(data)
+                for old, new in zip(image_file_names(filename)[1:], image_file_names(name)[1:]):
+                    if os.path.exists(os.path.join(folder, old)):
+                        os.replace(os.path.join(folder, old), os.path.join(upload_folder, new))
+            obsolete.append((folder, filename))
+            moved[(folder, filename)] = name
+        return moved[(folder, filename)]
+    for image_id, filename in connection.execute(db.select(ListingImage.id, ListingImage.filename)).all():
+        connection.execute(db.update(ListingImage).where(ListingImage.id == image_id)
+                           .values(filename=adopt(upload_folder, filename)))
+    for user_id, filename in connection.execute(db.select(User.id, User.avatar_filename)
+                                                .where(User.avatar_filename.isnot(None))).all():
+        connection.execute(db.update(User).where(User.id == user_id)
+                           .values(avatar_filename=adopt(current_app.config['AVATAR_FOLDER'], filename)))
+    reconcile_stored_files(connection)
+    for folder, filename in obsolete:
+        for name in image_file_names(filename):
+            try:
+                os.remove(os.path.join(folder, name))
+            except OSError:
+                pass
+
+def migrate_rating_summaries(connection):
+    RatingSummary.__table__.create(connection, checkfirst=True)
+    populate_rating_summaries(connection)
+    for index in Listing.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+def migrate_admin_dashboard(connection):
+    add_missing_columns(connection, User.__table__, 'created_at')
+    connection.execute(db.update(Report).where(Report.resolved.is_(None)).values(resolved=False))
+    for table in (User.__table__, Message.__table__, Report.__table__):
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+def migrate_listing_autoincrement(connection):
+    """Rebuild the listing table with AUTOINCREMENT, which SQLite can only
+    set when a table is created, so deleted listings' ids are not reused."""
+    if connection.dialect.name != 'sqlite':
+        return
+    table = Listing.__table__
+    ddl = str(CreateTable(table).compile(dialect=connection.dialect))
+    connection.exec_driver_sql(ddl.replace('CREATE TABLE listing ', 'CREATE TABLE listing_rebuild ', 1))
+    columns = ', '.join(column.name for column in table.columns)
+    connection.exec_driver_sql(f'INSERT INTO listing_rebuild ({columns}) SELECT {columns} FROM listing')
+    connection.exec_driver_sql('DROP TABLE listing')
+    connection.exec_driver_sql('ALTER TABLE listing_rebuild RENAME TO listing')
+    for index in table.indexes:
+        index.create(connection)
+
+MIGRATIONS = [
+    (1, 'Add unread counters and conversation threads', migrate_unread_counters_and_threads),
+    (2, 'Add the listing search index', migrate_search_index),
+    (3, 'Add indexes for hot query columns', migrate_hot_column_indexes),
+    (4, 'Track resized image derivatives', migrate_image_derivatives),
+    (5, 'Move uploads into the content-addressed store', migrate_content_addressed_uploads),
+    (6, 'Version listings for the card fragment cache', migrate_listing_version),
+    (7, 'Add seller rating summaries', migrate_rating_summaries),
+    (8, 'Index and date records for the admin dashboard', migrate_admin_dashboard),
+    (9, 'Never reuse listing ids', migrate_listing_autoincrement),
+]
+
+def upgrade_database(engine=None):
+    """Create or migrate the schema; returns the migrations that were applied."""
+    engine = engine or db.engine
+    with engine.begin() as connection:
+        if not inspect(connection).has_table(User.__tablename__):
+            db.metadata.create_all(connection)
+            connection.execute(schema_version.insert(), [{'version': v} for v, _, _ in MIGRATIONS])
+            return []
+        schema_version.create(connection, checkfirst=True)
+        current = connection.execute(db.select(func.max(schema_version.c.version))).scalar() or 0
+    applied = []
+    for version, description, migrate in MIGRATIONS:
+        if version > current:
+            with engine.begin() as connection:
+                migrate(connection)
+                connection.execute(schema_version.insert().values(version=version))
+            applied.append((version, description))
+    with engine.begin() as connection:
+        db.metadata.create_all(connection)
+    return applied
+
+@main_bp.cli.command('upgrade-db')
+def upgrade_db():
+    """Create the database or apply pending schema migrations."""
+    applied = upgrade_database()
+    for version, description in applied:
+        print(f'Applied migration {version}: {description}')
+    print('Database is up to date.')
+
+def create_app(config=None):
+    """Build an app with settings from the environment (and a .env file),
+    overridden by ``config``. Caches, stores and background threads start
+    on first use, so building an app, e.g. in a preloading gunicorn master,
+    opens no files or connections."""
+    load_dotenv()
+    app = Flask(__name__)
+    configure_from_environment(app)
+    app.config.update(config or {})
+    validate_config(app.config)
+    db.init_app(app)
+    login_manager.init_app(app)
+    if app.config['TRUSTED_PROXIES']:
+        # request.remote_addr, which the login throttle keys on, becomes the client's address
+        hops = app.config['TRUSTED_PROXIES']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, 'connect', sqlite_connect_listener(app.config))
+    app.before_request(start_request_profile)
+    app.before_request(start_request_timer)
+    app.before_request(load_unread_count)
+    app.after_request(add_server_timing)
+    app.after_request(record_request_metrics)
+    for blueprint in (main_bp, accounts_bp, listings_bp, messaging_bp, reviews_bp, admin_bp, media_bp):
+        app.register_blueprint(blueprint)
+    return app
+
+def __getattr__(name):
+    # `from app import app` and `gunicorn app:app` get an app built on first access
+    global app
+    if name == 'app':
+        app = create_app()
+        return app
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 if __name__ == '__main__':
+    app = create_app()
     with app.app_context():
-        db.create_all()
+        upgrade_database()
     app.run(debug=True) 
\ No newline at end of file
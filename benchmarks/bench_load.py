@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""
+Load-test the app with several worker processes sharing one SQLite file.
+Run from the project root: python benchmarks/bench_load.py [--workers 1,2,4] [--clients 16]
+    [--duration 20] [--mix browse=40,search=20,message=20,reserve=10,create=10] [--output FILE]
+
+For each worker count the database is reset to the same seed and the app is
+served the way DEPLOYMENT.md runs Gunicorn: one listening socket shared by N
+forked worker processes, each running at most --threads requests at once
+like a gthread worker (here on Werkzeug's server, so Gunicorn is not
+needed). Client processes then run
+--clients logged-in users for --duration seconds, each picking operations
+from the mix:
+
+  browse    GET /listings, then one listing
+  search    GET /listings?keyword=...
+  message   POST /message/send/<id> to another load user
+  reserve   POST /listing/<id>/reserve on a small shared pool of listings
+  create    POST /listing/new with a JPEG upload
+
+It reports throughput and latency percentiles per operation. Requests that
+failed because SQLite stayed locked past SQLITE_BUSY_TIMEOUT are counted
+separately. Once the clients stop, the database is checked for lost updates:
+- acknowledged messages and listings that are missing;
+- listings reserved by two users who were both told they had won;
+- unread counters, thread summaries and stored-file reference counts that
+  disagree with the rows they count.
+
+Any lost update exits 1.
+"""
+
+import argparse
+import collections
+import http.client
+import io
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+parser = argparse.ArgumentParser(description='Load-test several worker processes on one SQLite file.')
+parser.add_argument('--workers', default='1,2,4', help='comma-separated worker process counts (default 1,2,4)')
+parser.add_argument('--threads', type=int, default=4, help='request threads per worker (default 4)')
+parser.add_argument('--clients', type=int, default=16, help='concurrent logged-in users (default 16)')
+parser.add_argument('--client-processes', type=int, default=4, help='processes the users are spread over (default 4)')
+parser.add_argument('--duration', type=float, default=20, help='seconds per worker count (default 20)')
+parser.add_argument('--mix', default='browse=40,search=20,message=20,reserve=10,create=10',
+                    help='operation weights')
+parser.add_argument('--listings', type=int, default=5000, help='seeded listings (default 5000)')
+parser.add_argument('--output', help='write the results as JSON')
+ARGS = parser.parse_args()
+
+TMP = tempfile.mkdtemp()
+DB_PATH = os.path.join(TMP, 'load.db')
+SEED_PATH = os.path.join(TMP, 'seed.db')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import logging
+
+from PIL import Image as PILImage
+from sqlalchemy.exc import OperationalError
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import make_server
+
+from app import (create_app, db, upgrade_database, User, Listing, ListingImage, Message, StoredFile, CATEGORIES,
+                 acquire_stored_file, populate_search_index)
+
+app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{DB_PATH}', 'LOGIN_THROTTLE': 'none',
+                  'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000', 'METRICS_BACKEND': 'none', 'EVENTS_BACKEND': 'none',
+                  'UPLOAD_FOLDER': os.path.join(TMP, 'uploads')})
+os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+OPERATIONS = ['browse', 'search', 'message', 'reserve', 'create']
+WORDS = ['lamp', 'desk', 'chair', 'bike', 'textbook', 'calculator', 'kettle', 'monitor', 'guitar', 'jacket']
+PASSWORD = 'pass'
+RESERVE_POOL = 300  # listings 1..RESERVE_POOL, all buyers compete for them
+LOCK_MARKER = 'database-locked'
+
+
+def jpeg(seed):
+    buffer = io.BytesIO()
+    PILImage.new('RGB', (640, 480), (seed % 256, 80, 160)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def seed():
+    """Seller 'seller' owns every listing; load users are load1..loadN."""
+    rng = random.Random(0)
+    with app.app_context():
+        upgrade_database()
+        password_hash = generate_password_hash(PASSWORD, app.config['PASSWORD_HASH_METHOD'])
+        db.session.execute(db.insert(User), [{'username': name, 'password_hash': password_hash} for name in
+                                             ['seller'] + [f'load{i}' for i in range(1, ARGS.clients + 1)]])
+        db.session.execute(db.insert(Listing), [
+            {'title': f'{rng.choice(WORDS)} {i}', 'description': ' '.join(rng.choices(WORDS, k=20)),
+             'price': rng.randint(1, 300), 'category': rng.choice(CATEGORIES), 'location': 'Campus', 'seller_id': 1,
+             'status': 'Available'} for i in range(max(ARGS.listings, RESERVE_POOL))])
+        name = acquire_stored_file(jpeg(0), 'jpg')
+        db.session.execute(db.update(StoredFile).values(refcount=max(ARGS.listings, RESERVE_POOL)))
+        db.session.execute(db.insert(ListingImage), [{'filename': name, 'listing_id': i, 'is_cover': True}
+                                                     for i in range(1, max(ARGS.listings, RESERVE_POOL) + 1)])
+        populate_search_index(db.session.connection())
+        db.session.commit()
+        db.engine.dispose()
+    shutil.copyfile(DB_PATH, SEED_PATH)
+
+
+def reset_database():
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(DB_PATH + suffix):
+            os.remove(DB_PATH + suffix)
+    shutil.copyfile(SEED_PATH, DB_PATH)
+
+
+# Server side
+
+@app.errorhandler(OperationalError)
+def lock_timeout(error):
+    # Only installed in this benchmark, so clients can tell lock timeouts from other errors
+    if 'locked' in str(error.orig):
+        return LOCK_MARKER, 503
+    return 'operational error', 500
+
+
+def limit_threads(wsgi_app, threads):
+    """Like Gunicorn's gthread workers: at most `threads` requests run at once,
+    the rest wait for a free thread."""
+    slots = threading.BoundedSemaphore(threads)
+
+    def limited(environ, start_response):
+        with slots:
+            return list(wsgi_app(environ, start_response))
+    return limited
+
+
+def serve(fd):
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    with app.app_context():
+        db.engine.dispose(close=False)  # connections opened before the fork belong to the parent
+    server = make_server('127.0.0.1', 0, limit_threads(app, ARGS.threads), threaded=True, fd=fd)
+    server.serve_forever()
+
+
+def start_workers(count):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+    listener.set_inheritable(True)
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=serve, args=(listener.fileno(),), daemon=True) for _ in range(count)]
+    for worker in workers:
+        worker.start()
+    return listener, workers
+
+
+def stop_workers(listener, workers):
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        worker.join()
+    listener.close()
+
+
+# Client side
+
+class Browser:
+    """One logged-in browser: a keep-alive connection and a session cookie."""
+
+    def __init__(self, port, number):
+        self.port, self.number = port, number
+        self.connection, self.cookie = None, ''
+        self.serializer = app.session_interface.get_signing_serializer(app)
+
+    def request(self, method, path, body=None, content_type=None):
+        """Returns (status, body, seconds); a session cookie in the response is kept."""
+        headers = {'Cookie': f'session={self.cookie}'} if self.cookie else {}
+        if content_type:
+            headers['Content-Type'] = content_type
+        start = time.perf_counter()
+        for attempt in range(2):
+            try:
+                if self.connection is None:
+                    self.connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+                self.connection.request(method, path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                data = response.read()
+                break
+            except (ConnectionError, http.client.HTTPException, OSError):
+                # The server closed a kept-alive connection; retry once on a new one
+                self.connection = None
+                if attempt:
+                    raise
+        for header in response.headers.get_all('Set-Cookie') or ():
+            if header.startswith('session='):
+                self.cookie = header.split(';', 1)[0].split('=', 1)[1]
+        return response.status, data, time.perf_counter() - start
+
+    def pop_flashes(self):
+        """The flashes the last requests left in the session, removed from it
+        since only a few pages display and clear them."""
+        if not self.cookie:
+            return []
+        session = self.serializer.loads(self.cookie)
+        flashes = session.pop('_flashes', [])
+        self.cookie = self.serializer.dumps(session)
+        return flashes
+
+    def form(self, method, path, fields):
+        return self.request(method, path, urllib.parse.urlencode(fields), 'application/x-www-form-urlencoded')
+
+    def login(self):
+        self.form('POST', '/login', {'username': f'load{self.number}', 'password': PASSWORD})
+        self.pop_flashes()
+
+
+def multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: image/jpeg\r\n\r\n'.encode() + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def run_user(port, number, deadline, weights, records, claims):
+    rng = random.Random(number)
+    user = Browser(port, number)
+    user.login()
+    listings = max(ARGS.listings, RESERVE_POOL)
+    sequence = 0
+    while time.monotonic() < deadline:
+        operation = rng.choices(OPERATIONS, weights)[0]
+        sequence += 1
+        tag = f'load{number}:{sequence}'
+        if operation == 'browse':
+            status, body, seconds = user.request('GET', '/listings')
+            if status == 200:
+                status, body, more = user.request('GET', f'/listing/{rng.randint(1, listings)}')
+                seconds += more
+        elif operation == 'search':
+            status, body, seconds = user.request('GET', '/listings?' + urllib.parse.urlencode({'keyword': rng.choice(WORDS)}))
+        elif operation == 'message':
+            recipient = rng.choice([n for n in range(1, ARGS.clients + 1) if n != number] or [number]) + 1
+            status, body, seconds = user.form('POST', f'/message/send/{recipient}', {'content': tag})
+            if status == 302:
+                claims['messages'].append(tag)
+        elif operation == 'reserve':
+            listing_id = rng.randint(1, RESERVE_POOL)
+            status, body, seconds = user.form('POST', f'/listing/{listing_id}/reserve', {})
+            if status == 302 and [category for category, _ in user.pop_flashes()][-1:] == ['success']:
+                claims['reservations'].append((listing_id, number + 1))
+        else:
+            body, content_type = multipart({'title': tag, 'description': 'Load test listing', 'price': '10',
+                                            'category': CATEGORIES[0], 'location': 'Campus'},
+                                           {'images': ('photo.jpg', jpeg(number * 100000 + sequence))})
+            status, body, seconds = user.request('POST', '/listing/new', body, content_type)
+            if status == 302:
+                claims['listings'].append(tag)
+        user.pop_flashes()
+        records.append((operation, status, seconds, status == 503 and body == LOCK_MARKER.encode()))
+
+
+def run_client_process(port, numbers, deadline, weights):
+    records, claims = [], {'messages': [], 'reservations': [], 'listings': []}
+    threads = [threading.Thread(target=run_user, args=(port, number, deadline, weights, records, claims))
+               for number in numbers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return records, claims
+
+
+# Checks
+
+def count_mismatches(connection, sql):
+    return connection.exec_driver_sql(f'SELECT count(*) FROM ({sql})').scalar()
+
+
+def check_integrity(claims):
+    with app.app_context():
+        db.engine.dispose()
+        with db.engine.connect() as connection:
+            stored_messages = collections.Counter(connection.execute(
+                db.select(Message.content).where(Message.content.like('load%:%'))).scalars())
+            stored_listings = set(connection.execute(
+                db.select(Listing.title).where(Listing.title.like('load%:%'))).scalars())
+            reserved = dict(connection.execute(db.select(Listing.id, Listing.reserved_by_id)
+                                               .where(Listing.id <= RESERVE_POOL)).all())
+            winners = collections.defaultdict(set)
+            for listing_id, user_id in claims['reservations']:
+                winners[listing_id].add(user_id)
+            return {
+                'lost_messages': sum(1 for tag in claims['messages'] if tag not in stored_messages),
+                'duplicated_messages': sum(1 for count in stored_messages.values() if count > 1),
+                'lost_listings': sum(1 for tag in claims['listings'] if tag not in stored_listings),
+                'double_reservations': sum(1 for users in winners.values() if len(users) > 1),
+                'wrong_reservation_owner': sum(1 for listing_id, users in winners.items()
+                                               if len(users) == 1 and reserved[listing_id] not in users),
+                'user_unread_drift': count_mismatches(connection, """
+                    SELECT id FROM user WHERE unread_count !=
+                    (SELECT count(*) FROM message WHERE recipient_id = user.id AND NOT read)"""),
+                'thread_drift': count_mismatches(connection, """
+                    SELECT id FROM thread WHERE unread_count !=
+                    (SELECT count(*) FROM message WHERE recipient_id = thread.owner_id
+                     AND sender_id = thread.partner_id AND NOT read)
+                    OR last_message_id != (SELECT max(id) FROM message
+                     WHERE (sender_id = thread.owner_id AND recipient_id = thread.partner_id)
+                        OR (sender_id = thread.partner_id AND recipient_id = thread.owner_id))"""),
+                'refcount_drift': count_mismatches(connection, """
+                    SELECT name FROM stored_file WHERE refcount !=
+                    (SELECT count(*) FROM listing_image WHERE filename = stored_file.name)
+                    + (SELECT count(*) FROM user WHERE avatar_filename = stored_file.name)"""),
+            }
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(math.ceil(fraction * len(ordered)) - 1, 0))] if ordered else 0.0
+
+
+def run(workers, weights):
+    reset_database()
+    listener, processes = start_workers(workers)
+    port = listener.getsockname()[1]
+    numbers = list(range(1, ARGS.clients + 1))
+    chunks = [numbers[i::ARGS.client_processes] for i in range(min(ARGS.client_processes, ARGS.clients))]
+    start = time.monotonic()
+    deadline = start + ARGS.duration
+    try:
+        with multiprocessing.get_context('fork').Pool(len(chunks)) as pool:
+            results = pool.starmap(run_client_process, [(port, chunk, deadline, weights) for chunk in chunks])
+        elapsed = time.monotonic() - start
+    finally:
+        stop_workers(listener, processes)
+    records = [record for chunk_records, _ in results for record in chunk_records]
+    claims = {key: [claim for _, chunk_claims in results for claim in chunk_claims[key]]
+              for key in ('messages', 'reservations', 'listings')}
+    operations = {}
+    for operation in OPERATIONS:
+        rows = [record for record in records if record[0] == operation]
+        latencies = [seconds * 1000 for _, status, seconds, _ in rows if status < 500]
+        operations[operation] = {
+            'requests': len(rows), 'per_second': round(len(rows) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.5), 1), 'p95_ms': round(percentile(latencies, 0.95), 1),
+            'p99_ms': round(percentile(latencies, 0.99), 1),
+            'lock_timeouts': sum(1 for record in rows if record[3]),
+            'errors': sum(1 for _, status, _, locked in rows if status >= 400 and not locked)}
+    return {'workers': workers, 'seconds': round(elapsed, 1), 'per_second': round(len(records) / elapsed, 1),
+            'operations': operations, 'reservations_won': len(claims['reservations']),
+            'integrity': check_integrity(claims)}
+
+
+def report(result):
+    print(f"\n{result['workers']} workers x {ARGS.threads} threads, {ARGS.clients} users: "
+          f"{result['per_second']} operations/s")
+    print(f"{'operation':>10} {'requests':>9} {'per s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'locked':>7} {'errors':>7}")
+    for operation, row in result['operations'].items():
+        print(f"{operation:>10} {row['requests']:>9} {row['per_second']:>7} {row['p50_ms']:>8} {row['p95_ms']:>8} "
+              f"{row['p99_ms']:>8} {row['lock_timeouts']:>7} {row['errors']:>7}")
+    print(f"reservations won: {result['reservations_won']}; "
+          + ', '.join(f'{name.replace("_", " ")}: {count}' for name, count in result['integrity'].items()))
+
+
+def main():
+    weights = dict(item.split('=') for item in ARGS.mix.split(','))
+    weights = [float(weights.get(operation, 0)) for operation in OPERATIONS]
+    seed()
+    results = []
+    for workers in [int(count) for count in ARGS.workers.split(',')]:
+        result = run(workers, weights)
+        report(result)
+        results.append(result)
+    if ARGS.output:
+        with open(ARGS.output, 'w') as f:
+            json.dump({'threads': ARGS.threads, 'clients': ARGS.clients, 'duration': ARGS.duration,
+                       'mix': ARGS.mix, 'runs': results}, f, indent=2)
+    lost = sum(count for result in results for count in result['integrity'].values())
+    shutil.rmtree(TMP, ignore_errors=True)
+    sys.exit(1 if lost else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Benchmark password hashing and the login endpoint.
+Run from the project root: python benchmarks/bench_login.py [methods...]
+
+A login costs one password verification, which is CPU-bound and holds the
+worker for its whole duration, so a server with N cores can complete at most
+N / verification-time logins per second whatever else it does. The first
+table shows that ceiling for each hash method; PASSWORD_HASH_METHOD picks the
+trade-off between it and the cost of brute-forcing a leaked hash.
+
+The second table drives /login through the test client in this process:
+successful logins with the configured method, and the attempts the login
+throttle refuses, which never reach the hash.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from app import create_app, db, User, login_throttle
+
+DEFAULT_METHODS = ['scrypt:32768:8:1', 'scrypt:16384:8:1', 'pbkdf2:sha256:1000000', 'pbkdf2:sha256:600000']
+PASSWORD = 'correct horse battery staple'
+DURATION = 2.0  # seconds per measurement
+
+
+def rate(fn):
+    """Calls per second of fn, run repeatedly for DURATION seconds."""
+    calls, start = 0, time.perf_counter()
+    while time.perf_counter() - start < DURATION:
+        fn()
+        calls += 1
+    return calls / (time.perf_counter() - start)
+
+
+def hashing_table(methods):
+    cores = os.cpu_count() or 1
+    print(f"{'method':>24} {'verify ms':>10} {'logins/s/core':>14} {f'logins/s x{cores}':>14}")
+    for method in methods:
+        stored = generate_password_hash(PASSWORD, method)
+        per_second = rate(lambda: check_password_hash(stored, PASSWORD))
+        print(f"{method:>24} {1000 / per_second:>10.1f} {per_second:>14.1f} {per_second * cores:>14.1f}")
+
+
+def endpoint_table():
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+                          'LOGIN_THROTTLE_PATH': os.path.join(tmp, 'throttle.db')})
+        with app.app_context():
+            db.create_all()
+            user = User(username='bench')
+            user.password = PASSWORD
+            db.session.add(user)
+            db.session.commit()
+        client = app.test_client()
+        login = {'username': 'bench', 'password': PASSWORD}
+
+        print(f"\n{'/login (' + app.config['PASSWORD_HASH_METHOD'] + ')':>40} {'requests/s':>11}")
+        app.config['LOGIN_THROTTLE'] = 'none'
+        print(f"{'successful, unthrottled':>40} {rate(lambda: client.post('/login', data=login)):>11.1f}")
+        for backend in ('memory', 'sqlite'):
+            app.config.update(LOGIN_THROTTLE=backend, LOGIN_IP_BURST=1, LOGIN_IP_PER_MINUTE=0.001)
+            with app.app_context():
+                login_throttle.clear()
+            client.post('/login', data=login)
+            print(f"{'refused by ' + backend + ' throttle':>40} {rate(lambda: client.post('/login', data=login)):>11.1f}")
+
+
+def main():
+    hashing_table(sys.argv[1:] or DEFAULT_METHODS)
+    endpoint_table()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Benchmark buyers racing to reserve the same listings.
+Run from the project root: python benchmarks/bench_reserve.py [listings] [buyers]
+
+Buyer threads post reserve requests through the test client against an
+SQLite file, in two scenarios: "contended", where every buyer tries every
+listing in its own random order, and "distinct", where each listing has one
+buyer so every request succeeds. Two implementations run:
+
+  read-check-write    the old route: load the listing, check its status in
+                      Python, assign and commit. On SQLite it is only correct
+                      because POSTs begin with BEGIN IMMEDIATE, which holds
+                      the write lock across the whole round trip; on a
+                      database without that it can hand one listing to two
+                      buyers.
+  conditional update  reserve_listing(): one UPDATE ... WHERE status =
+                      'Available', checking the affected row count.
+
+Both must end with exactly one winner per listing. Throughput here is mostly
+Python request handling; the "lock ms" column is the mean time a request
+held the database write lock, from BEGIN IMMEDIATE to COMMIT, which is what
+serialises workers in separate processes.
+"""
+
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+TMP = tempfile.mkdtemp()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import flash, redirect, url_for
+from flask_login import current_user, login_required
+from sqlalchemy import event
+
+from app import create_app, db, User, Listing
+
+app = create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(TMP, 'bench.db')}", 'LOGIN_THROTTLE': 'none',
+                  'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000', 'FRAGMENT_CACHE': 'none'})
+
+
+@login_required
+def legacy_reserve(listing_id):
+    listing = Listing.query.get_or_404(listing_id)
+    if listing.status != 'Available':
+        flash('This listing is not available for reservation.', 'danger')
+        return redirect(url_for('listings.listing_detail', listing_id=listing.id))
+    if listing.seller == current_user:
+        flash('You cannot reserve your own listing.', 'danger')
+        return redirect(url_for('listings.listing_detail', listing_id=listing.id))
+    listing.status = 'Reserved'
+    listing.reserved_by = current_user
+    db.session.commit()
+    flash('You have reserved this listing.', 'success')
+    return redirect(url_for('listings.listing_detail', listing_id=listing.id))
+
+
+app.add_url_rule('/bench/<int:listing_id>/legacy_reserve', 'legacy_reserve', legacy_reserve, methods=['POST'])
+
+MODES = [('read-check-write', '/bench/{}/legacy_reserve'), ('conditional update', '/listing/{}/reserve')]
+
+
+def setup(listings, buyers):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seller = User(username='seller', password_hash='x')
+        db.session.add(seller)
+        for i in range(buyers):
+            user = User(username=f'buyer{i}')
+            user.password = 'pass'
+            db.session.add(user)
+        db.session.add_all(Listing(title=f'Item {i}', description='d', price=1.0, seller=seller)
+                           for i in range(listings))
+        db.session.commit()
+
+
+lock_times = []
+
+
+def track_write_locks():
+    with app.app_context():
+        engine = db.engine
+
+    @event.listens_for(engine, 'begin')
+    def begin(conn):
+        conn.info['began'] = time.perf_counter()
+
+    @event.listens_for(engine, 'commit')
+    @event.listens_for(engine, 'rollback')
+    def end(conn):
+        began = conn.info.pop('began', None)
+        if began is not None:
+            lock_times.append(time.perf_counter() - began)
+
+
+def race(url, listings, buyers, contended):
+    """Returns elapsed seconds, wins per listing and the number of failed requests."""
+    barrier = threading.Barrier(buyers + 1)
+    wins, failures = {}, []
+
+    def buyer(number):
+        client = app.test_client()
+        client.post('/login', data={'username': f'buyer{number}', 'password': 'pass'})
+        with client.session_transaction() as session:
+            session.pop('_flashes', None)
+        if contended:
+            listing_ids = list(range(1, listings + 1))
+            random.Random(number).shuffle(listing_ids)
+        else:
+            listing_ids = list(range(number + 1, listings + 1, buyers))
+        barrier.wait()
+        for listing_id in listing_ids:
+            response = client.post(url.format(listing_id))
+            if response.status_code != 302:
+                failures.append(response.status_code)
+            with client.session_transaction() as session:
+                if [category for category, _ in session.pop('_flashes', [])] == ['success']:
+                    wins[listing_id] = wins.get(listing_id, 0) + 1
+
+    threads = [threading.Thread(target=buyer, args=(i,)) for i in range(buyers)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    lock_times.clear()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, wins, len(failures)
+
+
+def main():
+    listings = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    buyers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    track_write_locks()
+    print(f'{listings} listings, {buyers} buyers')
+    print(f"{'scenario':>10} {'implementation':>20} {'requests':>9} {'requests/s':>11} {'lock ms':>8} "
+          f"{'one winner':>11} {'double':>7} {'failed':>7}")
+    ok = True
+    for scenario, contended in (('contended', True), ('distinct', False)):
+        requests = listings * buyers if contended else listings
+        for name, url in MODES:
+            setup(listings, buyers)
+            elapsed, wins, failed = race(url, listings, buyers, contended)
+            single = sum(1 for count in wins.values() if count == 1)
+            double = sum(1 for count in wins.values() if count > 1)
+            lock_ms = 1000 * sum(lock_times) / max(len(lock_times), 1)
+            print(f"{scenario:>10} {name:>20} {requests:>9} {requests / elapsed:>11.1f} {lock_ms:>8.2f} "
+                  f"{single:>11} {double:>7} {failed:>7}")
+            ok = ok and single == listings and not failed
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
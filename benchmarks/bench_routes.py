@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+"""
+Benchmark every route against a seeded production-sized database.
+Run from the project root: python benchmarks/bench_routes.py [--scale 0.1] [--db PATH]
+    [--repeat 30] [--output FILE] [--compare FILE] [--latency-factor 2]
+
+The database is seeded with bulk inserts (at --scale 1: 10k users, 100k
+listings with two images each, 1M messages, 50k reviews, 200k favorites and
+5k reports) and the derived tables are rebuilt with the same functions the
+maintenance commands use. --db keeps the seeded file, so later runs skip
+seeding; every run works on a fresh copy of it, since the write cases use up
+the rows set aside for them.
+
+Each case in build_cases() drives one route through the test client --repeat times
+after two warm-up requests, recording the SQL statements and wall time of
+every request. A case fails when its worst query count or its p95 latency
+goes over the budget next to it. Budgets are set for the default --scale 1;
+smaller scales are for trying the harness out. p95 budgets are multiplied
+by --latency-factor for slower machines. Every route in app.url_map must have
+at least one case, so a new route fails the run until it gets a budget.
+
+Results go to --output as JSON (default benchmarks/results/<commit>.json);
+--compare prints them against an earlier file. Exits 1 on any failure.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+parser = argparse.ArgumentParser(description='Time every route against a seeded database.')
+parser.add_argument('--scale', type=float, default=1.0, help='fraction of the full data volumes (default 1)')
+parser.add_argument('--db', help='SQLite file to seed once and reuse (default: a temporary file)')
+parser.add_argument('--repeat', type=int, default=30, help='timed requests per case (default 30)')
+parser.add_argument('--output', help='JSON results file (default benchmarks/results/<commit>.json)')
+parser.add_argument('--compare', help='earlier JSON results to print alongside')
+parser.add_argument('--latency-factor', type=float, default=1.0, help='multiplier for every p95 budget')
+parser.add_argument('--only', help='run only the cases whose name contains this')
+ARGS = parser.parse_args()
+if not 0 < ARGS.repeat <= 198:
+    parser.error('--repeat must be between 1 and 198')
+
+TMP = tempfile.mkdtemp()
+SEED_PATH = os.path.abspath(ARGS.db) if ARGS.db else None
+DB_PATH = os.path.join(TMP, 'bench.db')
+SEEDED = SEED_PATH is not None and os.path.exists(SEED_PATH)
+if SEEDED:
+    shutil.copyfile(SEED_PATH, DB_PATH)
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'  # logins are benchmarked by bench_login.py
+sys.path.insert(0, ROOT)
+
+from PIL import Image as PILImage
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+
+from app import (create_app, db, upgrade_database, User, Listing, ListingImage, Message, Review, Report, favorites,
+                 CATEGORIES, IMAGE_SIZES, stored_name, derivative_filename, populate_threads,
+                 populate_rating_summaries, populate_search_index, reconcile_unread, reconcile_stored_files)
+
+MEDIA_ROOT = os.path.dirname(SEED_PATH or DB_PATH)
+app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{DB_PATH}', 'LOGIN_THROTTLE': 'none',
+                  'PASSWORD_HASH_METHOD': PASSWORD_HASH_METHOD, 'EVENTS_MAX_DURATION': 0.001,
+                  'METRICS_PATH': os.path.join(TMP, 'metrics.db'),
+                  'UPLOAD_FOLDER': os.path.join(MEDIA_ROOT, 'bench-uploads'),
+                  'AVATAR_FOLDER': os.path.join(MEDIA_ROOT, 'bench-avatars')})
+
+VOLUMES = {'users': 10000, 'listings': 100000, 'images_per_listing': 2, 'messages': 1000000,
+           'reviews': 50000, 'favorites': 200000, 'reports': 5000}
+WARMUP = 2
+FIXTURE_ROWS = 200  # listings set aside per write case, one per request
+SEED_IMAGES = 16
+WORDS = ['lamp', 'desk', 'chair', 'bike', 'textbook', 'calculator', 'kettle', 'monitor', 'guitar', 'jacket',
+         'sofa', 'shelf', 'camera', 'printer', 'fan', 'mirror', 'rug', 'speaker', 'keyboard', 'backpack']
+ADJECTIVES = ['red', 'vintage', 'small', 'large', 'used', 'new', 'wooden', 'folding', 'electric', 'classic']
+LOCATIONS = ['North Campus', 'South Campus', 'Library', 'Dorm A', 'Dorm B', 'Downtown']
+
+# Named users the cases act as; everyone else is user<n>
+BENCH, ADMIN, SELLER, PARTNER = 1, 2, 3, 4
+PASSWORD = 'pass'
+
+
+def volume(name):
+    return max(int(VOLUMES[name] * ARGS.scale), 1) if name != 'images_per_listing' else VOLUMES[name]
+
+
+def insert_batches(connection, table, rows, size=20000):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            connection.execute(db.insert(table), batch)
+            batch = []
+    if batch:
+        connection.execute(db.insert(table), batch)
+
+
+def write_seed_images():
+    """A few real JPEGs with their resized copies; every seeded image row points at one of them."""
+    folder = app.config['UPLOAD_FOLDER']
+    names = []
+    for i in range(SEED_IMAGES):
+        buffer = io.BytesIO()
+        PILImage.new('RGB', (1600, 1200), (i * 15, 100, 255 - i * 15)).save(buffer, 'JPEG', quality=80)
+        data = buffer.getvalue()
+        name = stored_name(hashlib.sha256(data).hexdigest(), 'jpg')
+        os.makedirs(os.path.dirname(os.path.join(folder, name)), exist_ok=True)
+        with open(os.path.join(folder, name), 'wb') as f:
+            f.write(data)
+        with PILImage.open(io.BytesIO(data)) as original:
+            for size, edge in IMAGE_SIZES.items():
+                resized = original.copy()
+                resized.thumbnail((edge, edge))
+                resized.save(os.path.join(folder, derivative_filename(name, size, 'jpg')), 'JPEG', quality=82)
+        names.append(name)
+    os.makedirs(app.config['AVATAR_FOLDER'], exist_ok=True)
+    PILImage.new('RGB', (128, 128), 'gray').save(os.path.join(app.config['AVATAR_FOLDER'], 'bench.png'))
+    return names
+
+
+def fixture_size():
+    return FIXTURE_ROWS
+
+
+def fixture_blocks():
+    """Listing id ranges set aside for the write cases, one listing per request."""
+    n, blocks, start = fixture_size(), {}, 1
+    for name in ('reserve', 'favorite', 'mine_reserved', 'delete', 'review'):
+        blocks[name] = range(start, start + n)
+        start += n
+    return blocks
+
+
+def seed():
+    rng = random.Random(0)
+    users, listings, messages = volume('users'), volume('listings'), volume('messages')
+    blocks = fixture_blocks()
+    fixtures = sum(len(block) for block in blocks.values())
+    users, listings = max(users, 10), max(listings, fixtures + 100)
+    now = datetime.utcnow()
+    started = time.perf_counter()
+    with app.app_context():
+        upgrade_database()
+        image_names = write_seed_images()
+        password_hash = generate_password_hash(PASSWORD, PASSWORD_HASH_METHOD)
+        with db.engine.begin() as connection:
+            names = {BENCH: 'bench', ADMIN: 'admin', SELLER: 'seller', PARTNER: 'partner'}
+            insert_batches(connection, User.__table__, (
+                {'id': i, 'username': names.get(i, f'user{i}'), 'password_hash': password_hash, 'is_admin': i == ADMIN,
+                 'avatar_filename': 'bench.png' if i == BENCH else None,
+                 'created_at': now - timedelta(days=365 * (users - i) / users)} for i in range(1, users + 1)))
+
+            def listing_row(i):
+                row = {'id': i, 'title': f'{rng.choice(ADJECTIVES)} {rng.choice(WORDS)}',
+                       'description': ' '.join(rng.choices(ADJECTIVES + WORDS, k=30)),
+                       'price': round(rng.uniform(1, 500), 2), 'category': rng.choice(CATEGORIES),
+                       'location': rng.choice(LOCATIONS), 'seller_id': rng.randint(5, users),
+                       'status': 'Available', 'reserved_by_id': None, 'version': 0}
+                roll = rng.random()
+                if roll < 0.05:
+                    row.update(status='Sold', reserved_by_id=rng.randint(1, users))
+                elif roll < 0.15:
+                    row.update(status='Reserved', reserved_by_id=rng.randint(1, users))
+                elif roll < 0.17:
+                    row['seller_id'] = BENCH
+                # Listings the write cases act on, one per request
+                if i in blocks['reserve'] or i in blocks['favorite']:
+                    row.update(seller_id=SELLER, status='Available', reserved_by_id=None)
+                elif i in blocks['mine_reserved']:
+                    row.update(seller_id=BENCH, status='Reserved', reserved_by_id=SELLER)
+                elif i in blocks['delete']:
+                    row.update(seller_id=BENCH, status='Available', reserved_by_id=None)
+                elif i in blocks['review']:
+                    row.update(seller_id=SELLER, status='Sold', reserved_by_id=BENCH)
+                return row
+            insert_batches(connection, Listing.__table__, (listing_row(i) for i in range(1, listings + 1)))
+            insert_batches(connection, ListingImage.__table__, (
+                {'filename': rng.choice(image_names), 'listing_id': i, 'is_cover': n == 0, 'derivatives': 'jpg'}
+                for i in range(1, listings + 1) for n in range(volume('images_per_listing'))))
+
+            # Mostly short conversations between random users, plus one long
+            # one for the conversation page and a busy inbox for the bench user
+            pairs = [(rng.randint(1, users), rng.randint(1, users)) for _ in range(max(messages // 20, 1))]
+            pairs += [(BENCH, rng.randint(5, users)) for _ in range(200)]
+            long_thread = min(5000, max(messages // 10, 100))
+            span = timedelta(days=365).total_seconds()
+
+            def message_row(i):
+                if i < long_thread:
+                    sender, recipient = (BENCH, PARTNER) if i % 2 else (PARTNER, BENCH)
+                else:
+                    sender, recipient = rng.choice(pairs)
+                    if sender == recipient:
+                        recipient = recipient % users + 1
+                    if rng.random() < 0.5:
+                        sender, recipient = recipient, sender
+                return {'sender_id': sender, 'recipient_id': recipient, 'content': ' '.join(rng.choices(WORDS, k=8)),
+                        'timestamp': now - timedelta(seconds=span * (1 - i / messages)), 'read': i < messages * 0.95}
+            insert_batches(connection, Message.__table__, (message_row(i) for i in range(messages)))
+
+            insert_batches(connection, Review.__table__, (
+                {'reviewer_id': rng.randint(1, users), 'reviewee_id': SELLER if i % 10 == 0 else rng.randint(1, users),
+                 'listing_id': rng.randint(fixtures + 1, listings), 'rating': rng.randint(1, 5), 'comment': 'Smooth sale.',
+                 'timestamp': now - timedelta(seconds=rng.uniform(0, span))} for i in range(volume('reviews'))))
+            reserved = set(blocks['favorite'])
+            pairs = {(rng.randint(1, users), rng.randint(1, listings)) for _ in range(volume('favorites'))}
+            insert_batches(connection, favorites, ({'user_id': user_id, 'listing_id': listing_id}
+                                                   for user_id, listing_id in pairs
+                                                   if not (user_id == BENCH and listing_id in reserved)))
+            insert_batches(connection, Report.__table__, (
+                {'reporter_id': rng.randint(1, users), 'listing_id': rng.randint(fixtures + 1, listings), 'reason': 'Looks off',
+                 'timestamp': now - timedelta(seconds=rng.uniform(0, span)), 'resolved': rng.random() < 0.5}
+                for _ in range(volume('reports'))))
+
+            populate_threads(connection)
+            populate_rating_summaries(connection)
+            populate_search_index(connection)
+            reconcile_unread(connection)
+            reconcile_stored_files(connection)
+        # No ANALYZE: the app never runs it, so production files have no planner statistics
+        db.engine.dispose()
+    # Fold the WAL into the file before it is copied
+    with contextlib.closing(sqlite3.connect(DB_PATH)) as conn:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    if SEED_PATH:
+        shutil.copyfile(DB_PATH, SEED_PATH)
+    print(f'Seeded {SEED_PATH or DB_PATH} in {time.perf_counter() - started:.0f}s')
+
+
+class Case:
+    """One route request repeated. path and data may be callables of the
+    request number, so write cases can act on a fresh row each time, and
+    prepare(clients, number) runs untimed before each request."""
+
+    def __init__(self, name, method, path, user, max_queries, p95_ms, data=None, prepare=None, files=False):
+        self.name, self.method, self.path, self.user = name, method, path, user
+        self.max_queries, self.p95_ms = max_queries, p95_ms
+        self.data, self.prepare, self.files = data, prepare, files
+
+    def request(self, client, i):
+        path = self.path(i) if callable(self.path) else self.path
+        data = self.data(i) if callable(self.data) else self.data
+        return client.open(path, method=self.method, data=data,
+                           content_type='multipart/form-data' if self.files else None)
+
+
+def upload(i):
+    buffer = io.BytesIO()
+    PILImage.new('RGB', (800, 600), (i % 256, 40, 90)).save(buffer, 'JPEG')
+    buffer.seek(0)
+    return buffer
+
+
+BLOCKS = fixture_blocks()
+
+
+def build_cases():
+    listings = volume('listings')
+    rng = random.Random(1)
+    detail_ids = [rng.randint(1, max(listings, 1)) for _ in range(fixture_size())]
+    with app.app_context():
+        image_name = db.session.execute(db.select(ListingImage.filename).limit(1)).scalar()
+        mine = db.session.execute(db.select(Listing.id).where(Listing.seller_id == BENCH)
+                                  .order_by(Listing.id.desc()).limit(1)).scalar()
+    listing_form = {'title': 'Bench lamp', 'description': 'Barely used.', 'price': '12.5', 'category': CATEGORIES[0],
+                    'location': LOCATIONS[0]}
+    # name, method, path, user, max queries, p95 ms
+    return [
+        Case('home', 'GET', '/', 'visitor', 0, 15),
+        Case('about', 'GET', '/about', 'visitor', 0, 15),
+        Case('contact', 'GET', '/contact', 'visitor', 0, 15),
+        Case('contact post', 'POST', '/contact', 'visitor', 0, 20, data={'message': 'Hello'}),
+        Case('static', 'GET', '/static/js/live.js', 'visitor', 0, 20),
+        Case('register form', 'GET', '/register', 'visitor', 0, 15),
+        Case('register', 'POST', '/register', 'visitor', 3, 30,
+             data=lambda i: {'username': f'newcomer{i}', 'password': PASSWORD}),
+        Case('login form', 'GET', '/login', 'visitor', 0, 15),
+        Case('login', 'POST', '/login', 'visitor', 2, 30, data={'username': 'seller', 'password': PASSWORD}),
+        Case('logout', 'GET', '/logout', 'visitor', 0, 15,
+             prepare=lambda clients, i: clients['visitor'].post('/login', data={'username': 'seller', 'password': PASSWORD})),
+        Case('listings', 'GET', '/listings', 'bench', 5, 60),
+        Case('listings anonymous', 'GET', '/listings', 'visitor', 4, 60),
+        Case('listings category', 'GET', f'/listings?category={CATEGORIES[1]}', 'bench', 5, 60),
+        Case('listings keyword', 'GET', '/listings?keyword=lamp', 'bench', 5, 500),
+        Case('listings price', 'GET', '/listings?sort=price_asc&min_price=50', 'bench', 5, 150),
+        Case('listings sold', 'GET', '/listings?status=Sold', 'bench', 5, 60),
+        Case('api listings', 'GET', '/api/listings?limit=50', 'bench', 3, 80),
+        Case('api listing images', 'GET', '/api/listing-images?ids=' + ','.join(map(str, detail_ids[:24])),
+             'visitor', 2, 20),
+        Case('listing detail', 'GET', lambda i: f'/listing/{detail_ids[i]}', 'bench', 9, 100),
+        Case('new listing form', 'GET', '/listing/new', 'bench', 0, 20),
+        Case('new listing', 'POST', '/listing/new', 'bench', 12, 150, files=True,
+             data=lambda i: dict(listing_form, images=(upload(i), 'photo.jpg'))),
+        Case('edit listing form', 'GET', f'/listing/{mine}/edit', 'bench', 3, 30),
+        Case('edit listing', 'POST', f'/listing/{mine}/edit', 'bench', 6, 40, data=listing_form),
+        Case('reserve', 'POST', lambda i: f"/listing/{BLOCKS['reserve'][i]}/reserve", 'bench', 3, 60),
+        Case('cancel reservation', 'POST', lambda i: f"/listing/{BLOCKS['reserve'][i]}/cancel_reservation",
+             'bench', 3, 30),
+        Case('mark sold', 'POST', lambda i: f"/listing/{BLOCKS['mine_reserved'][i]}/mark_sold", 'bench', 3, 20),
+        Case('relist', 'POST', lambda i: f"/listing/{BLOCKS['mine_reserved'][i]}/relist", 'bench', 3, 20),
+        Case('delete listing', 'POST', lambda i: f"/listing/{BLOCKS['delete'][i]}/delete", 'bench', 14, 80),
+        Case('favorite', 'POST', lambda i: f"/favorite/{BLOCKS['favorite'][i]}", 'bench', 6, 30),
+        Case('unfavorite', 'POST', lambda i: f"/unfavorite/{BLOCKS['favorite'][i]}", 'bench', 5, 30),
+        Case('my favorites', 'GET', '/my_favorites', 'bench', 3, 40),
+        # Unpaginated: renders every purchase, and the bench user has the 200 review listings
+        Case('my purchases', 'GET', '/my_purchases', 'bench', 3, 250),
+        Case('my sales', 'GET', '/my_sales', 'bench', 2, 20),
+        Case('review', 'POST', lambda i: f"/review/{BLOCKS['review'][i]}/{SELLER}", 'bench', 9, 40,
+             data={'rating': '5', 'comment': 'Great seller'}),
+        Case('report', 'POST', lambda i: f'/report/listing/{detail_ids[i]}', 'bench', 6, 30,
+             data={'reason': 'Spam'}),
+        Case('profile', 'GET', '/user/seller', 'bench', 5, 30),
+        Case('own profile', 'GET', '/user/bench', 'bench', 5, 30),
+        Case('avatar upload', 'POST', '/user/bench', 'bench', 9, 60, files=True,
+             data=lambda i: {'avatar': (upload(i), 'avatar.jpg')}),
+        Case('avatar', 'GET', '/avatars/bench.png', 'visitor', 0, 15),
+        Case('upload', 'GET', f'/uploads/{image_name}', 'visitor', 0, 15),
+        Case('conversations', 'GET', '/conversations', 'bench', 2, 30),
+        Case('conversation', 'GET', '/messages/partner', 'bench', 5, 30),
+        Case('conversation send', 'POST', '/messages/partner', 'bench', 10, 40, data={'content': 'Still available?'}),
+        Case('conversation read', 'POST', '/messages/bench/read', 'partner', 7, 30, data={'up_to': str(2 ** 31)},
+             prepare=lambda clients, i: clients['bench'].post('/messages/partner', data={'content': 'Are you there?'})),
+        Case('send message', 'POST', f'/message/send/{PARTNER}', 'bench', 10, 50, data={'content': 'Hi there'}),
+        Case('events', 'GET', '/events', 'bench', 0, 15),
+        Case('admin', 'GET', '/admin', 'admin', 5, 60),
+        Case('metrics', 'GET', '/metrics', 'visitor', 10, 100),
+    ]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def run(cases):
+    with app.app_context():
+        engine = db.engine
+    statements, request_thread = [], threading.get_ident()
+
+    # Image resizing runs on background threads; their statements are not the request's
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == request_thread:
+            statements.append(statement)
+    clients = {}
+    for user in {case.user for case in cases} | {'bench', 'visitor'}:
+        client = clients[user] = app.test_client()
+        if user != 'visitor':
+            client.post('/login', data={'username': user, 'password': PASSWORD})
+    results = {}
+    for case in cases:
+        client = clients[case.user]
+        timings, queries, statuses = [], [], set()
+        for i in range(ARGS.repeat + WARMUP):
+            if case.prepare:
+                case.prepare(clients, i)
+            del statements[:]
+            start = time.perf_counter()
+            response = case.request(client, i)
+            response.get_data()
+            elapsed = time.perf_counter() - start
+            if i >= WARMUP:
+                timings.append(elapsed * 1000)
+                queries.append(len(statements))
+                statuses.add(response.status_code)
+            # Keep the session cookie small when redirects are not followed
+            with client.session_transaction() as session:
+                session.pop('_flashes', None)
+        rule = app.url_map.bind('localhost').match(
+            (case.path(0) if callable(case.path) else case.path).split('?')[0], method=case.method)[0]
+        p95_budget = case.p95_ms * ARGS.latency_factor
+        result = results[case.name] = {
+            'endpoint': rule, 'method': case.method, 'statuses': sorted(statuses),
+            'queries': max(queries), 'p50_ms': round(percentile(timings, 0.5), 2),
+            'p95_ms': round(percentile(timings, 0.95), 2), 'max_queries': case.max_queries,
+            'p95_budget_ms': p95_budget}
+        result['failed'] = [reason for reason, over in (
+            ('queries', result['queries'] > case.max_queries), ('p95', result['p95_ms'] > p95_budget),
+            ('status', any(status >= 400 for status in statuses))) if over]
+    return results
+
+
+def uncovered_routes(results):
+    covered = {(result['endpoint'], result['method']) for result in results.values()}
+    return sorted((rule.endpoint, method) for rule in app.url_map.iter_rules()
+                  for method in rule.methods - {'HEAD', 'OPTIONS'} if (rule.endpoint, method) not in covered)
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def report(results, baseline):
+    print(f"{'case':>22} {'endpoint':>30} {'queries':>8} {'budget':>7} {'p50 ms':>8} {'p95 ms':>8} {'budget':>8}"
+          + (f" {'was p95':>8} {'was q':>6}" if baseline else '') + '  result')
+    for name, result in results.items():
+        line = (f"{name:>22} {result['endpoint']:>30} {result['queries']:>8} {result['max_queries']:>7} "
+                f"{result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} {result['p95_budget_ms']:>8.1f}")
+        if baseline:
+            before = baseline.get(name)
+            line += f" {before['p95_ms']:>8.2f} {before['queries']:>6}" if before else f" {'-':>8} {'-':>6}"
+        print(line + '  ' + (', '.join(f'over {reason}' for reason in result['failed']) or 'ok'))
+
+
+def main():
+    if SEEDED:
+        print(f'Using a copy of {SEED_PATH}')
+    else:
+        seed()
+    cases = [case for case in build_cases() if not ARGS.only or ARGS.only in case.name]
+    results = run(cases)
+    baseline = None
+    if ARGS.compare:
+        with open(ARGS.compare) as f:
+            baseline = json.load(f)['routes']
+    report(results, baseline)
+    uncovered = [] if ARGS.only else uncovered_routes(results)
+    for endpoint, method in uncovered:
+        print(f'No benchmark case for {method} {endpoint}')
+
+    output = ARGS.output or os.path.join(ROOT, 'benchmarks', 'results', f'{commit()}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'commit': commit(), 'created': datetime.utcnow().isoformat(timespec='seconds'),
+                   'scale': ARGS.scale, 'repeat': ARGS.repeat, 'latency_factor': ARGS.latency_factor,
+                   'routes': results, 'uncovered': uncovered}, f, indent=2)
+    print(f'Results written to {output}')
+    failed = [name for name, result in results.items() if result['failed']]
+    if failed or uncovered:
+        print(f'FAILED: {len(failed)} cases over budget, {len(uncovered)} routes without a case')
+    sys.exit(1 if failed or uncovered else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Benchmark listing keyword search: the old leading-wildcard LIKE scan against
+the FTS5 index and the term-table fallback used on other databases.
+Run from the project root: python benchmarks/bench_search.py [sizes...]
+
+LIKE cost grows with the rows it has to scan before it finds a page of hits,
+so it is worst for rare words. The index cost grows with the number of
+matches, because ranking by relevance has to score all of them.
+"""
+
+import itertools
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy.dialects import sqlite
+
+from app import create_app, db, SEARCH_FTS_DDL, listing_term_weights, search_listings_subquery
+
+app = create_app()
+
+VOCABULARY_SIZE = 20000
+# Vocabulary ranks to search for, from common words to rare ones. Word
+# frequencies follow a Zipf distribution like real listing text does.
+KEYWORD_RANKS = [20, 200, 2000, 15000]
+REPEAT = 20
+
+
+def make_vocabulary():
+    rng = random.Random(0)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        words.add(''.join(rng.choice(letters) for _ in range(rng.randint(4, 9))))
+    return sorted(words)
+
+
+VOCABULARY = make_vocabulary()
+KEYWORDS = [VOCABULARY[rank] for rank in KEYWORD_RANKS]
+ZIPF_CUM_WEIGHTS = list(itertools.accumulate(1.0 / rank for rank in range(1, VOCABULARY_SIZE + 1)))
+
+
+def build_database(path, size):
+    rng = random.Random(size)
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE listing (id INTEGER PRIMARY KEY, title TEXT NOT NULL, description TEXT NOT NULL)")
+    conn.execute(SEARCH_FTS_DDL)
+    conn.execute("CREATE TABLE listing_search_term (term TEXT, listing_id INTEGER, weight INTEGER NOT NULL, "
+                 "PRIMARY KEY (term, listing_id))")
+    rows = []
+    for i in range(1, size + 1):
+        words = rng.choices(VOCABULARY, cum_weights=ZIPF_CUM_WEIGHTS, k=28)
+        rows.append((i, ' '.join(words[:3]), ' '.join(words[3:])))
+    conn.executemany("INSERT INTO listing VALUES (?, ?, ?)", rows)
+    conn.execute("INSERT INTO listing_fts (rowid, title, description) SELECT id, title, description FROM listing")
+    conn.executemany("INSERT INTO listing_search_term VALUES (?, ?, ?)",
+                     ((t, i, w) for i, title, description in rows
+                      for t, w in listing_term_weights(title, description).items()))
+    conn.commit()
+    return conn
+
+
+def like_search(conn, keyword):
+    pattern = f'%{keyword}%'
+    return conn.execute("SELECT id FROM listing WHERE title LIKE ? OR description LIKE ? ORDER BY id DESC LIMIT 24",
+                        (pattern, pattern)).fetchall()
+
+
+def index_search_sql(backend, keyword):
+    """Compile the query listings() runs for this backend to plain SQLite SQL."""
+    app.config['SEARCH_BACKEND'] = backend
+    with app.app_context():
+        matches = search_listings_subquery(keyword)
+        query = db.select(matches.c.listing_id).order_by(matches.c.rank).limit(24)
+        return str(query.compile(dialect=sqlite.dialect(), compile_kwargs={'literal_binds': True}))
+
+
+def index_search(backend):
+    compiled = {keyword: index_search_sql(backend, keyword) for keyword in KEYWORDS}
+    return lambda conn, keyword: conn.execute(compiled[keyword]).fetchall()
+
+
+def timed(fn, conn, keyword):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        fn(conn, keyword)
+    return (time.perf_counter() - start) * 1000 / REPEAT
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [1000, 10000, 100000]
+    fts_search, term_search = index_search('fts5'), index_search('terms')
+    print(f"{'listings':>10} {'keyword':>10} {'matches':>8} {'LIKE ms':>9} {'FTS5 ms':>9} {'terms ms':>9} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            conn = build_database(os.path.join(tmp, f'bench_{size}.db'), size)
+            for keyword in KEYWORDS:
+                matches = conn.execute("SELECT count(*) FROM listing_fts WHERE listing_fts MATCH ?",
+                                       (f'"{keyword}"',)).fetchone()[0]
+                like_ms = timed(like_search, conn, keyword)
+                fts_ms = timed(fts_search, conn, keyword)
+                term_ms = timed(term_search, conn, keyword)
+                print(f"{size:>10} {keyword:>10} {matches:>8} {like_ms:>9.3f} {fts_ms:>9.3f} {term_ms:>9.3f} "
+                      f"{like_ms / fts_ms:>7.1f}x")
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
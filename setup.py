@@ -40,9 +40,9 @@ def install_dependencies():
 def create_database():
     """Create the database and tables."""
     try:
-        from app import app, db
+        from app import app, upgrade_database
         with app.app_context():
-            db.create_all()
+            upgrade_database()
         print("✅ Database created successfully")
         return True
     except Exception as e:
@@ -2,6 +2,47 @@
 window.listingImages = {};
 window.listingImageIndex = {};
 
+// Image lists are fetched from the manifest endpoint the first time a card's
+// arrows are used. Presses in the same tick share one batched request.
+var manifestQueue = {};
+var manifestRequested = {};
+var manifestTimer = null;
+
+function withListingImages(listingId, callback) {
+    if (window.listingImages[listingId]) {
+        callback();
+        return;
+    }
+    if (manifestRequested[listingId]) return;
+    manifestRequested[listingId] = true;
+    manifestQueue[listingId] = callback;
+    if (!manifestTimer) manifestTimer = setTimeout(fetchManifests, 0);
+}
+
+function fetchManifests() {
+    var batch = manifestQueue;
+    manifestQueue = {};
+    manifestTimer = null;
+    var ids = Object.keys(batch);
+    var url = document.getElementById('listing-grid').getAttribute('data-image-manifest-url');
+    fetch(url + '?ids=' + ids.join(','), {credentials: 'same-origin', headers: {'Accept': 'application/json'}})
+        .then(function(response) {
+            if (!response.ok) throw new Error('HTTP ' + response.status);
+            return response.json();
+        })
+        .then(function(data) {
+            ids.forEach(function(listingId) {
+                window.listingImages[listingId] = data.images[listingId] || [];
+                batch[listingId]();
+            });
+        })
+        .catch(function() {})
+        .then(function() {
+            // Failed lists can be requested again on the next press
+            ids.forEach(function(listingId) { delete manifestRequested[listingId]; });
+        });
+}
+
 // Function to show image at specific index
 function showImage(listingId, idx) {
     var imgs = window.listingImages[listingId];
@@ -9,45 +50,48 @@ function showImage(listingId, idx) {
     if (idx < 0) idx = imgs.length - 1;
     if (idx >= imgs.length) idx = 0;
     window.listingImageIndex[listingId] = idx;
-    document.getElementById('listing-img-' + listingId).src = imgs[idx];
+    var img = document.getElementById('listing-img-' + listingId);
+    // The resized srcset only describes the cover image, so drop it before switching.
+    img.removeAttribute('srcset');
+    if (img.parentNode.tagName === 'PICTURE') {
+        img.parentNode.querySelectorAll('source').forEach(function(source) { source.remove(); });
+    }
+    img.src = imgs[idx];
+    // Warm the cache for the image the next press will show
+    if (imgs.length > 1) {
+        new Image().src = imgs[(idx + 1) % imgs.length];
+    }
 }
 
 // Initialize carousel functionality
 function initializeCarousel() {
-    // Set up event listeners for navigation buttons
-    var buttons = document.querySelectorAll('button[data-listing-id][data-direction]');
-    console.log('Found buttons:', buttons.length);
-    
-    buttons.forEach(function(btn) {
-        btn.addEventListener('click', function(e) {
-            e.preventDefault();
-            var listingId = this.getAttribute('data-listing-id');
-            var direction = this.getAttribute('data-direction');
+    // One delegated listener, so cards appended by infinite scroll work too
+    document.addEventListener('click', function(e) {
+        var btn = e.target.closest('button[data-listing-id][data-direction]');
+        if (!btn) return;
+        e.preventDefault();
+        var listingId = btn.getAttribute('data-listing-id');
+        var direction = btn.getAttribute('data-direction');
+        withListingImages(listingId, function() {
             var idx = window.listingImageIndex[listingId] || 0;
-            console.log('Button clicked:', listingId, direction, idx);
-            console.log('Available images:', window.listingImages[listingId]);
             if (direction === 'prev') {
                 showImage(listingId, idx - 1);
             } else {
                 showImage(listingId, idx + 1);
             }
         });
-        
-        // Add hover effect for better UX
-        btn.addEventListener('mouseenter', function() {
-            this.style.opacity = '1';
-        });
-        btn.addEventListener('mouseleave', function() {
-            this.style.opacity = '0.8';
-        });
     });
-    
-    console.log('Carousel initialized with listings:', Object.keys(window.listingImages));
-    console.log('Total buttons found:', document.querySelectorAll('button[data-listing-id][data-direction]').length);
+
+    // Add hover effect for better UX
+    document.addEventListener('mouseover', function(e) {
+        var btn = e.target.closest('button[data-listing-id][data-direction]');
+        if (btn) btn.style.opacity = '1';
+    });
+    document.addEventListener('mouseout', function(e) {
+        var btn = e.target.closest('button[data-listing-id][data-direction]');
+        if (btn) btn.style.opacity = '0.8';
+    });
 }
 
 // Initialize when DOM is ready
-document.addEventListener('DOMContentLoaded', function() {
-    // Wait a bit for data to be initialized
-    setTimeout(initializeCarousel, 100);
-}); 
\ No newline at end of file
+document.addEventListener('DOMContentLoaded', initializeCarousel);
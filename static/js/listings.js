@@ -1,46 +1,125 @@
-// Image carousel functionality for listings page
-window.listingImages = {};
-window.listingImageIndex = {};
+// Infinite scroll for the listings page: when the end of the grid comes into
+// view, fetch the next page from /api/listings and append its cards. The
+// server-rendered Next link stays as the fallback without JavaScript.
+// The carousel arrows are handled by carousel.js.
+(function() {
+    var STATUS_BADGES = {
+        'Available': 'badge bg-success',
+        'Reserved': 'badge bg-warning text-dark',
+        'Sold': 'badge bg-danger'
+    };
 
-function showImage(listingId, idx) {
-    var imgs = window.listingImages[listingId];
-    if (!imgs || imgs.length === 0) return;
-    if (idx < 0) idx = imgs.length - 1;
-    if (idx >= imgs.length) idx = 0;
-    window.listingImageIndex[listingId] = idx;
-    document.getElementById('listing-img-' + listingId).src = imgs[idx];
-}
+    function element(tag, attrs, text) {
+        var el = document.createElement(tag);
+        Object.keys(attrs || {}).forEach(function(name) { el.setAttribute(name, attrs[name]); });
+        if (text !== undefined) el.textContent = text;
+        return el;
+    }
 
-function initializeCarousel() {
-    document.querySelectorAll('button[data-listing-id][data-direction]').forEach(function(btn) {
-        btn.addEventListener('click', function() {
-            var listingId = this.getAttribute('data-listing-id');
-            var direction = this.getAttribute('data-direction');
-            var idx = window.listingImageIndex[listingId] || 0;
-            if (direction === 'prev') {
-                showImage(listingId, idx - 1);
-            } else {
-                showImage(listingId, idx + 1);
-            }
+    function imageWrapper(listing) {
+        var wrapper = element('div', {
+            'class': 'image-wrapper position-relative d-flex align-items-center justify-content-center',
+            'style': 'width:100%;aspect-ratio:4/3;max-width:100%;background:#fff;'
         });
-    });
-}
+        var imgStyle = 'width:100%;height:100%;object-fit:contain;display:block;background:#fff;';
+        if (!listing.cover) {
+            wrapper.appendChild(element('img', {src: 'https://via.placeholder.com/400x300?text=No+Image', alt: 'No Image', style: imgStyle}));
+            return wrapper;
+        }
+        wrapper.appendChild(element('img', {id: 'listing-img-' + listing.id, src: listing.cover, alt: 'Listing Image', loading: 'lazy', style: imgStyle}));
+        if (listing.image_count > 1) {
+            [['prev', 'start-0', '←', 'Previous'], ['next', 'end-0', '→', 'Next']].forEach(function(b) {
+                var btn = element('button', {
+                    type: 'button',
+                    'class': 'btn btn-light btn-sm position-absolute top-50 ' + b[1] + ' translate-middle-y p-0 border-0',
+                    style: 'z-index:2;width:32px;height:32px;opacity:0.8;border-radius:50%;display:flex;align-items:center;justify-content:center;background:rgba(255,255,255,0.9);',
+                    'data-listing-id': listing.id, 'data-direction': b[0], 'aria-label': b[3]
+                });
+                btn.appendChild(element('span', {style: 'font-size:1.5em;line-height:1;'}, b[2]));
+                wrapper.appendChild(btn);
+            });
+        }
+        return wrapper;
+    }
 
-// Global function to be called from template
-window.initializeListingData = function(uploadBaseUrl) {
-    document.querySelectorAll('.listing-data').forEach(function(dataDiv) {
-        var listingId = dataDiv.getAttribute('data-listing-id');
-        var imagesData = JSON.parse(dataDiv.getAttribute('data-images'));
-        
-        // Convert filenames to full URLs
-        var imageUrls = imagesData.map(function(filename) {
-            return uploadBaseUrl + filename;
-        });
-        
-        window.listingImages[listingId] = imageUrls;
-        window.listingImageIndex[listingId] = 0;
+    function favoriteForm(listing, grid) {
+        var favoriteUrl = grid.getAttribute('data-favorite-url').replace(/0$/, listing.id);
+        var unfavoriteUrl = grid.getAttribute('data-unfavorite-url').replace(/0$/, listing.id);
+        var form = element('form', {method: 'POST', action: favoriteUrl, style: 'display:inline;'});
+        var btn = element('button', {type: 'submit', 'class': 'btn btn-link p-0'});
+        if (listing.favorited) {
+            btn.setAttribute('formaction', unfavoriteUrl);
+            btn.appendChild(element('span', {style: 'color:#e25555; font-size:1.5em;'}, '❤'));
+        } else {
+            btn.appendChild(element('span', {style: 'color:#bbb; font-size:1.5em;'}, '♡'));
+        }
+        form.appendChild(btn);
+        return form;
+    }
+
+    function listingCard(listing, grid) {
+        var column = element('div', {'class': 'col-md-4 mb-4'});
+        var card = element('div', {'class': 'card fixed-card h-100'});
+        var body = element('div', {'class': 'card-body'});
+        var heading = element('div', {'class': 'd-flex justify-content-between align-items-center'});
+        heading.appendChild(element('h5', {'class': 'card-title mb-0'}, listing.title));
+        if (listing.favorited !== null) heading.appendChild(favoriteForm(listing, grid));
+        body.appendChild(heading);
+        body.appendChild(element('p', {'class': 'card-text'}, '$' + listing.price));
+        var badges = element('p', {'class': 'card-text'});
+        badges.appendChild(element('span', {'class': 'badge bg-secondary'}, listing.category));
+        if (STATUS_BADGES[listing.status]) {
+            badges.appendChild(document.createTextNode(' '));
+            badges.appendChild(element('span', {'class': STATUS_BADGES[listing.status]}, listing.status));
+        }
+        if (listing.location) {
+            badges.appendChild(document.createTextNode(' '));
+            badges.appendChild(element('span', {'class': 'badge bg-info text-dark'}, listing.location));
+        }
+        body.appendChild(badges);
+        body.appendChild(element('a', {href: listing.url, 'class': 'btn btn-primary'}, 'View Details'));
+        card.appendChild(imageWrapper(listing));
+        card.appendChild(body);
+        column.appendChild(card);
+        return column;
+    }
+
+    document.addEventListener('DOMContentLoaded', function() {
+        var grid = document.getElementById('listing-grid');
+        var nextUrl = grid && grid.getAttribute('data-next-page');
+        if (!nextUrl || !('IntersectionObserver' in window)) return;
+        var nextLink = document.getElementById('listings-next');
+        if (nextLink) nextLink.style.display = 'none';
+        var sentinel = element('div', {'aria-hidden': 'true'});
+        grid.parentNode.insertBefore(sentinel, grid.nextSibling);
+        var loading = false;
+
+        var observer = new IntersectionObserver(function(entries) {
+            if (!entries[0].isIntersecting || loading || !nextUrl) return;
+            loading = true;
+            fetch(nextUrl, {credentials: 'same-origin', headers: {'Accept': 'application/json'}})
+                .then(function(response) {
+                    if (!response.ok) throw new Error('HTTP ' + response.status);
+                    return response.json();
+                })
+                .then(function(page) {
+                    page.items.forEach(function(listing) { grid.appendChild(listingCard(listing, grid)); });
+                    if (page.next_cursor) {
+                        var url = new URL(nextUrl, window.location.href);
+                        url.searchParams.set('after', page.next_cursor);
+                        nextUrl = url.toString();
+                    } else {
+                        nextUrl = null;
+                        observer.disconnect();
+                    }
+                })
+                .catch(function() {
+                    // Fall back to the regular page link
+                    observer.disconnect();
+                    if (nextLink) nextLink.style.display = '';
+                })
+                .then(function() { loading = false; });
+        }, {rootMargin: '600px'});
+        observer.observe(sentinel);
     });
-    
-    // Initialize carousel after data is loaded
-    initializeCarousel();
-}; 
\ No newline at end of file
+})();
@@ -0,0 +1,99 @@
+// Live updates from the /events stream on the conversation pages: the unread
+// badge in the navbar, new messages in an open conversation and the
+// conversation list. The pages still render everything themselves; this only
+// saves reloading them.
+(function() {
+    var script = document.currentScript;
+    if (!window.EventSource || !script) return;
+    var me = script.getAttribute('data-username');
+
+    function element(tag, className, text) {
+        var el = document.createElement(tag);
+        if (className) el.className = className;
+        if (text !== undefined) el.textContent = text;
+        return el;
+    }
+
+    function showUnread(count) {
+        var badge = document.getElementById('unread-badge');
+        if (!badge) return;
+        badge.textContent = count;
+        badge.classList.toggle('d-none', count <= 0);
+    }
+
+    function appendToConversation(msg) {
+        var list = document.getElementById('message-list');
+        var partner = list && list.getAttribute('data-partner');
+        if (!partner || (msg.sender !== partner && msg.recipient !== partner)) return;
+        if (list.querySelector('[data-message-id="' + msg.id + '"]')) return;
+        var mine = msg.sender === me;
+        var row = element('div', 'mb-2 d-flex ' + (mine ? 'justify-content-end' : 'justify-content-start'));
+        row.setAttribute('data-message-id', msg.id);
+        var bubble = element('div', 'p-2 rounded text-white ' + (mine ? 'bg-primary' : 'bg-secondary'));
+        bubble.style.maxWidth = '70%';
+        var heading = element('div', 'small');
+        heading.appendChild(element('b', null, msg.sender));
+        heading.appendChild(document.createTextNode(' '));
+        heading.appendChild(element('span', 'text-muted', msg.timestamp));
+        bubble.appendChild(heading);
+        bubble.appendChild(element('div', null, msg.content));
+        row.appendChild(bubble);
+        var placeholder = document.getElementById('no-messages');
+        if (placeholder) placeholder.remove();
+        list.appendChild(row);
+        list.scrollTop = list.scrollHeight;
+        if (!mine) {
+            // The message is on screen, so it has been read
+            fetch(list.getAttribute('data-read-url'), {
+                method: 'POST', credentials: 'same-origin', body: new URLSearchParams({up_to: msg.id})
+            });
+        }
+    }
+
+    function updateThreadList(msg) {
+        var list = document.getElementById('thread-list');
+        if (!list) return;
+        var partner = msg.sender === me ? msg.recipient : msg.sender;
+        var row = list.querySelector('[data-partner="' + partner + '"]');
+        if (!row) {
+            document.getElementById('threads-updated').classList.remove('d-none');
+            return;
+        }
+        row.querySelector('.thread-snippet').textContent = msg.content.length > 40 ? msg.content.slice(0, 40) + '...' : msg.content;
+        row.querySelector('.thread-time').textContent = msg.timestamp;
+        if (msg.sender !== me) {
+            var badge = row.querySelector('.badge');
+            badge.textContent = parseInt(badge.textContent, 10) + 1;
+            badge.classList.remove('d-none');
+        }
+        list.insertBefore(row, list.firstChild);
+    }
+
+    var source, stream;
+
+    function open() {
+        // Named so that leaving the page can end it on the server at once
+        stream = Math.random().toString(36).slice(2);
+        source = new EventSource(script.getAttribute('data-events-url') + '?stream=' + stream);
+        source.addEventListener('unread', function(e) {
+            showUnread(JSON.parse(e.data).unread_count);
+        });
+        source.addEventListener('message', function(e) {
+            var msg = JSON.parse(e.data);
+            appendToConversation(msg);
+            updateThreadList(msg);
+        });
+    }
+
+    window.addEventListener('pagehide', function() {
+        source.close();
+        if (navigator.sendBeacon) {
+            navigator.sendBeacon(script.getAttribute('data-close-url'), new URLSearchParams({stream: stream}));
+        }
+    });
+    window.addEventListener('pageshow', function(e) {
+        // Back from the page cache, with the old stream already closed
+        if (e.persisted) open();
+    });
+    open();
+})();
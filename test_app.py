@@ -6,20 +6,29 @@ Run with: python -m pytest test_app.py
 import pytest
 import os
 import tempfile
-from app import app, db, User, Listing, ListingImage
+from app import create_app, db, User, Listing, ListingImage, user_cache, fragment_cache, admin_stats_cache, login_throttle
 from werkzeug.security import generate_password_hash
 
 
 @pytest.fixture
-def client():
+def app(tmp_path_factory):
+    """Create an application with a database of its own."""
+    database = tmp_path_factory.mktemp('db') / 'test.db'
+    return create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': f'sqlite:///{database}'})
+
+
+@pytest.fixture
+def client(app):
     """Create a test client for the Flask application."""
-    app.config['TESTING'] = True
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
-    
     with app.test_client() as client:
         with app.app_context():
+            user_cache.clear()
+            fragment_cache.clear()
+            admin_stats_cache['stats'] = None
+            login_throttle.clear()
             db.create_all()
             yield client
+            db.session.remove()
             db.drop_all()
 
 
@@ -56,7 +65,7 @@ def test_login_page(client):
     assert b'Login' in response.data
 
 
-def test_user_registration(client):
+def test_user_registration(app, client):
     """Test user registration functionality."""
     response = client.post('/register', data={
         'username': 'newuser',
@@ -86,7 +95,7 @@ def test_listings_page(client):
     assert b'All Listings' in response.data
 
 
-def test_create_listing(client, test_user):
+def test_create_listing(app, client, test_user):
     """Test creating a new listing."""
     # Login first
     client.post('/login', data={
@@ -112,7 +121,7 @@ def test_create_listing(client, test_user):
         assert listing.seller.username == 'testuser'
 
 
-def test_listing_detail_page(client, test_user):
+def test_listing_detail_page(app, client, test_user):
     """Test listing detail page."""
     # Create a test listing
     with app.app_context():
@@ -132,7 +141,7 @@ def test_listing_detail_page(client, test_user):
         assert b'Test Item' in response.data
 
 
-def test_favorite_functionality(client, test_user):
+def test_favorite_functionality(app, client, test_user):
     """Test favorite/unfavorite functionality."""
     # Create a test listing
     with app.app_context():
@@ -179,17 +188,18 @@ def test_file_upload_security():
     assert allowed_file('image.txt') == False
 
 
-def test_password_hashing():
+def test_password_hashing(app):
     """Test password hashing functionality."""
-    user = User(username='testuser')
-    user.password = 'testpass'
+    with app.app_context():
+        user = User(username='testuser')
+        user.password = 'testpass'
     
-    # Test password verification
-    assert user.verify_password('testpass') == True
-    assert user.verify_password('wrongpass') == False
+        # Test password verification
+        assert user.verify_password('testpass') == True
+        assert user.verify_password('wrongpass') == False
 
 
-def test_database_relationships():
+def test_database_relationships(app):
     """Test database relationships."""
     with app.app_context():
         # Create test user
@@ -226,5 +236,988 @@ def test_database_relationships():
         assert image.listing == listing
 
 
+def test_listings_keyset_pagination(client, test_user):
+    """Test that listings are paged with next/prev cursors for every sort."""
+    from app import LISTINGS_PER_PAGE
+    import re
+    total = LISTINGS_PER_PAGE + 5
+    for i in range(total):
+        db.session.add(Listing(title=f'Item {i:03d}', description='d', price=float(i % 7),
+                               category='Books', seller=test_user))
+    db.session.commit()
+
+    for sort in ('newest', 'price_asc', 'price_desc'):
+        response = client.get(f'/listings?sort={sort}&category=Books')
+        first = re.findall(rb'Item \d{3}', response.data)
+        assert len(first) == LISTINGS_PER_PAGE
+        next_url = re.search(rb'href="(/listings\?[^"]*after=[^"]*)"', response.data).group(1)
+        response = client.get(next_url.decode().replace('&amp;', '&'))
+        second = re.findall(rb'Item \d{3}', response.data)
+        assert len(second) == total - LISTINGS_PER_PAGE
+        assert not set(first) & set(second)
+        assert b'category=Books' in response.data
+        prev_url = re.search(rb'href="(/listings\?[^"]*before=[^"]*)"', response.data).group(1)
+        response = client.get(prev_url.decode().replace('&amp;', '&'))
+        assert re.findall(rb'Item \d{3}', response.data) == first
+
+
+def test_keyword_search_index(client, test_user):
+    """Test that keyword search is ranked and follows listing edits and deletes."""
+    import re
+    lamp = Listing(title='Desk lamp', description='Bright and cheap', price=5.0, seller=test_user)
+    chair = Listing(title='Office chair', description='Comes with a free desk lamp bulb', price=20.0, seller=test_user)
+    db.session.add_all([lamp, chair])
+    db.session.commit()
+
+    response = client.get('/listings?keyword=lamp')
+    assert re.findall(rb'<h5 class="card-title mb-0">([^<]+)</h5>', response.data) == [b'Desk lamp', b'Office chair']
+
+    chair.title = 'Gaming chair'
+    chair.description = 'Barely used'
+    db.session.commit()
+    response = client.get('/listings?keyword=lamp')
+    assert b'Gaming chair' not in response.data
+    response = client.get('/listings?keyword=gam')
+    assert b'Gaming chair' in response.data
+
+    db.session.delete(lamp)
+    db.session.commit()
+    response = client.get('/listings?keyword=lamp')
+    assert b'Desk lamp' not in response.data
+
+
+def test_search_term_fallback(app, client, test_user):
+    """Test the pure-Python inverted index used on non-SQLite backends."""
+    from app import search_listings_subquery, listing_search_term
+    app.config['SEARCH_BACKEND'] = 'terms'
+    try:
+        db.session.add_all([
+            Listing(title='Red bike', description='Road bike', price=50.0, seller=test_user),
+            Listing(title='Helmet', description='Fits any red bike', price=15.0, seller=test_user),
+            Listing(title='Red scarf', description='Wool', price=8.0, seller=test_user),
+        ])
+        db.session.commit()
+        matches = search_listings_subquery('red bik')
+        rows = db.session.execute(db.select(Listing.title).join(matches, matches.c.listing_id == Listing.id)
+                                  .order_by(matches.c.rank)).scalars().all()
+        assert rows == ['Red bike', 'Helmet']
+    finally:
+        db.session.execute(listing_search_term.delete())
+        db.session.commit()
+        app.config['SEARCH_BACKEND'] = 'auto'
+
+
+def count_queries(fn):
+    """Run fn and return how many SQL statements it executed."""
+    from sqlalchemy import event
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        fn()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+    return len(statements)
+
+
+def test_listing_cards_constant_queries(client, test_user):
+    """Test that card pages do not issue a query per listing."""
+    buyer = User(username='buyer', password_hash=generate_password_hash('buyerpass'))
+    db.session.add(buyer)
+    db.session.commit()
+    client.post('/login', data={'username': 'buyer', 'password': 'buyerpass'})
+
+    def add_listings(n):
+        for i in range(n):
+            listing = Listing(title=f'Card {i}', description='d', price=1.0, seller=test_user,
+                              reserved_by=buyer, status='Sold')
+            db.session.add(listing)
+            db.session.add_all([ListingImage(filename=f'{i}_a.jpg', listing=listing, is_cover=True),
+                                ListingImage(filename=f'{i}_b.jpg', listing=listing)])
+            buyer.favorites.append(listing)
+        db.session.commit()
+        db.session.expire_all()
+
+    add_listings(2)
+    few = {url: count_queries(lambda: client.get(url)) for url in ('/listings', '/my_favorites', '/my_purchases')}
+    add_listings(20)
+    many = {url: count_queries(lambda: client.get(url)) for url in few}
+    assert many == few
+
+
+def test_image_derivatives(app, client, test_user, tmp_path):
+    """Test that uploads get resized copies that the listing cards serve via srcset."""
+    import io
+    PIL = pytest.importorskip('PIL.Image')
+    saved = app.config['UPLOAD_FOLDER'], app.config['IMAGE_WORKERS']
+    app.config.update(UPLOAD_FOLDER=str(tmp_path), IMAGE_WORKERS=0)
+    try:
+        upload = io.BytesIO()
+        PIL.new('RGB', (2000, 1500), 'red').save(upload, 'PNG')
+        upload.seek(0)
+        client.post('/login', data={'username': 'testuser', 'password': 'testpass'})
+        client.post('/listing/new', data={'title': 'Bike', 'description': 'd', 'price': '10', 'category': 'Sports',
+                                          'location': 'Campus', 'images': (upload, 'bike.png')},
+                    content_type='multipart/form-data')
+        image = ListingImage.query.one()
+        assert 'jpg' in image.derivatives.split(',')
+        with PIL.open(tmp_path / image.filename.replace('.png', '.thumb.jpg')) as thumb:
+            assert max(thumb.size) == 480
+        response = client.get('/listings')
+        assert image.filename.replace('.png', '.thumb.jpg').encode() in response.data
+        assert b'480w' in response.data and b'1280w' in response.data
+    finally:
+        app.config['UPLOAD_FOLDER'], app.config['IMAGE_WORKERS'] = saved
+
+
+def test_media_caching(app, client, tmp_path, monkeypatch):
+    """Test content-hash ETags, conditional and range requests, and proxy offload for uploads."""
+    import hashlib
+    body = b'0123456789' * 100
+    digest = hashlib.sha256(body).hexdigest()
+    (tmp_path / 'photo.jpg').write_bytes(body)
+    (tmp_path / f'{digest}.jpg').write_bytes(body)
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', str(tmp_path))
+
+    response = client.get('/uploads/photo.jpg')
+    assert response.get_etag() == (digest, False)
+    assert response.cache_control.no_cache and not response.cache_control.immutable
+    assert client.get('/uploads/photo.jpg', headers={'If-None-Match': f'"{digest}"'}).status_code == 304
+    partial = client.get('/uploads/photo.jpg', headers={'Range': 'bytes=10-19'})
+    assert partial.status_code == 206 and partial.data == body[10:20]
+
+    response = client.get(f'/uploads/{digest}.jpg')
+    assert response.cache_control.immutable and response.cache_control.max_age == 365 * 24 * 3600
+    assert client.get('/uploads/../test_app.py').status_code == 404
+
+    monkeypatch.setitem(app.config, 'MEDIA_SENDFILE', 'x-accel-redirect')
+    response = client.get('/uploads/photo.jpg')
+    assert response.headers['X-Accel-Redirect'] == '/_media/uploads/photo.jpg'
+    assert response.data == b'' and response.mimetype == 'image/jpeg'
+    assert client.get('/uploads/photo.jpg', headers={'If-None-Match': f'"{digest}"'}).status_code == 304
+
+
+def test_uploads_are_deduplicated(app, client, test_user, tmp_path, monkeypatch):
+    """Test that identical uploads are stored once and removed with their last reference."""
+    import io
+    from app import StoredFile
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', str(tmp_path))
+    monkeypatch.setattr('app.Image', None)
+    client.post('/login', data={'username': 'testuser', 'password': 'testpass'})
+    for title in ('Lamp', 'Lamp again'):
+        client.post('/listing/new', data={'title': title, 'description': 'd', 'price': '5', 'category': 'Other',
+                                          'location': 'Campus', 'images': (io.BytesIO(b'lamp photo'), 'lamp.jpg')},
+                    content_type='multipart/form-data')
+    first, second = ListingImage.query.order_by(ListingImage.id).all()
+    assert first.filename == second.filename and db.session.get(StoredFile, first.filename).refcount == 2
+    assert [p.name for p in tmp_path.rglob('*.jpg')] == [first.filename.split('/')[1]]
+    assert client.get(f'/uploads/{first.filename}').data == b'lamp photo'
+
+    client.post(f'/listing/{first.listing_id}/delete')
+    assert (tmp_path / second.filename).exists()
+    client.post(f'/listing/{second.listing_id}/delete')
+    assert not (tmp_path / second.filename).exists() and StoredFile.query.count() == 0
+
+
+def test_listing_card_fragment_cache(app, client, test_user, tmp_path, monkeypatch):
+    """Test that cards are cached per listing version with a per-user favorite heart."""
+    buyer = User(username='buyer', password_hash=generate_password_hash('buyerpass'))
+    listing = Listing(title='Desk', description='d', price=20.0, seller=test_user)
+    db.session.add_all([buyer, listing])
+    db.session.commit()
+    client.post('/login', data={'username': 'buyer', 'password': 'buyerpass'})
+    for backend in ('memory', 'sqlite'):
+        monkeypatch.setitem(app.config, 'FRAGMENT_CACHE', backend)
+        monkeypatch.setitem(app.config, 'FRAGMENT_CACHE_PATH', str(tmp_path / 'fragments.db'))
+        fragment_cache.clear()
+        assert b'&#9825;' in client.get('/listings').data
+        client.post(f'/favorite/{listing.id}')
+        response = client.get('/listings')
+        assert b'&#10084;' in response.data and b'badge bg-success' in response.data
+        assert fragment_cache.stats()['hits'] == 1 and fragment_cache.stats()['size'] == 1
+        client.post(f'/listing/{listing.id}/reserve')
+        assert b'badge bg-warning' in client.get('/listings').data
+        client.post(f'/listing/{listing.id}/cancel_reservation')
+        client.post(f'/unfavorite/{listing.id}')
+    client.get('/logout')
+    client.post('/login', data={'username': 'testuser', 'password': 'testpass'})
+    client.post(f'/listing/{listing.id}/delete')
+    assert fragment_cache.stats()['size'] == 0
+
+    # Deleted by another worker, whose eviction this one never saw
+    db.session.add(Listing(title='Chair', description='d', price=5.0, seller=test_user))
+    db.session.commit()
+    assert b'Chair' in client.get('/listings').data
+    db.session.execute(db.delete(Listing))
+    db.session.commit()
+    db.session.add(Listing(title='Lamp', description='d', price=5.0, seller=test_user))
+    db.session.commit()
+    page = client.get('/listings').data
+    assert b'Lamp' in page and b'Chair' not in page
+
+
+def test_listings_api(client, test_user):
+    """Test the JSON listings API: filters, cursors, sparse fields, ETags and gzip."""
+    import gzip
+    import json
+    for i in range(30):
+        listing = Listing(title=f'Book {i}', description='Paperback ' * 20, price=float(i), category='Books',
+                          seller=test_user)
+        db.session.add_all([listing, ListingImage(filename=f'{i}.jpg', listing=listing, is_cover=True)])
+    db.session.add(Listing(title='Kettle', description='d', price=3.0, category='Appliances', seller=test_user))
+    db.session.commit()
+
+    page = client.get('/api/listings?category=Books&sort=price_asc&fields=id,title,price,cover').get_json()
+    assert [item['title'] for item in page['items'][:2]] == ['Book 0', 'Book 1']
+    assert set(page['items'][0]) == {'id', 'title', 'price', 'cover'}
+    assert page['items'][0]['cover'] == '/uploads/0.jpg'
+    rest = client.get(f"/api/listings?category=Books&sort=price_asc&fields=title&after={page['next_cursor']}").get_json()
+    assert len(page['items']) == 24 and len(rest['items']) == 6 and rest['next_cursor'] is None
+    assert client.get('/api/listings?fields=id,secret').status_code == 400
+
+    response = client.get('/api/listings?limit=50&fields=id,title,description', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert len(json.loads(gzip.decompress(response.data))['items']) == 31
+    etag = response.headers['ETag']
+    again = client.get('/api/listings?limit=50&fields=id,title,description',
+                       headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert again.status_code == 304 and again.data == b''
+    plain = client.get('/api/listings?limit=50&fields=id,title,description', headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in plain.headers and plain.headers['ETag'] != etag
+
+    # Page links only carry the filters over
+    html = client.get('/listings?category=Books&fields=id&_external=1&limit=3').get_data(as_text=True)
+    assert 'data-next-page="/api/listings?after=' in html and 'category=Books' in html
+    assert 'limit=3' not in html and '_external' not in html and 'http://' not in html
+
+
+def test_listing_image_manifests(client, test_user):
+    """Test that card pages leave non-cover images to the batched manifest endpoint."""
+    lamp = Listing(title='Lamp', description='d', price=5.0, seller=test_user)
+    desk = Listing(title='Desk', description='d', price=9.0, seller=test_user)
+    db.session.add_all([lamp, desk,
+                        ListingImage(filename='lamp_side.jpg', listing=lamp),
+                        ListingImage(filename='lamp_front.jpg', listing=lamp, is_cover=True),
+                        ListingImage(filename='desk.jpg', listing=desk, is_cover=True)])
+    db.session.commit()
+
+    page = client.get('/listings').data
+    assert b'lamp_front.jpg' in page and b'lamp_side.jpg' not in page
+    manifests = client.get(f'/api/listing-images?ids={lamp.id},{desk.id},999').get_json()['images']
+    assert manifests == {str(lamp.id): ['/uploads/lamp_front.jpg', '/uploads/lamp_side.jpg'],
+                         str(desk.id): ['/uploads/desk.jpg'], '999': []}
+    assert client.get('/api/listing-images?ids=1,x').status_code == 400
+    detail = client.get(f'/listing/{lamp.id}').data
+    assert b'src="/uploads/lamp_side.jpg" class="d-block w-100" style="max-height:400px; object-fit:contain;" loading="lazy"' in detail
+
+
+def test_rating_summary_and_profile_pages(app, client, test_user):
+    """Test that reviews update the seller's rating summary and profiles page their history."""
+    from app import RatingSummary, PROFILE_LISTINGS_PER_PAGE
+    buyer = User(username='buyer', password_hash=generate_password_hash('buyerpass'))
+    sold = [Listing(title=f'Sold {i}', description='d', price=1.0, seller=test_user, reserved_by=buyer, status='Sold')
+            for i in range(12)]
+    db.session.add_all([buyer] + sold)
+    db.session.add_all(Listing(title=f'Extra {i}', description='d', price=1.0, seller=test_user) for i in range(5))
+    db.session.commit()
+    client.post('/login', data={'username': 'buyer', 'password': 'buyerpass'})
+    for listing, rating in zip(sold, [5] * 8 + [4, 4, 1, 9]):
+        client.post(f'/review/{listing.id}/{test_user.id}', data={'rating': rating, 'comment': f'Review of {listing.title}'})
+
+    summary = db.session.get(RatingSummary, test_user.id)
+    assert (summary.count, summary.total, summary.average) == (11, 49, 4.45)
+    assert summary.histogram == [(5, 8), (4, 2), (3, 0), (2, 0), (1, 1)]
+
+    response = client.get('/user/testuser')
+    assert b'4.45 / 5 (11 reviews)' in response.data
+    assert response.data.count(b'Review of Sold') == 10 and b'reviews_after=' in response.data
+    assert response.data.count(b'<h5 class="card-title">') == PROFILE_LISTINGS_PER_PAGE
+    # Arguments clashing with the path or url_for's options are not carried over
+    response = client.get('/user/testuser?username=x&_anchor=top&listings_after=junk')
+    assert response.status_code == 200 and b'/user/testuser?' in response.data and b'#top' not in response.data
+
+    db.session.commit()
+    db.session.delete(summary)
+    db.session.commit()
+    result = app.test_cli_runner().invoke(args=['rebuild-rating-summaries'])
+    assert 'Rebuilt rating summaries for 1 users.' in result.output
+    assert db.session.get(RatingSummary, test_user.id).histogram == [(5, 8), (4, 2), (3, 0), (2, 0), (1, 1)]
+
+
+def test_admin_dashboard_pages_and_statistics(app, client, test_user, monkeypatch):
+    """Test that the admin tables are filtered and paginated and the statistics are cached."""
+    import re
+    from app import Report, ADMIN_PAGE_SIZE
+    admin = User(username='admin', password_hash=generate_password_hash('adminpass'), is_admin=True)
+    listings = [Listing(title=f'Item {i}', description='d', price=1.0, seller=test_user,
+                        category='Books' if i % 3 else 'Sports', status='Sold' if i % 2 else 'Available')
+                for i in range(ADMIN_PAGE_SIZE + 5)]
+    db.session.add_all([admin] + listings)
+    db.session.add_all(Report(reporter=admin, listing=listing, reason=f'Report {listing.title}!',
+                              resolved=listing.status == 'Sold') for listing in listings)
+    db.session.commit()
+    client.post('/login', data={'username': 'admin', 'password': 'adminpass'})
+
+    response = client.get('/admin')
+    assert response.data.count(b'bg-warning text-dark">Open') == 15
+    assert b'Resolved</span>' not in response.data
+    assert b'<li>Listings: <strong>30</strong></li>' in response.data
+    assert b'<tr><td>Sold</td><td>15</td></tr>' in response.data
+    assert b'<tr><td>Sports</td><td>10</td></tr>' in response.data
+
+    response = client.get('/admin?report_status=all&listing_category=Sports')
+    assert response.data.count(b'Report Item') == ADMIN_PAGE_SIZE
+    assert b'reports_after=' in response.data and b'listings_after=' not in response.data
+    next_url = re.search(rb'href="([^"]*reports_after=[^"]*)"', response.data).group(1).decode().replace('&amp;', '&')
+    response = client.get(next_url)
+    assert response.data.count(b'Report Item') == 5 and b'listing_category=Sports' in response.data
+
+    response = client.get('/admin?user_search=adm&user_role=admin')
+    assert b'>admin</a>' in response.data and b'>testuser</a>' not in response.data
+
+    # Statistics come from the cache until the TTL runs out
+    db.session.add(Listing(title='Late', description='d', price=1.0, seller=test_user, status='Sold'))
+    db.session.commit()
+    assert b'<li>Listings: <strong>30</strong></li>' in client.get('/admin').data
+    monkeypatch.setitem(app.config, 'ADMIN_STATS_TTL', 0)
+    assert b'<li>Listings: <strong>31</strong></li>' in client.get('/admin').data
+
+
+def test_password_rehash_and_login_throttle(app, client, test_user, monkeypatch, tmp_path):
+    """Test that old password hashes are upgraded at login and that attempts are throttled before hashing."""
+    import app as app_module
+    test_user.password_hash = generate_password_hash('testpass', 'pbkdf2:sha256:1000')
+    db.session.commit()
+    monkeypatch.setitem(app.config, 'PASSWORD_HASH_METHOD', 'pbkdf2:sha256:2000')
+    client.post('/login', data={'username': 'testuser', 'password': 'testpass'})
+    db.session.refresh(test_user)
+    assert test_user.password_hash.startswith('pbkdf2:sha256:2000$')
+    assert not test_user.password_needs_rehash()
+    client.get('/logout')
+
+    checks = []
+    monkeypatch.setattr(app_module, 'check_password_hash', lambda *args: checks.append(args) or False)
+    for backend in ('memory', 'sqlite'):
+        monkeypatch.setitem(app.config, 'LOGIN_THROTTLE', backend)
+        monkeypatch.setitem(app.config, 'LOGIN_THROTTLE_PATH', str(tmp_path / 'throttle.db'))
+        monkeypatch.setitem(app.config, 'LOGIN_USER_BURST', 3)
+        monkeypatch.setitem(app.config, 'LOGIN_IP_BURST', 6)
+        monkeypatch.setitem(app.config, 'LOGIN_IP_PER_MINUTE', 1)
+        checks.clear()
+        statuses = [client.post('/login', data={'username': 'testuser', 'password': 'wrong'}).status_code
+                    for _ in range(4)]
+        assert statuses == [200, 200, 200, 429] and len(checks) == 3
+        response = client.post('/login', data={'username': 'TestUser', 'password': 'testpass'})
+        assert response.status_code == 429 and int(response.headers['Retry-After']) == 12
+        assert len(checks) == 3
+
+        # Other usernames have their own bucket until the address runs out
+        assert client.post('/login', data={'username': 'someone', 'password': 'x'}).status_code == 200
+        assert client.post('/login', data={'username': 'another', 'password': 'x'}).status_code == 429
+        login_throttle.clear()
+
+
+def test_login_throttle_behind_proxy(tmp_path):
+    """Test that behind a trusted proxy each client address gets its own login bucket."""
+    for proxies, statuses in ((1, [200, 200, 200]), (0, [200, 429, 429])):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path}/proxy{proxies}.db', 'TRUSTED_PROXIES': proxies,
+                          'LOGIN_IP_BURST': 1, 'LOGIN_IP_PER_MINUTE': 0.001})
+        with app.app_context():
+            db.create_all()
+            login_throttle.clear()
+        client = app.test_client()
+        assert [client.post('/login', data={'username': 'x', 'password': 'x'},
+                            headers={'X-Forwarded-For': f'10.0.0.{i}'}, environ_base={'REMOTE_ADDR': '127.0.0.1'}).status_code
+                for i in range(3)] == statuses
+
+
+def test_conversation_threads(app, client, test_user):
+    """Test that the inbox summaries follow sends and reads, and can be rebuilt."""
+    from app import Thread
+    for name in ('alice', 'bob'):
+        db.session.add(User(username=name, password_hash=generate_password_hash('pass')))
+    db.session.commit()
+
+    client.post('/login', data={'username': 'alice', 'password': 'pass'})
+    client.post(f'/message/send/{test_user.id}', data={'content': 'Is it still available?'})
+    client.post('/messages/testuser', data={'content': 'Can you ship it?'})
+    client.get('/logout')
+    client.post('/login', data={'username': 'bob', 'password': 'pass'})
+    client.post('/messages/testuser', data={'content': 'Hello from bob'})
+    client.get('/logout')
+
+    client.post('/login', data={'username': 'testuser', 'password': 'testpass'})
+    response = client.get('/conversations')
+    assert response.data.index(b'Hello from bob') < response.data.index(b'Can you ship it?')
+    assert b'<span class="badge bg-danger">2</span>' in response.data
+    assert count_queries(lambda: client.get('/conversations')) == count_queries(lambda: client.get('/about')) + 1
+
+    client.get('/messages/alice')
+    thread = Thread.query.filter_by(owner_id=test_user.id).join(Thread.partner).filter(User.username == 'alice').one()
+    assert thread.unread_count == 0
+    assert thread.last_message.content == 'Can you ship it?'
+
+    before = sorted((t.owner_id, t.partner_id, t.last_message_id, t.unread_count) for t in Thread.query)
+    db.session.commit()
+    result = app.test_cli_runner().invoke(args=['rebuild-threads'])
+    assert result.exit_code == 0
+    db.session.expire_all()
+    assert sorted((t.owner_id, t.partner_id, t.last_message_id, t.unread_count) for t in Thread.query) == before
+
+
+def test_live_message_events(app, client, test_user, monkeypatch, tmp_path):
+    """Test that sends and reads are pushed to the user's event stream, from either backend."""
+    import json
+    from app import event_broker
+    db.session.add(User(username='alice', password_hash=generate_password_hash('pass')))
+    db.session.commit()
+    monkeypatch.setitem(app.config, 'EVENTS_KEEPALIVE', 0.05)
+
+    def login_as(username, password):
+        client.get('/logout')
+        client.post('/login', data={'username': username, 'password': password})
+
+    def read_event(chunks):
+        chunk = next(chunk for chunk in chunks if not chunk.startswith(b':'))
+        fields = dict(line.split(': ', 1) for line in chunk.decode().strip().split('\n') if ': ' in line)
+        return fields.get('id'), fields['event'], json.loads(fields['data'])
+
+    for backend in ('memory', 'sqlite'):
+        monkeypatch.setitem(app.config, 'EVENTS_BACKEND', backend)
+        monkeypatch.setitem(app.config, 'EVENTS_PATH', str(tmp_path / 'events.db'))
+        monkeypatch.setitem(app.config, 'EVENTS_POLL_INTERVAL', 0.01)
+        login_as('testuser', 'testpass')
+        response = client.get('/events', buffered=False)
+        assert response.mimetype == 'text/event-stream'
+        chunks = iter(response.response)
+        assert read_event(chunks) == (None, 'unread', {'unread_count': 0})
+        if backend == 'sqlite':
+            import time
+            time.sleep(0.1)  # let the poller find its starting point
+
+        # The stream outlives the request, so the same client can post as alice
+        login_as('alice', 'pass')
+        client.post('/messages/testuser', data={'content': f'Hello over {backend}'})
+        event_id, name, data = read_event(chunks)
+        assert name == 'message' and data['sender'] == 'alice' and data['content'] == f'Hello over {backend}'
+        assert read_event(chunks)[1:] == ('unread', {'unread_count': 1})
+        login_as('testuser', 'testpass')
+        assert client.post('/messages/alice/read', data={'up_to': data['id']}).status_code == 204
+        assert read_event(chunks)[1:] == ('unread', {'unread_count': 0})
+        response.close()
+        assert event_broker.stats()['streams'] == 0
+
+        # A reconnecting stream catches up from its Last-Event-ID
+        response = client.get('/events', headers={'Last-Event-ID': event_id}, buffered=False)
+        chunks = iter(response.response)
+        read_event(chunks)
+        assert read_event(chunks)[1:] == ('unread', {'unread_count': 1})
+        assert read_event(chunks)[1:] == ('unread', {'unread_count': 0})
+        response.close()
+
+    monkeypatch.setitem(app.config, 'EVENTS_BACKEND', 'none')
+    assert client.get('/events').status_code == 204
+
+
+def test_event_streams_bounded(app, client, test_user, monkeypatch, tmp_path):
+    """Test that only conversation pages open a stream, that a page ends its
+    stream when it is left, and that a worker holds at most EVENTS_MAX_STREAMS."""
+    from app import event_broker
+    client.post('/login', data={'username': 'testuser', 'password': 'testpass'})
+    assert b'live.js' not in client.get('/').data
+    assert b'live.js' in client.get('/conversations').data
+
+    # Without the close the stream would wait out the keepalive
+    monkeypatch.setitem(app.config, 'EVENTS_KEEPALIVE', 30)
+    for backend in ('memory', 'sqlite'):
+        monkeypatch.setitem(app.config, 'EVENTS_BACKEND', backend)
+        monkeypatch.setitem(app.config, 'EVENTS_PATH', str(tmp_path / 'events.db'))
+        monkeypatch.setitem(app.config, 'EVENTS_POLL_INTERVAL', 0.01)
+        left = client.get('/events?stream=left', buffered=False)
+        kept = client.get('/events?stream=kept', buffered=False)
+        left_chunks, kept_chunks = iter(left.response), iter(kept.response)
+        next(left_chunks), next(kept_chunks)
+        assert event_broker.stats()['streams'] == 2
+        assert client.post('/events/close', data={'stream': 'left'}).status_code == 204
+        assert list(left_chunks) == []
+        assert event_broker.stats()['streams'] == 1
+        kept.close()
+
+    monkeypatch.setitem(app.config, 'EVENTS_MAX_STREAMS', 1)
+    first = client.get('/events', buffered=False)
+    assert first.status_code == 200
+    assert client.get('/events').status_code == 204
+    first.close()
+    assert client.get('/events', buffered=False).status_code == 200
+
+def test_conversation_history_pages(client, test_user):
+    """Test that conversations load the latest messages first, page back by
+    cursor with a constant number of queries, and mark read by watermark."""
+    import re
+    from datetime import datetime, timedelta
+    from app import Message, Thread, record_message, CONVERSATION_MESSAGES_PER_PAGE
+    alice = User(username='alice', password_hash=generate_password_hash('pass'))
+    db.session.add(alice)
+    db.session.commit()
+    start = datetime(2024, 1, 1)
+
+    def send(count, offset=0):
+        for i in range(offset, offset + count):
+            # Pairs of messages share a timestamp, so the id breaks the tie
+            sender, recipient = (alice, test_user) if i % 3 else (test_user, alice)
+            record_message(Message(sender=sender, recipient=recipient, content=f'Message {i}.',
+                                   timestamp=start + timedelta(minutes=i // 2)))
+        db.session.commit()
+
+    send(120)
+    client.post('/login', data={'username': 'testuser', 'password': 'testpass'})
+    response = client.get('/messages/alice')
+    shown = [int(n) for n in re.findall(rb'Message (\d+)\.', response.data)]
+    assert shown == list(range(120 - CONVERSATION_MESSAGES_PER_PAGE, 120))
+    db.session.refresh(test_user)
+    assert test_user.unread_count == 0
+    assert Thread.query.filter_by(owner_id=test_user.id, partner_id=alice.id).one().unread_count == 0
+
+    pages, urls = [], ['/messages/alice']
+    while urls[-1]:
+        response = client.get(urls[-1])
+        pages.append([int(n) for n in re.findall(rb'Message (\d+)\.', response.data)])
+        older = re.search(rb'href="([^"]*)" id="older-messages"', response.data)
+        urls.append(older and older.group(1).decode().replace('&amp;', '&'))
+    assert sum(reversed(pages), []) == list(range(120))
+    newer = re.search(rb'href="([^"]*)" id="newer-messages"', response.data).group(1).decode().replace('&amp;', '&')
+    assert [int(n) for n in re.findall(rb'Message (\d+)\.', client.get(newer).data)] == pages[1]
+
+    # Older pages leave new messages unread, the latest page reads them
+    send(2, offset=120)
+    client.get(urls[1])
+    db.session.refresh(test_user)
+    assert test_user.unread_count == 1
+    client.get('/messages/alice')
+    db.session.refresh(test_user)
+    assert test_user.unread_count == 0
+
+    first_page = count_queries(lambda: client.get('/messages/alice'))
+    send(500, offset=122)
+    client.get('/messages/alice')
+    assert count_queries(lambda: client.get('/messages/alice')) == first_page
+
+
+def test_unread_counter(app, client, test_user):
+    """Test the maintained unread counter and its reconciliation command."""
+    db.session.add(User(username='alice', password_hash=generate_password_hash('pass')))
+    db.session.commit()
+    client.post('/login', data={'username': 'alice', 'password': 'pass'})
+    for i in range(3):
+        client.post(f'/message/send/{test_user.id}', data={'content': f'Message {i}'})
+    client.get('/logout')
+    db.session.refresh(test_user)
+    assert test_user.unread_count == 3
+
+    client.post('/login', data={'username': 'testuser', 'password': 'testpass'})
+    response = client.get('/about')
+    assert b'rounded-pill bg-danger">3</span>' in response.data
+    client.get('/messages/alice')
+    db.session.refresh(test_user)
+    assert test_user.unread_count == 0
+
+    test_user.unread_count = 42
+    db.session.commit()
+    result = app.test_cli_runner().invoke(args=['reconcile-unread-counts'])
+    assert result.exit_code == 0
+    db.session.refresh(test_user)
+    assert test_user.unread_count == 0
+
+
+def test_user_loader_cache(app, client, test_user):
+    """Test that the login loader is served from cache and sees profile changes."""
+    from app import load_user
+    user_id = str(test_user.id)
+    db.session.expunge_all()
+    assert load_user(user_id).username == 'testuser'
+    db.session.expunge_all()
+    assert count_queries(lambda: load_user(user_id)) == 0
+    assert user_cache.stats()['hits'] == 1
+
+    user = load_user(user_id)
+    assert user.is_admin is False
+    user.is_admin = True
+    db.session.commit()
+    assert user.version == 1
+    db.session.expunge_all()
+    assert load_user(user_id).is_admin is True
+    assert user_cache.stats()['misses'] == 2
+
+    app.config['USER_CACHE_TTL'] = 0
+    try:
+        user_cache.clear()
+        load_user(user_id)
+        db.session.expunge_all()
+        assert load_user(user_id).is_admin is True
+        assert user_cache.stats()['revalidations'] == 1
+    finally:
+        app.config['USER_CACHE_TTL'] = 30
+
+
+CONCURRENT_SETUP = '''
+from app import app, db, User
+with app.app_context():
+    db.create_all()
+    for i in range(WORKERS):
+        user = User(username=f'worker{i}')
+        user.password = 'pass'
+        db.session.add(user)
+    db.session.add(User(username='seller', password_hash='x'))
+    db.session.commit()
+'''
+
+CONCURRENT_WORKER = '''
+import sys
+from app import app, User
+client = app.test_client()
+client.post('/login', data={'username': f'worker{WORKER}', 'password': 'pass'})
+with app.app_context():
+    seller_id = User.query.filter_by(username='seller').one().id
+failures = 0
+for i in range(MESSAGES):
+    response = client.post(f'/message/send/{seller_id}', data={'content': f'hello {i}'})
+    failures += response.status_code != 302
+sys.exit(failures)
+'''
+
+
+def test_concurrent_writes_from_multiple_processes(tmp_path):
+    """Test that worker processes keep writing while another connection holds
+    a long read transaction (a backup or report) on the same SQLite file."""
+    import sqlite3
+    import subprocess
+    import sys
+    import time
+    workers, messages = 4, 25
+    path = f'{tmp_path}/concurrent.db'
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{path}')
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    subprocess.run([sys.executable, '-c', f'WORKERS = {workers}' + CONCURRENT_SETUP], env=env, cwd=cwd, check=True)
+
+    reader = sqlite3.connect(path, isolation_level=None)
+    reader.execute('BEGIN')
+    reader.execute('SELECT count(*) FROM user').fetchone()
+    procs = [subprocess.Popen([sys.executable, '-c', f'WORKER, MESSAGES = {i}, {messages}' + CONCURRENT_WORKER],
+                              env=env, cwd=cwd, stderr=subprocess.PIPE)
+             for i in range(workers)]
+    try:
+        deadline = time.monotonic() + 60
+        while any(proc.poll() is None for proc in procs) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        # The writers finished while the read transaction was still open
+        assert reader.execute('SELECT count(*) FROM message').fetchone()[0] == 0
+    finally:
+        reader.execute('COMMIT')
+        reader.close()
+    for proc in procs:
+        _, stderr = proc.communicate(timeout=60)
+        assert proc.returncode == 0, stderr.decode()[-2000:]
+
+    conn = sqlite3.connect(path)
+    assert conn.execute('SELECT count(*) FROM message').fetchone()[0] == workers * messages
+    assert conn.execute("SELECT unread_count FROM user WHERE username = 'seller'").fetchone()[0] == workers * messages
+    conn.close()
+
+
+def test_listing_status_transitions(client, test_user):
+    """Test that status changes check their preconditions in the UPDATE itself."""
+    buyer = User(username='buyer', password_hash=generate_password_hash('buyerpass'))
+    listing = Listing(title='Lamp', description='d', price=5.0, seller=test_user)
+    db.session.add_all([buyer, listing])
+    db.session.commit()
+
+    def post(action):
+        client.post(f'/listing/{listing.id}/{action}')
+        with client.session_transaction() as session:
+            category, message = session.pop('_flashes')[-1]
+        db.session.refresh(listing)
+        return category, listing.status, listing.version
+
+    client.post('/login', data={'username': 'testuser', 'password': 'testpass'})
+    assert post('reserve') == ('danger', 'Available', 0)
+    assert post('mark_sold') == ('danger', 'Available', 0)
+    client.get('/logout')
+    client.post('/login', data={'username': 'buyer', 'password': 'buyerpass'})
+    assert post('reserve') == ('success', 'Reserved', 1)
+    assert listing.reserved_by == buyer
+    assert post('reserve') == ('danger', 'Reserved', 1)
+    assert post('mark_sold') == ('danger', 'Reserved', 1)
+    assert post('relist') == ('danger', 'Reserved', 1)
+    assert post('cancel_reservation') == ('info', 'Available', 2)
+    assert post('cancel_reservation') == ('danger', 'Available', 2)
+    assert post('reserve') == ('success', 'Reserved', 3)
+    client.get('/logout')
+    client.post('/login', data={'username': 'testuser', 'password': 'testpass'})
+    assert post('mark_sold') == ('success', 'Sold', 4)
+    assert post('relist') == ('success', 'Available', 5)
+    assert listing.reserved_by is None
+    assert client.post('/listing/999/reserve').status_code == 404
+
+
+RESERVE_SETUP = '''
+from app import app, db, User, Listing
+with app.app_context():
+    db.create_all()
+    seller = User(username='seller', password_hash='x')
+    db.session.add(seller)
+    for i in range(PROCESSES * THREADS):
+        user = User(username=f'buyer{i}')
+        user.password = 'pass'
+        db.session.add(user)
+    db.session.add_all(Listing(title=f'Item {i}', description='d', price=1.0, seller=seller) for i in range(LISTINGS))
+    db.session.commit()
+'''
+
+RESERVE_WORKER = '''
+import json
+import random
+import threading
+from app import app
+
+def buyer(number, wins):
+    client = app.test_client()
+    client.post('/login', data={'username': f'buyer{number}', 'password': 'pass'})
+    with client.session_transaction() as session:
+        session.pop('_flashes', None)
+    listing_ids = list(range(1, LISTINGS + 1))
+    random.shuffle(listing_ids)
+    barrier.wait()
+    for listing_id in listing_ids:
+        client.post(f'/listing/{listing_id}/reserve')
+        with client.session_transaction() as session:
+            if [category for category, _ in session.pop('_flashes', [])] == ['success']:
+                wins[listing_id] = number
+
+barrier = threading.Barrier(THREADS)
+wins = {}
+threads = [threading.Thread(target=buyer, args=(PROCESS * THREADS + i, wins)) for i in range(THREADS)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+print(json.dumps(sorted(wins.items())))
+'''
+
+
+def test_concurrent_reservations_have_one_winner(tmp_path):
+    """Test that buyers racing from several processes and threads each get a
+    listing only if nobody else did."""
+    import json
+    import sqlite3
+    import subprocess
+    import sys
+    processes, threads, listings = 3, 4, 20
+    path = f'{tmp_path}/reserve.db'
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{path}', PASSWORD_HASH_METHOD='pbkdf2:sha256:1000')
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    constants = f'PROCESSES, THREADS, LISTINGS = {processes}, {threads}, {listings}\n'
+    subprocess.run([sys.executable, '-c', constants + RESERVE_SETUP], env=env, cwd=cwd, check=True)
+    procs = [subprocess.Popen([sys.executable, '-c', constants + f'PROCESS = {i}\n' + RESERVE_WORKER],
+                              env=env, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+             for i in range(processes)]
+    wins = []
+    for proc in procs:
+        stdout, stderr = proc.communicate(timeout=120)
+        assert proc.returncode == 0, stderr.decode()[-2000:]
+        wins += [tuple(win) for win in json.loads(stdout)]
+
+    assert sorted(listing_id for listing_id, _ in wins) == list(range(1, listings + 1))
+    conn = sqlite3.connect(path)
+    reserved = conn.execute("SELECT listing.id, user.username FROM listing JOIN user ON user.id = reserved_by_id "
+                            "WHERE status = 'Reserved' AND listing.version = 1").fetchall()
+    conn.close()
+    assert sorted(reserved) == sorted((listing_id, f'buyer{number}') for listing_id, number in wins)
+
+
+LEGACY_SCHEMA = """
+CREATE TABLE user (id INTEGER PRIMARY KEY, username VARCHAR(150) NOT NULL UNIQUE, password_hash VARCHAR(150) NOT NULL,
+                   avatar_filename VARCHAR(120), is_admin BOOLEAN);
+CREATE TABLE listing (id INTEGER PRIMARY KEY, title VARCHAR(100) NOT NULL, description TEXT NOT NULL, price FLOAT NOT NULL,
+                      location VARCHAR(100), image_filename VARCHAR(120), category VARCHAR(50),
+                      seller_id INTEGER NOT NULL REFERENCES user(id), reserved_by_id INTEGER REFERENCES user(id),
+                      status VARCHAR(20));
+CREATE TABLE listing_image (id INTEGER PRIMARY KEY, filename VARCHAR(120) NOT NULL,
+                            listing_id INTEGER NOT NULL REFERENCES listing(id), is_cover BOOLEAN);
+CREATE TABLE message (id INTEGER PRIMARY KEY, sender_id INTEGER NOT NULL, recipient_id INTEGER NOT NULL,
+                      content TEXT NOT NULL, timestamp DATETIME, read BOOLEAN);
+CREATE TABLE review (id INTEGER PRIMARY KEY, reviewer_id INTEGER NOT NULL, reviewee_id INTEGER NOT NULL,
+                     listing_id INTEGER NOT NULL, rating INTEGER NOT NULL, comment TEXT, timestamp DATETIME);
+CREATE TABLE report (id INTEGER PRIMARY KEY, reporter_id INTEGER NOT NULL, listing_id INTEGER, reason TEXT NOT NULL,
+                     timestamp DATETIME, resolved BOOLEAN);
+CREATE TABLE favorites (user_id INTEGER NOT NULL, listing_id INTEGER NOT NULL, PRIMARY KEY (user_id, listing_id));
+INSERT INTO user VALUES (1, 'alice', 'x', '1_me.png', 0), (2, 'bob', 'x', NULL, 0);
+INSERT INTO listing VALUES (1, 'Old bicycle', 'Needs a new chain', 30, 'Town', NULL, 'Sports', 1, NULL, 'Available');
+INSERT INTO listing_image VALUES (1, '1_1_bike.png', 1, 1);
+INSERT INTO message VALUES (1, 2, 1, 'Hi', '2024-01-01 10:00:00', 0), (2, 2, 1, 'Still there?', '2024-01-01 11:00:00', 0),
+                           (3, 1, 2, 'Yes', '2024-01-01 12:00:00', 0);
+"""
+
+
+def test_upgrade_legacy_database(app, tmp_path, monkeypatch):
+    """Test that a database created before the migrations is upgraded in place."""
+    import hashlib
+    import sqlite3
+    from sqlalchemy import create_engine
+    from app import upgrade_database, MIGRATIONS
+    for folder in ('uploads', 'avatars'):
+        (tmp_path / folder).mkdir()
+        monkeypatch.setitem(app.config, f'{folder[:-1].upper()}_FOLDER', str(tmp_path / folder))
+    (tmp_path / 'uploads' / '1_1_bike.png').write_bytes(b'same picture')
+    (tmp_path / 'avatars' / '1_me.png').write_bytes(b'same picture')
+    digest = hashlib.sha256(b'same picture').hexdigest()
+    path = tmp_path / 'legacy.db'
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.close()
+
+    engine = create_engine(f'sqlite:///{path}')
+    with app.app_context():
+        assert [v for v, _ in upgrade_database(engine)] == [v for v, _, _ in MIGRATIONS]
+        assert upgrade_database(engine) == []
+    engine.dispose()
+
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT unread_count FROM user WHERE username = 'alice'").fetchone() == (2,)
+    assert conn.execute("SELECT last_message_id, unread_count FROM thread WHERE owner_id = 1").fetchone() == (3, 2)
+    assert conn.execute("SELECT rowid FROM listing_fts WHERE listing_fts MATCH 'chain'").fetchall() == [(1,)]
+    assert 'AUTOINCREMENT' in conn.execute("SELECT sql FROM sqlite_master WHERE name = 'listing'").fetchone()[0]
+    assert conn.execute("SELECT title FROM listing WHERE id = 1").fetchone() == ('Old bicycle',)
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {'ix_listing_category', 'ix_message_pair', 'ix_review_reviewee', 'ix_report_timestamp',
+            'ix_report_resolved', 'ix_user_created_at'} <= indexes
+    stored = f'{digest[:2]}/{digest}.png'
+    assert conn.execute("SELECT filename FROM listing_image").fetchone() == (stored,)
+    assert conn.execute("SELECT avatar_filename FROM user WHERE id = 1").fetchone() == (stored,)
+    assert conn.execute("SELECT name, refcount FROM stored_file").fetchall() == [(stored, 2)]
+    conn.close()
+    assert sorted(str(p.relative_to(tmp_path)) for p in tmp_path.glob('*/**/*.png')) == [f'uploads/{stored}']
+
+
+def test_routes_do_not_scan_tables(client, test_user):
+    """Test with EXPLAIN QUERY PLAN that filtered queries issued by the main
+    routes are answered from indexes instead of full table scans."""
+    import re
+    from sqlalchemy import event
+    other = User(username='other', password_hash=generate_password_hash('pass'))
+    listing = Listing(title='Table lamp', description='d', price=9.0, category='Books', seller=other)
+    db.session.add_all([other, listing, ListingImage(filename='lamp.jpg', listing=listing, is_cover=True)])
+    db.session.commit()
+    client.post('/login', data={'username': 'testuser', 'password': 'testpass'})
+    client.post(f'/message/send/{other.id}', data={'content': 'Hello'})
+    urls = ['/listings?category=Books', '/listings?status=Sold', '/listings?sort=price_asc&min_price=5',
+            '/listings?keyword=lamp', '/my_sales', '/my_purchases', '/my_favorites', '/conversations',
+            '/messages/other', '/user/other']
+    statements = []
+    listener = lambda conn, cursor, statement, parameters, context, executemany: \
+        statements.append((statement, parameters))
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        for url in urls:
+            assert client.get(url).status_code == 200
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+
+    raw = db.engine.raw_connection()
+    try:
+        for statement, parameters in statements:
+            if not statement.lstrip().upper().startswith('SELECT') or not re.search(r'\bWHERE\b', statement):
+                continue
+            plan = [row[3] for row in raw.execute('EXPLAIN QUERY PLAN ' + statement, parameters)]
+            scans = [step for step in plan if re.fullmatch(r'SCAN \w+', step)]
+            assert not scans, (statement, plan)
+    finally:
+        raw.close()
+
+
+def test_sql_profiler_server_timing(app, client, test_user, monkeypatch, caplog):
+    """Test that the opt-in profiler reports query counts and render time in
+    Server-Timing headers and logs slow statements normalized."""
+    import re
+    from app import normalize_sql
+    client.post('/login', data={'username': 'testuser', 'password': 'testpass'})
+    assert 'Server-Timing' not in client.get('/listings').headers
+
+    monkeypatch.setitem(app.config, 'SQL_PROFILER', True)
+    monkeypatch.setitem(app.config, 'SLOW_QUERY_MS', 0)
+    responses = []
+    queries = count_queries(lambda: responses.append(client.get('/listings')))
+    timings = responses[0].headers.getlist('Server-Timing')
+    assert [timing.split(';')[0] for timing in timings] == ['db', 'render', 'app']
+    assert int(re.search(r'desc="(\d+) queries"', timings[0]).group(1)) == queries
+    assert float(timings[1].split('dur=')[1]) > 0
+    slow = [record.getMessage() for record in caplog.records if record.name == 'app.slow_query']
+    assert len(slow) == queries and all(' in listings.listings: SELECT' in line for line in slow)
+
+    assert normalize_sql("SELECT *\n  FROM t WHERE a = 'it''s' AND b IN (1, 2, 3) AND c > 4.5") == \
+        'SELECT * FROM t WHERE a = ? AND b IN (?, ...) AND c > ?'
+
+
+def test_metrics_endpoint(app, client, test_user, tmp_path, monkeypatch):
+    """Test that /metrics reports request counts, latency histograms, upload
+    bytes and row counts, summing what every worker flushed to the store."""
+    import io
+    from app import metrics, SQLiteMetricsStore
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', str(tmp_path))
+    monkeypatch.setitem(app.config, 'METRICS_BACKEND', 'sqlite')
+    monkeypatch.setitem(app.config, 'METRICS_PATH', str(tmp_path / 'metrics.db'))
+    monkeypatch.setattr('app.Image', None)
+    metrics.clear()
+    client.post('/login', data={'username': 'testuser', 'password': 'testpass'})
+    client.post('/listing/new', data={'title': 'Lamp', 'description': 'd', 'price': '5', 'category': 'Other',
+                                      'location': 'Campus', 'images': (io.BytesIO(b'lamp photo'), 'lamp.jpg')},
+                content_type='multipart/form-data')
+    # Recording a request adds no statements to it
+    monkeypatch.setitem(app.config, 'METRICS_BACKEND', 'none')
+    client.get('/listings')
+    unmeasured = count_queries(lambda: client.get('/listings'))
+    monkeypatch.setitem(app.config, 'METRICS_BACKEND', 'sqlite')
+    assert count_queries(lambda: client.get('/listings')) == unmeasured
+    client.get('/listings')
+    # Another worker's flush
+    SQLiteMetricsStore(app.config['METRICS_PATH']).add(
+        {('http_requests_total', (('endpoint', 'listings.listings'), ('method', 'GET'), ('status', '200'))): 5}, {})
+
+    text = client.get('/metrics').get_data(as_text=True)
+    lines = dict(line.rsplit(' ', 1) for line in text.splitlines() if not line.startswith('#'))
+    assert lines['http_requests_total{endpoint="listings.listings",method="GET",status="200"}'] == '7'
+    assert lines['http_requests_total{endpoint="listings.new_listing",method="POST",status="302"}'] == '1'
+    assert lines['http_request_duration_seconds_bucket{endpoint="listings.listings",le="+Inf"}'] == '2'
+    assert lines['http_request_duration_seconds_count{endpoint="listings.listings"}'] == '2'
+    buckets = [int(value) for key, value in lines.items() if key.startswith('http_request_duration_seconds_bucket{endpoint="listings.listings"')]
+    assert buckets == sorted(buckets) and len(buckets) == 12
+    assert lines['upload_bytes_written_total{kind="original"}'] == str(len(b'lamp photo'))
+    assert lines['db_rows{model="Listing"}'] == '1' and lines['db_rows{model="User"}'] == '1'
+    assert int(lines['db_pool_checkouts_total']) > 0
+    assert '# TYPE http_request_duration_seconds histogram' in text
+
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'secret')
+    assert client.get('/metrics').status_code == 403
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
+
+
 if __name__ == '__main__':
-    pytest.main([__file__]) 
\ No newline at end of file
+    pytest.main([__file__]) 
+
+def test_app_factory_isolation(tmp_path):
+    """Test that apps built by create_app keep their own settings and databases."""
+    from sqlalchemy import text
+    first = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path}/first.db', 'SQLITE_BUSY_TIMEOUT': 1234})
+    second = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path}/second.db', 'SQLITE_BUSY_TIMEOUT': 4321})
+    for app, timeout in ((first, 1234), (second, 4321)):
+        with app.app_context():
+            db.create_all()
+            assert db.session.execute(text('PRAGMA busy_timeout')).scalar() == timeout
+    with first.app_context():
+        db.session.add(User(username='first', password_hash='x'))
+        db.session.commit()
+    with second.app_context():
+        assert User.query.count() == 0
+    assert first.test_client().get('/login').status_code == 200
+
+    with pytest.raises(ValueError, match='EVENTS_BACKEND.*LOGIN_USER_BURST'):
+        create_app({'EVENTS_BACKEND': 'redis', 'LOGIN_USER_BURST': 0})